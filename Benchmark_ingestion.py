@@ -0,0 +1,311 @@
+"""
+Banc d'essai de l'import des DICOM : génère localement une série de scanner synthétique avec pydicom,
+puis chronomètre chaque étape de la chaîne d'import (lecture des en-têtes, tri, décodage, réglage du contraste,
+encodage png, écriture) ainsi que ReglageContrasteDICOM, Norm0_1 et Dossier_DICOM_vers_ImagesPNG en entier.
+
+Les résultats sont écrits en JSON pour pouvoir comparer deux versions du code :
+
+    python Benchmark_ingestion.py --coupes 300 --taille 512 --sortie avant.json
+    python Benchmark_ingestion.py --coupes 300 --taille 512 --sortie apres.json --reference avant.json
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pydicom
+from pydicom.dataset import FileDataset, FileMetaDataset
+from PIL import Image
+
+import FunctionsMaster as Tutoriel
+
+
+#Syntaxes de transfert utilisables pour la série synthétique
+SYNTAXES = {"explicite" : pydicom.uid.ExplicitVRLittleEndian,
+            "implicite" : pydicom.uid.ImplicitVRLittleEndian,
+            "rle"       : getattr(pydicom.uid, "RLELossless", "1.2.840.10008.1.2.5"),
+            "jpeg2000"  : getattr(pydicom.uid, "JPEG2000Lossless", "1.2.840.10008.1.2.4.90"),
+            "jpegls"    : getattr(pydicom.uid, "JPEGLSLossless", "1.2.840.10008.1.2.4.80")}
+
+
+def Fantome_CT(taille, z, nb_coupes, generateur):
+    """
+    Crée une coupe de scanner synthétique en UH : air, corps, deux poumons dont la taille varie selon z, un rachis, et du bruit.
+    """
+    y, x = np.mgrid[-1:1:taille * 1j, -1:1:taille * 1j]
+    relatif = z / max(nb_coupes - 1, 1)
+    image = np.full((taille, taille), -1000.)
+    image[(x / 0.9) ** 2 + (y / 0.7) ** 2 < 1] = 40.
+    rayon_poumon = 0.15 + 0.2 * np.sin(np.pi * relatif)
+    for centre in (-0.4, 0.4):
+        image[((x - centre) / rayon_poumon) ** 2 + ((y + 0.05) / (1.4 * rayon_poumon)) ** 2 < 1] = -850.
+    image[x ** 2 + (y - 0.5) ** 2 < 0.01] = 700.
+    return image + generateur.normal(0, 15, image.shape)
+
+
+def _Sauvegarde_dataset(ds, chemin):
+    """
+    Sauvegarde compatible avec les différentes versions de pydicom.
+    """
+    try:
+        ds.save_as(chemin, enforce_file_format=True)
+    except TypeError:
+        ds.save_as(chemin, write_like_original=False)
+
+
+def Generer_serie_synthetique(dossier,
+                              nb_coupes = 200,
+                              taille = 512,
+                              syntaxe = "explicite",
+                              ordre = "normal",
+                              plan = "axial",
+                              epaisseur = 1.,
+                              graine = 42
+                             ):
+    """
+    Génère une série de scanner synthétique réaliste, coupe par coupe (la mémoire utilisée ne dépend pas du nombre de coupes).
+
+    Parameters
+    ----------
+        - dossier : string, dossier où écrire les fichiers DICOM (créé si besoin)
+        - nb_coupes : int, nombre de coupes
+        - taille : int, nombre de lignes et de colonnes de chaque coupe
+        - syntaxe : string, parmi SYNTAXES ('explicite', 'implicite', 'rle', 'jpeg2000', 'jpegls'). Les syntaxes compressées
+        nécessitent une version de pydicom capable de compresser (Dataset.compress) et, pour jpeg2000/jpegls, l'encodeur correspondant.
+        - ordre : string, 'normal' si le nom des fichiers suit l'axe z, 'melange' pour des noms dans le désordre
+        - plan : string, 'axial', 'coronal' ou 'sagittal' : plan de coupe simulé via ImagePositionPatient et ImageOrientationPatient
+        - epaisseur : float, épaisseur de coupe en mm (au-delà de 2.5 mm la série est écartée par Tri_serie_DICOM)
+        - graine : int, rend la série reproductible
+
+    Returns
+    -------
+        - liste_fichiers : liste des chemins des fichiers créés
+
+    """
+    os.makedirs(dossier, exist_ok=True)
+    generateur = np.random.RandomState(graine)
+    transfer_syntax = pydicom.uid.UID(SYNTAXES[syntaxe])
+    noms = np.arange(nb_coupes)
+    if ordre == "melange":
+        noms = generateur.permutation(nb_coupes)
+    orientation = {"axial"    : [1., 0., 0., 0., 1., 0.],
+                   "coronal"  : [1., 0., 0., 0., 0., -1.],
+                   "sagittal" : [0., 1., 0., 0., 0., -1.]}[plan]
+    serie_uid = pydicom.uid.generate_uid()
+    etude_uid = pydicom.uid.generate_uid()
+    ancienne_version = int(pydicom.__version__.split(".")[0]) < 3
+
+    liste_fichiers = []
+    for z in range(nb_coupes):
+        file_meta = FileMetaDataset()
+        file_meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.2" #CT Image Storage
+        file_meta.MediaStorageSOPInstanceUID = pydicom.uid.generate_uid()
+        file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian if transfer_syntax.is_compressed else transfer_syntax
+        chemin = os.path.join(dossier, "IM{:05d}.dcm".format(noms[z]))
+        ds = FileDataset(chemin, {}, file_meta=file_meta, preamble=b"\0" * 128)
+        if ancienne_version:
+            ds.is_little_endian = True
+            ds.is_implicit_VR = file_meta.TransferSyntaxUID == pydicom.uid.ImplicitVRLittleEndian
+
+        ds.SOPClassUID = file_meta.MediaStorageSOPClassUID
+        ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+        ds.StudyInstanceUID = etude_uid
+        ds.SeriesInstanceUID = serie_uid
+        ds.PatientID = "SYNTHETIQUE"
+        ds.Modality = "CT"
+        ds.BodyPartExamined = "CHEST"
+        ds.SeriesDescription = "Serie synthetique {}".format(plan)
+        ds.InstanceNumber = z + 1
+        position = [-175., -175., -175.]
+        position[{"axial" : 2, "coronal" : 1, "sagittal" : 0}[plan]] = z * epaisseur
+        ds.ImagePositionPatient = position
+        ds.ImageOrientationPatient = orientation
+        ds.SliceThickness = epaisseur
+        ds.PixelSpacing = [0.7, 0.7]
+        ds.Rows = taille
+        ds.Columns = taille
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        ds.BitsAllocated = 16
+        ds.BitsStored = 12
+        ds.HighBit = 11
+        ds.PixelRepresentation = 0
+        ds.RescaleIntercept = -1024.
+        ds.RescaleSlope = 1.
+        ds.WindowCenter = 40.
+        ds.WindowWidth = 400.
+        pixels = np.clip(Fantome_CT(taille, z, nb_coupes, generateur) + 1024, 0, 4095).astype(np.uint16)
+        ds.PixelData = pixels.tobytes()
+        if transfer_syntax.is_compressed:
+            if not hasattr(ds, "compress"):
+                raise ValueError("Cette version de pydicom ne sait pas compresser en {}".format(transfer_syntax.name))
+            ds.compress(transfer_syntax)
+        _Sauvegarde_dataset(ds, chemin)
+        liste_fichiers.append(chemin)
+    return liste_fichiers
+
+
+def _Etape(nom, fonction, nb_coupes, resultats):
+    """
+    Chronomètre une étape ; fonction renvoie le nombre d'octets traités.
+    """
+    debut = time.perf_counter()
+    octets = fonction()
+    duree = max(time.perf_counter() - debut, 1e-9)
+    resultats[nom] = {"secondes"           : duree,
+                      "coupes_par_seconde" : nb_coupes / duree,
+                      "Mo_par_seconde"     : (octets or 0) / 1e6 / duree}
+    return resultats[nom]
+
+
+def Benchmark_ingestion(dossier_serie, dossier_sortie, nombre_decodeurs = Tutoriel.NOMBRE_DECODEURS):
+    """
+    Chronomètre chaque étape de l'import d'une série DICOM.
+
+    Parameters
+    ----------
+        - dossier_serie : string, dossier contenant la série (par exemple créée par Generer_serie_synthetique)
+        - dossier_sortie : string, dossier temporaire où écrire les png
+        - nombre_decodeurs : int, nombre de threads pour l'étape 'decodage_parallele'
+
+    Returns
+    -------
+        - etapes : dict, pour chaque étape : 'secondes', 'coupes_par_seconde', 'Mo_par_seconde'
+        - raison : string, la raison pour laquelle Tri_serie_DICOM écarte la série, None sinon
+
+    """
+    fichiers = sorted(os.path.join(dossier_serie, f) for f in os.listdir(dossier_serie))
+    n = len(fichiers)
+    etapes = {}
+    positions = {}
+    datasets = []
+    images = []
+    pngs = []
+
+    def entetes():
+        for f in fichiers:
+            positions[f] = pydicom.dcmread(f, specific_tags=["ImagePositionPatient", "SliceThickness"]).ImagePositionPatient[2]
+        return sum(os.path.getsize(f) for f in fichiers)
+    _Etape("entetes", entetes, n, etapes)
+
+    _Etape("tri", lambda : fichiers.sort(key=lambda f : positions[f], reverse=True), n, etapes)
+
+    def decodage():
+        for f in fichiers:
+            ds = pydicom.dcmread(f)
+            datasets.append((Tutoriel.Decodage_pixels(ds)[0], float(ds.RescaleSlope), float(ds.RescaleIntercept)))
+        return sum(pixels.nbytes for pixels, _, _ in datasets)
+    _Etape("decodage", decodage, n, etapes)
+
+    _Etape("decodage_parallele",
+           lambda : sum(pixels.nbytes for _, pixels in Tutoriel.Decodage_parallele(fichiers, nombre_decodeurs)), n, etapes)
+
+    def fenetrage():
+        for pixels, slope, intercept in datasets:
+            images.append(Tutoriel.ReglageContrasteDICOM_LUT(40, 400, pixels, slope, intercept))
+        return sum(pixels.nbytes for pixels, _, _ in datasets)
+    _Etape("fenetrage", fenetrage, n, etapes)
+
+    def fenetrage_float():
+        for pixels, slope, intercept in datasets:
+            Tutoriel.ReglageContrasteDICOM(40, 400, pixels * slope + intercept)
+        return sum(pixels.nbytes for pixels, _, _ in datasets)
+    _Etape("ReglageContrasteDICOM", fenetrage_float, n, etapes)
+
+    volume = np.stack([pixels * slope + intercept for pixels, slope, intercept in datasets]).astype(np.float32)
+    _Etape("Norm0_1", lambda : (Tutoriel.Norm0_1(volume), volume.nbytes)[1], n, etapes)
+    del volume
+
+    def encodage():
+        for image in images:
+            tampon = io.BytesIO()
+            Image.fromarray(image).save(tampon, format="PNG", compress_level=6)
+            pngs.append(tampon.getvalue())
+        return sum(len(png) for png in pngs)
+    _Etape("encodage", encodage, n, etapes)
+
+    def ecriture():
+        for j, png in enumerate(pngs):
+            with open(os.path.join(dossier_sortie, "coupe_{}.png".format(j)), "wb") as fichier:
+                fichier.write(png)
+        return sum(len(png) for png in pngs)
+    _Etape("ecriture", ecriture, n, etapes)
+    del datasets[:], images[:], pngs[:]
+
+    raison = Tutoriel.Tri_serie_DICOM(dossier_serie)[1]
+    if raison is None:
+        _Etape("Dossier_DICOM_vers_ImagesPNG",
+               lambda : Tutoriel.Dossier_DICOM_vers_ImagesPNG(dossier_serie, dossier_sortie).nbytes, n, etapes)
+    return etapes, raison
+
+
+def Comparaison(resultats, reference):
+    """
+    Affiche le rapport des débits entre deux résultats JSON : > 1 signifie plus rapide que la référence.
+    """
+    for etape, mesure in resultats["etapes"].items():
+        if etape in reference["etapes"]:
+            rapport = mesure["coupes_par_seconde"] / reference["etapes"][etape]["coupes_par_seconde"]
+            print("{:30s} x{:.2f}".format(etape, rapport))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--coupes", type=int, default=200)
+    parser.add_argument("--taille", type=int, default=512)
+    parser.add_argument("--syntaxe", choices=sorted(SYNTAXES), default="explicite")
+    parser.add_argument("--ordre", choices=["normal", "melange"], default="melange")
+    parser.add_argument("--plan", choices=["axial", "coronal", "sagittal"], default="axial")
+    parser.add_argument("--epaisseur", type=float, default=1.)
+    parser.add_argument("--decodeurs", type=int, default=Tutoriel.NOMBRE_DECODEURS)
+    parser.add_argument("--dossier", default=None, help="dossier de travail, temporaire par défaut")
+    parser.add_argument("--sortie", default=None, help="fichier JSON des résultats, affichés sinon")
+    parser.add_argument("--reference", default=None, help="fichier JSON d'une mesure précédente à comparer")
+    arguments = parser.parse_args()
+
+    dossier = arguments.dossier or tempfile.mkdtemp(prefix="benchmark_dicom_")
+    dossier_serie = os.path.join(dossier, "serie")
+    dossier_sortie = os.path.join(dossier, "png")
+    os.makedirs(dossier_sortie, exist_ok=True)
+    try:
+        debut = time.perf_counter()
+        Generer_serie_synthetique(dossier_serie, arguments.coupes, arguments.taille, arguments.syntaxe, arguments.ordre,
+                                  arguments.plan, arguments.epaisseur)
+        generation = time.perf_counter() - debut
+        with contextlib.redirect_stdout(sys.stderr): #la sortie standard reste réservée au JSON
+            etapes, raison = Benchmark_ingestion(dossier_serie, dossier_sortie, arguments.decodeurs)
+    finally:
+        if arguments.dossier is None:
+            shutil.rmtree(dossier, ignore_errors=True)
+
+    resultats = {"date"       : datetime.datetime.now().isoformat(),
+                 "machine"    : {"systeme" : platform.platform(), "processeur" : platform.processor(), "coeurs" : os.cpu_count(),
+                                 "python" : platform.python_version(), "numpy" : np.__version__, "pydicom" : pydicom.__version__},
+                 "parametres" : vars(arguments),
+                 "generation" : generation,
+                 "serie_ecartee" : raison,
+                 "etapes"     : etapes,
+                 "rss_max_Mo" : Tutoriel.Memoire_max_Mo()} #pic du processus entier : ru_maxrss ne se mesure pas par étape
+    texte = json.dumps(resultats, indent=2)
+    if arguments.sortie:
+        with open(arguments.sortie, "w") as fichier:
+            fichier.write(texte)
+    else:
+        print(texte)
+    if arguments.reference:
+        with open(arguments.reference) as fichier:
+            Comparaison(resultats, json.load(fichier))
+
+
+if __name__ == "__main__":
+    main()
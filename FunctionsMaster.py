@@ -11,14 +11,40 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 import matplotlib.pyplot as plt
 import numpy as np
 import pydicom
+try:
+    from pydicom import pixels as pydicom_pixels #pydicom >= 3
+except ImportError:
+    pydicom_pixels = None
 import os
 import pandas
-from PIL import Image
+from PIL import Image, ImageDraw
 import random
 import datetime
 import scipy
+import scipy.ndimage
 import openpyxl
 import time
+import platform
+import subprocess
+import sys
+import functools
+import hashlib
+import io
+import json
+import collections
+import contextlib
+import threading
+import queue
+import inspect
+import weakref
+import concurrent.futures
+import multiprocessing
+import sqlite3
+import h5py
+try:
+    import resource
+except ImportError: #Windows
+    resource = None
 
 import tensorflow as tf
 from tensorflow import keras
@@ -37,47 +63,41 @@ import tensorflow.keras.backend as K
 #___________________________________________________________________________________________
 
     
-def Dossier_DICOM_vers_ImagesPNG(DossierDICOM, #Entrer ici la localisation du dossier oú se situent les fichiers
-                                 Dossier_de_sauvegarde, #indiquer le chemin où seront sauvegardées les images
-                                 WINDOWCENTER = 40,
-                                 WINDOWWIDTH = 400
-                                ):
+def Tri_serie_DICOM(DossierDICOM, catalogue = None):
     """
-    Prend un dossier contenant des DICOM et les sauveagrdes en images .png
-    Obtient également un volume numpy correspondant au volume du scanner
+    Vérifie qu'un dossier contient une série DICOM exploitable puis trie ses fichiers dans l'ordre de la séquence de scanner.
+    Les séries de moins de 150 coupes, les coupes trop épaisses ainsi que les plans sagittaux et coronaux sont écartés.
     
     Parameters
     ----------
         - DossierDICOM : string, chemin vers le dossier contenant les fichiers DICOM
-        - Dossier_de_sauvegarde : string, chemin vers le dossier où l'on veut enregistrer les fichiers png
-        - WINDOWCENTER : int, optionnel, correspond au centre du fenetrage voulu qui sera pris par défaut si jamais le fichier dicom n'est pas lisible
-        - WINDOWWIDTH : int, optionnel, correspond à la largeur du fenetrage voulu qui sera pris par défaut si jamais le fichier dicom n'est pas lisible
+        - catalogue : string, optionnel, chemin vers un catalogue créé par Catalogue_DICOM. Les en-têtes sont alors lus dans
+        le catalogue au lieu d'ouvrir chaque fichier.
         
     Returns
     -------
-        - volume_numpy : numpy, volume de l'ensemble de sfichiers DICOM, dont la taille est de [nb_dIamges,512,512].
+        - liste_fichiers : liste des chemins des fichiers triés selon l'axe z, None si la série a été écartée
+        - raison : string, la raison pour laquelle la série a été écartée, None sinon
     
     """
-    list_files = os.listdir(DossierDICOM)
+    if catalogue is not None:
+        return _Tri_depuis_catalogue(DossierDICOM, catalogue)
+
+    list_files = sorted(f for f in os.listdir(DossierDICOM) if not os.path.isdir(os.path.join(DossierDICOM, f)))
     if len(list_files) <150:
-        print("   Moins de 150 coupes, le dossier n'a pas été importé")
-        return
+        return None, "Moins de 150 coupes, le dossier n'a pas été importé"
 
     #Nous ne récupérons pas les images dont l'épaisseur est trop épaisse :  
-    echantillon1 = os.path.join(rootdir, list_files[1])
-    echantillon2 = os.path.join(rootdir, list_files[100])
-    if not os.path.isdir(echantillon1):
-        _ds_1 = pydicom.dcmread(echantillon1,force =True, specific_tags =["ImagePositionPatient","SliceThickness","WindowCenter","BodyPartExamined", "FilterType", "SeriesDescription"])
-        if (0x18, 0x50) in _ds_1:
-            thickness = _ds_1["SliceThickness"].value
-            if thickness >2.5: #Limitation si coupe trop épaisses : MIP...etc
-                print("   Thickness is too high.")
-                return
+    echantillon1 = os.path.join(DossierDICOM, list_files[1])
+    echantillon2 = os.path.join(DossierDICOM, list_files[100])
+    _ds_1 = pydicom.dcmread(echantillon1,force =True, specific_tags =["ImagePositionPatient","SliceThickness","WindowCenter","BodyPartExamined", "FilterType", "SeriesDescription"])
+    if (0x18, 0x50) in _ds_1:
+        thickness = _ds_1["SliceThickness"].value
+        if thickness >2.5: #Limitation si coupe trop épaisses : MIP...etc
+            return None, "Thickness is too high."
 
-    
     #Nous ne récupérons pas les images sagittales ni coronales :        
-    if not os.path.isdir(echantillon2):
-        _ds_2 = pydicom.dcmread(echantillon2,force =True,specific_tags =["ImagePositionPatient","SliceThickness"])
+    _ds_2 = pydicom.dcmread(echantillon2,force =True,specific_tags =["ImagePositionPatient","SliceThickness"])
     position1 = [5.,10.,15.] 
     position2 = [5.,10.,15.] 
     if (0x20, 0x32) in _ds_1:
@@ -86,63 +106,771 @@ def Dossier_DICOM_vers_ImagesPNG(DossierDICOM, #Entrer ici la localisation du do
         position2 = _ds_2["ImagePositionPatient"].value
 
     if position1[0] != position2[0]:
-        print("   Sagittal plane.")
-        return 
+        return None, "Sagittal plane."
     
     if position1[1] != position2[1]:
-        print("   Coronal plane.")
-        return
+        return None, "Coronal plane."
         
-    #Maintenant que l'on a arrêté la fonction précocement selon certains criteres, regardons la liste des images
+    #Maintenant que l'on a écarté les séries selon certains criteres, regardons la liste des images
 
     #il faut les trier les fichiers dans l'ordre de la sequence de scanner 
     #(ce qui ne correspond pas à l'ordre alphabetique du nom des fichiers)
     inter = {}
     for f in list_files:
-        if not os.path.isdir(f):
-            f_long = os.path.join(rootdir, f)
-            _ds_   = pydicom.dcmread(f_long,specific_tags =["ImagePositionPatient","SliceThickness"])
-            inter[f_long]=_ds_.ImagePositionPatient[2]
+        f_long = os.path.join(DossierDICOM, f)
+        _ds_   = pydicom.dcmread(f_long,specific_tags =["ImagePositionPatient","SliceThickness"])
+        inter[f_long]=_ds_.ImagePositionPatient[2]
     inter_sorted=sorted(inter.items(), key=lambda x: x[1], reverse=True) 
     liste_fichiers=[x[0] for x in inter_sorted]
+    return liste_fichiers, None
+
+
+def _Chemin_catalogue(chemin):
+    """
+    Forme absolue et normalisée d'un chemin, sous laquelle les dossiers et les fichiers sont enregistrés et cherchés dans le catalogue.
+    """
+    return os.path.abspath(os.path.normpath(chemin))
+
+
+def _Tri_depuis_catalogue(DossierDICOM, catalogue):
+    """
+    Equivalent de Tri_serie_DICOM à partir du catalogue des en-têtes : une seule requête au lieu d'ouvrir chaque fichier.
+    """
+    connexion = _Ouvrir_catalogue(catalogue)
+    lignes = connexion.execute("""SELECT chemin, epaisseur, plan FROM entetes WHERE dossier = ? AND valide = 1
+                                  ORDER BY position_z DESC""", (_Chemin_catalogue(DossierDICOM),)).fetchall()
+    connexion.close()
+    if len(lignes) <150:
+        return None, "Moins de 150 coupes, le dossier n'a pas été importé"
+    if max(ligne[1] or 0. for ligne in lignes) >2.5:
+        return None, "Thickness is too high."
+    plans = set(ligne[2] for ligne in lignes)
+    if "sagittal" in plans:
+        return None, "Sagittal plane."
+    if "coronal" in plans:
+        return None, "Coronal plane."
+    return [ligne[0] for ligne in lignes], None
+
+
+def Allocation_volume(forme, dtype = np.float16, Fichier_volume = None):
+    """
+    Prépare le volume dans lequel seront écrites les coupes une à une.
+    
+    Parameters
+    ----------
+        - forme : tuple, (nb_de_coupes, lignes, colonnes)
+        - dtype : type numpy du volume, np.float16 par défaut comme le volume renvoyé par Dossier_DICOM_vers_ImagesPNG
+        - Fichier_volume : string, optionnel, chemin d'un fichier .npy. Si indiqué, le volume est un memmap écrit directement sur
+        le disque : la mémoire utilisée ne dépend plus du nombre de coupes.
+        
+    Returns
+    -------
+        - volume : numpy ou memmap numpy, rempli de zéros
+    
+    """
+    if Fichier_volume is None:
+        return np.zeros(forme, dtype=dtype)
+    return np.lib.format.open_memmap(Fichier_volume, mode="w+", dtype=dtype, shape=tuple(forme))
+
+
+def Ouvrir_volume(Fichier_volume, mode = "r"):
+    """
+    Rouvre un volume sauvegardé en .npy sans le charger en mémoire : seules les coupes utilisées sont lues sur le disque.
+    Le résultat s'utilise comme un volume numpy classique (affichage3D, AffichageMulti, entrainement...).
+    
+    Parameters
+    ----------
+        - Fichier_volume : string, chemin du fichier .npy
+        - mode : string, 'r' en lecture seule, 'r+' pour pouvoir modifier le volume
+        
+    Returns
+    -------
+        - volume : memmap numpy
+    
+    """
+    return np.load(Fichier_volume, mmap_mode=mode)
+
+
+def _Creation_HDF5(Fichier_HDF5, forme, DossierDICOM, dicom_file, compression = "gzip"):
+    """
+    Crée le fichier HDF5 d'une série : les pixels bruts en int16, découpés coupe par coupe et compressés.
+    """
+    fichier = h5py.File(Fichier_HDF5, "w")
+    fichier.create_dataset("pixels", shape=forme, dtype=np.int16, chunks=(1,) + tuple(forme[1:]),
+                           compression=compression, shuffle=True)
+    fichier.attrs["DossierDICOM"] = DossierDICOM
+    fichier.attrs["SeriesInstanceUID"] = str(dicom_file.get("SeriesInstanceUID", ""))
+    if "PixelSpacing" in dicom_file:
+        fichier.attrs["PixelSpacing"] = [float(x) for x in dicom_file.PixelSpacing]
+    if "SliceThickness" in dicom_file:
+        fichier.attrs["SliceThickness"] = float(dicom_file.SliceThickness)
+    return fichier
+
+
+#Décodeurs de pydicom écrits en code compilé, essayés dans cet ordre pour les fichiers compressés (JPEG, JPEG 2000, JPEG-LS, RLE).
+#Ils travaillent en grande partie hors du GIL de python et peuvent donc décoder plusieurs coupes en même temps dans des threads.
+#Modules de pydicom.pixel_data_handlers jusqu'à pydicom 2, plugins de pydicom.pixels à partir de pydicom 3.
+DECODEURS_PARALLELES = ["pillow_handler", "pylibjpeg_handler", "gdcm_handler", "jpeg_ls_handler"]
+PLUGINS_PARALLELES = ["pillow", "pylibjpeg", "gdcm", "pyjpegls"]
+
+#Nombre de threads de décodage par défaut : la lecture du fichier suivant se fait pendant le décodage de la coupe en cours,
+#au-delà le gain est faible car une partie du décodage garde le GIL, et Import_DICOM_parallele lance déjà un processus par coeur.
+NOMBRE_DECODEURS = 2
+
+
+def _Decodeurs_disponibles(transfer_syntax):
+    """
+    Liste des décodeurs de DECODEURS_PARALLELES (ou PLUGINS_PARALLELES avec pydicom >= 3) installés et capables de lire
+    cette syntaxe de transfert, sous forme de tuples (nom, fonction qui renvoie les pixels d'un dataset).
+    """
+    if pydicom_pixels is not None:
+        try:
+            decodeur = pydicom_pixels.get_decoder(transfer_syntax)
+        except NotImplementedError: #syntaxe sans décodeur dans pydicom
+            return []
+        return [(plugin, functools.partial(lambda dicom_file, plugin : decodeur.as_array(dicom_file, decoding_plugin=plugin)[0],
+                                           plugin=plugin))
+                for plugin in PLUGINS_PARALLELES if plugin in decodeur.available_plugins]
+    decodeurs = []
+    for module in pydicom.config.pixel_data_handlers:
+        nom = module.__name__.split(".")[-1]
+        if nom in DECODEURS_PARALLELES and module.is_available() and module.supports_transfer_syntax(transfer_syntax):
+            decodeurs.append((nom, functools.partial(lambda dicom_file, module : pydicom.pixel_data_handlers.util.reshape_pixel_array(
+                                                         dicom_file, module.get_pixeldata(dicom_file)), module=module)))
+    return sorted(decodeurs, key=lambda decodeur : DECODEURS_PARALLELES.index(decodeur[0]))
+
+
+def Decodage_pixels(dicom_file):
+    """
+    Equivalent de dicom_file.pixel_array qui, pour les fichiers compressés, essaie d'abord les DECODEURS_PARALLELES,
+    puis se replie sur les décodeurs par défaut de pydicom si aucun ne convient.
+    
+    Parameters
+    ----------
+        - dicom_file : dataset pydicom, lu avec pydicom.dcmread
+        
+    Returns
+    -------
+        - pixels : numpy, l'image brute (avant slope et intercept)
+        - decodeur : string, nom du décodeur utilisé ('pydicom' pour les décodeurs par défaut)
+    
+    """
+    transfer_syntax = dicom_file.file_meta.TransferSyntaxUID
+    if transfer_syntax.is_compressed:
+        for nom, decodage in _Decodeurs_disponibles(transfer_syntax):
+            try:
+                return decodage(dicom_file), nom
+            except Exception:
+                continue
+    return dicom_file.pixel_array, "pydicom"
+
+
+def Decodage_parallele(liste_fichiers, nombre_de_threads = NOMBRE_DECODEURS, taille_lot = 16, rapport = None):
+    """
+    Lit et décode les fichiers DICOM par lots dans un pool de threads, en gardant l'ordre de liste_fichiers.
+    Utile surtout pour les séries compressées (JPEG lossless, JPEG 2000, RLE) où le décodage de pixel_array domine le temps d'import.
+    
+    Parameters
+    ----------
+        - liste_fichiers : liste des chemins des fichiers, par exemple triés par Tri_serie_DICOM
+        - nombre_de_threads : int, nombre de coupes décodées en même temps, par défaut NOMBRE_DECODEURS
+        - taille_lot : int, nombre maximal de coupes décodées en avance, limite la mémoire utilisée
+        - rapport : dict, optionnel, complété au fur et à mesure par syntaxe de transfert, cf Rapport_decodage
+        
+    Returns
+    -------
+        - generator renvoyant pour chaque fichier le tuple (dicom_file, pixels)
+    
+    """
+    verrou = threading.Lock()
+    def lecture(chemin):
+        debut = time.perf_counter()
+        dicom_file = pydicom.dcmread(chemin)
+        pixels, decodeur = Decodage_pixels(dicom_file)
+        duree = time.perf_counter() - debut
+        if rapport is not None:
+            with verrou:
+                ligne = rapport.setdefault(dicom_file.file_meta.TransferSyntaxUID.name,
+                                           {"decodeurs" : [], "nb_coupes" : 0, "octets" : 0, "secondes" : 0.})
+                if decodeur not in ligne["decodeurs"]:
+                    ligne["decodeurs"].append(decodeur)
+                ligne["nb_coupes"] += 1
+                ligne["octets"] += pixels.nbytes
+                ligne["secondes"] += duree
+        return dicom_file, pixels
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nombre_de_threads) as executor:
+        en_cours = collections.deque()
+        for chemin in liste_fichiers:
+            en_cours.append(executor.submit(lecture, chemin))
+            if len(en_cours) >= taille_lot:
+                yield en_cours.popleft().result()
+        while en_cours:
+            yield en_cours.popleft().result()
+
+
+def Rapport_decodage(rapport):
+    """
+    Affiche, pour chaque syntaxe de transfert rencontrée, le décodeur utilisé et son débit.
+    Les débits sont ceux d'un thread : le débit total est multiplié par le nombre de threads tant que le décodeur libère le GIL.
+    
+    Parameters
+    ----------
+        - rapport : dict, rempli par Decodage_parallele (ou renvoyé dans les statistiques de _Conversion_serie)
+    
+    """
+    for syntaxe, ligne in rapport.items():
+        secondes = max(ligne["secondes"], 1e-9)
+        print("{} : {} ; {} coupes, {:.1f} coupes/s, {:.1f} Mo/s par thread".format(
+            syntaxe, ", ".join(ligne["decodeurs"]), ligne["nb_coupes"], ligne["nb_coupes"] / secondes, ligne["octets"] / 1e6 / secondes))
+
+
+#Niveaux de compression zlib des png : 0 = aucune compression (écriture la plus rapide, fichiers les plus lourds), 9 = maximale
+NIVEAUX_COMPRESSION_PNG = {"aucune" : 0, "rapide" : 1, "defaut" : 6, "maximale" : 9}
+
+
+class EcrivainPNG:
+    """
+    Sauvegarde les images png dans des threads en arrière-plan, pendant que la coupe suivante est décodée.
+    Le nombre d'images en attente d'écriture est limité pour que la mémoire utilisée reste constante.
+    
+    Parameters
+    ----------
+        - nombre_de_threads : int, nombre d'images encodées en même temps (l'encodage zlib libère le GIL)
+        - compression : int entre 0 et 9, ou nom parmi NIVEAUX_COMPRESSION_PNG ('aucune', 'rapide', 'defaut', 'maximale')
+        - en_attente_max : int, nombre maximal d'images en attente d'écriture
+    
+    """
+    def __init__(self, nombre_de_threads = 2, compression = 6, en_attente_max = 16):
+        self.compression = NIVEAUX_COMPRESSION_PNG.get(compression, compression)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=nombre_de_threads)
+        self._places = threading.BoundedSemaphore(en_attente_max)
+        self._verrou = threading.Lock()
+        self._erreur = None
+        self.nb_images = 0
+        self.nb_octets = 0
+        self.sommes_controle = {}
+
+    def _sauvegarde(self, image, chemin):
+        tampon = io.BytesIO()
+        Image.fromarray(image).save(tampon, format="PNG", compress_level=self.compression)
+        contenu = tampon.getvalue()
+        with open(chemin, "wb") as fichier:
+            fichier.write(contenu)
+        return chemin, len(contenu), hashlib.sha1(contenu).hexdigest()
+
+    def _fin_de_tache(self, tache):
+        self._places.release()
+        with self._verrou:
+            if tache.exception() is not None:
+                self._erreur = self._erreur or tache.exception()
+            else:
+                chemin, taille, somme = tache.result()
+                self.nb_images += 1
+                self.nb_octets += taille
+                self.sommes_controle[chemin] = somme
+
+    def ecrire(self, image, chemin):
+        """
+        Ajoute une image à la file d'écriture, attend si trop d'images sont déjà en attente.
+        L'image doit être en uint8 (cf ReglageContrasteDICOM_LUT) et ne doit plus être modifiée ensuite.
+        """
+        if image.dtype != np.uint8:
+            raise TypeError("EcrivainPNG n'écrit que des images uint8, reçu {}".format(image.dtype))
+        self._places.acquire()
+        self._executor.submit(self._sauvegarde, image, chemin).add_done_callback(self._fin_de_tache)
+
+    def fermer(self):
+        """
+        Attend la fin de toutes les écritures, puis signale la première erreur rencontrée s'il y en a eu une.
+        
+        Returns
+        -------
+            - nb_images : int, nombre d'images écrites
+            - nb_octets : int, taille totale des fichiers écrits
+        
+        """
+        self._executor.shutdown(wait=True)
+        if self._erreur is not None:
+            raise self._erreur
+        return self.nb_images, self.nb_octets
+
+
+def _Conversion_serie(liste_fichiers, DossierDICOM, Dossier_de_sauvegarde, WINDOWCENTER, WINDOWWIDTH, Fichier_volume = None,
+                      Fichier_HDF5 = None, compression_png = 6, nombre_ecrivains = 2, nombre_decodeurs = NOMBRE_DECODEURS):
+    """
+    Importe les fichiers DICOM déjà triés, règle leur contraste puis les sauvegarde en images .png
+    Chaque coupe n'est décodée qu'une fois, quelles que soient les sorties demandées (png, volume .npy, fichier HDF5).
+    Les coupes sont décodées par lots dans des threads (cf Decodage_parallele) et les png sont écrits en arrière-plan par un EcrivainPNG.
+    A utiliser via Dossier_DICOM_vers_ImagesPNG, Dossier_DICOM_vers_HDF5 ou Import_DICOM_parallele
+    
+    Returns
+    -------
+        - volume_numpy : numpy (ou memmap si Fichier_volume est indiqué), volume de l'ensemble des fichiers DICOM.
+        None si seul un fichier HDF5 est demandé : le contraste n'est alors pas réglé.
+        - statistiques : dict, 'nb_coupes', 'duree' (s), 'coupes_par_seconde', 'png_Mo', 'png_Mo_par_seconde', ainsi que 'png'
+        (liste des fichiers png dans l'ordre des coupes), 'somme_controle_png' (sha1 des sommes de chaque png) et 'decodage'
+        (débit par syntaxe de transfert, cf Rapport_decodage)
+    
+    """
+    fenetrage = Dossier_de_sauvegarde is not None or Fichier_volume is not None or Fichier_HDF5 is None
+
+    #Pour chaque fichier nous allons : l'importer, régler son contraste, puis le sauvegarder avec un nom différent
+    j=0
+    identifiant = Identifiant_serie(DossierDICOM)
+    volume_numpy = None
+    fichier_hdf5 = None
+    fichiers_png = []
+    slopes, intercepts, positions = [], [], []
+    ecrivain = None
+    if Dossier_de_sauvegarde is not None:
+        ecrivain = EcrivainPNG(nombre_ecrivains, compression_png)
+    nb_octets_png = 0
+    somme_png = None
+    rapport_decodage = {}
+    debut = time.time()
+    try:
+        for k, (dicom_file, img_orig_dcm) in enumerate(Decodage_parallele(liste_fichiers, nombre_decodeurs, rapport=rapport_decodage)):
+
+            forme = (len(liste_fichiers), int(dicom_file.Rows), int(dicom_file.Columns))
+            if k == 0 and fenetrage:
+                #La taille des coupes est lue dans l'en-tête du premier fichier
+                volume_numpy = Allocation_volume(forme, np.float16, Fichier_volume)
+
+            slope=float(dicom_file[0x28,0x1053].value)
+            intercept=float(dicom_file[0x28,0x1052].value)
+
+            if Fichier_HDF5 is not None:
+                if k == 0:
+                    fichier_hdf5 = _Creation_HDF5(Fichier_HDF5, forme, DossierDICOM, dicom_file)
+                if img_orig_dcm.dtype != np.int16 and (img_orig_dcm.max() > 32767 or img_orig_dcm.min() < -32768):
+                    raise ValueError("Les pixels de {} ne tiennent pas sur 16 bits signés".format(liste_fichiers[k]))
+                fichier_hdf5["pixels"][k] = img_orig_dcm
+                slopes.append(slope)
+                intercepts.append(intercept)
+                positions.append(float(dicom_file.ImagePositionPatient[2]))
+                if not fenetrage:
+                    continue
+
+            #Réglage du contraste
+            WindowCenter = WINDOWCENTER
+            WindowWidth = WINDOWWIDTH
+            if (0x28, 0x1050) in dicom_file:
+                WindowCenter = dicom_file["WindowCenter"].value
+                if not isinstance(WindowCenter, float) : WindowCenter = WINDOWCENTER
+            if (0x28, 0x1051) in dicom_file:
+                WindowWidth = dicom_file["WindowWidth"].value
+                if not isinstance(WindowWidth, float) : WindowWidth = WINDOWWIDTH
+            arraytopng = ReglageContrasteDICOM_LUT(WindowCenter,WindowWidth,img_orig_dcm,slope,intercept) #réglages de contraste, en uint8
+            volume_numpy[k,:,:]=arraytopng #ecrit une ligne correspondant à l'image
+
+            #Sauvegarde du fichier, en arrière-plan
+            if ecrivain is not None:
+                SAVING = os.path.basename(DossierDICOM)+r"_{}_{}.png".format(identifiant, j) 
+                fichiers_png.append(os.path.join(Dossier_de_sauvegarde, SAVING))
+                ecrivain.ecrire(arraytopng, fichiers_png[-1])
+            j+=1
+            if Fichier_volume is not None and k % 64 == 63:
+                volume_numpy.flush() #écrit régulièrement sur disque les pages déjà remplies
+
+        if fichier_hdf5 is not None:
+            fichier_hdf5["slope"] = np.asarray(slopes)
+            fichier_hdf5["intercept"] = np.asarray(intercepts)
+            fichier_hdf5["position_z"] = np.asarray(positions)
+            if len(positions) > 1:
+                fichier_hdf5.attrs["EspacementZ"] = float(np.median(np.abs(np.diff(positions))))
+    except BaseException:
+        if ecrivain is not None:
+            with contextlib.suppress(Exception): #une erreur d'écriture des png ne doit pas masquer l'erreur en cours
+                ecrivain.fermer()
+        raise
+    finally:
+        if fichier_hdf5 is not None:
+            fichier_hdf5.close()
+    if ecrivain is not None:
+        nb_octets_png = ecrivain.fermer()[1]
+
+    if ecrivain is not None:
+        somme_png = hashlib.sha1("".join(ecrivain.sommes_controle[chemin] for chemin in fichiers_png).encode())
+    if Fichier_volume is not None:
+        volume_numpy.flush()
+    duree = max(time.time() - debut, 1e-9)
+    statistiques = {"nb_coupes"          : len(liste_fichiers),
+                    "duree"              : duree,
+                    "coupes_par_seconde" : len(liste_fichiers) / duree,
+                    "png_Mo"             : nb_octets_png / 1e6,
+                    "png_Mo_par_seconde" : nb_octets_png / 1e6 / duree,
+                    "png"                : fichiers_png,
+                    "somme_controle_png" : None if somme_png is None else somme_png.hexdigest(),
+                    "decodage"           : rapport_decodage}
+    return volume_numpy, statistiques
+
+
+def Dossier_DICOM_vers_ImagesPNG(DossierDICOM, #Entrer ici la localisation du dossier oú se situent les fichiers
+                                 Dossier_de_sauvegarde, #indiquer le chemin où seront sauvegardées les images
+                                 WINDOWCENTER = 40,
+                                 WINDOWWIDTH = 400,
+                                 catalogue = None,
+                                 Fichier_volume = None,
+                                 compression_png = 6,
+                                 nombre_ecrivains = 2,
+                                 nombre_decodeurs = NOMBRE_DECODEURS
+                                ):
+    """
+    Prend un dossier contenant des DICOM et les sauveagrdes en images .png
+    Obtient également un volume numpy correspondant au volume du scanner
+    
+    Parameters
+    ----------
+        - DossierDICOM : string, chemin vers le dossier contenant les fichiers DICOM
+        - Dossier_de_sauvegarde : string, chemin vers le dossier où l'on veut enregistrer les fichiers png, None pour n'obtenir que le volume
+        - WINDOWCENTER : int, optionnel, correspond au centre du fenetrage voulu qui sera pris par défaut si jamais le fichier dicom n'est pas lisible
+        - WINDOWWIDTH : int, optionnel, correspond à la largeur du fenetrage voulu qui sera pris par défaut si jamais le fichier dicom n'est pas lisible
+        - catalogue : string, optionnel, chemin vers un catalogue créé par Catalogue_DICOM pour éviter de relire les en-têtes
+        - Fichier_volume : string, optionnel, chemin d'un fichier .npy où écrire le volume coupe par coupe (memmap) au lieu de le garder
+        en mémoire. A rouvrir avec Ouvrir_volume.
+        - compression_png : int entre 0 et 9 ou 'aucune', 'rapide', 'defaut', 'maximale' : compression des png, cf EcrivainPNG
+        - nombre_ecrivains : int, nombre de threads qui écrivent les png pendant le décodage des coupes suivantes
+        - nombre_decodeurs : int, nombre de threads qui décodent les coupes, par défaut NOMBRE_DECODEURS : la lecture
+        du fichier suivant recouvre le décodage de la coupe en cours, au-delà le gain est faible (cf Decodage_parallele)
+        
+    Returns
+    -------
+        - volume_numpy : numpy float16, volume de l'ensemble de sfichiers DICOM, dont la taille est de [nb_dIamges,lignes,colonnes].
+    
+    """
+    liste_fichiers, raison = Tri_serie_DICOM(DossierDICOM, catalogue)
+    if liste_fichiers is None:
+        print("   " + raison)
+        return
 
     #Nous avons maintenant la liste des fichiers selon leur ordre selon l'axe z du scanner
     nbcoupes = len(liste_fichiers)
     print(nbcoupes, " fichiers trouvés pour ce scanner")
 
-    #Pour chaque fichier nous allons : l'importer, régler son contraste, puis le sauvegarder avec un nom différent
-    j=0
-    randomnumber = random.randint(0, 1000)
-    volume_numpy=np.zeros((len(liste_fichiers),512,512))
-    for k in range (0,len(liste_fichiers)):
-
-        dicom_file = pydicom.read_file(liste_fichiers[k])
-        img_orig_dcm = (dicom_file.pixel_array)
-
-        slope=float(dicom_file[0x28,0x1053].value)
-        intercept=float(dicom_file[0x28,0x1052].value)
-        img_modif_dcm=(img_orig_dcm*slope) + intercept
-
-        #Réglage du contraste
-        if (0x28, 0x1050) in dicom_file:
-            WindowCenter = dicom_file["WindowCenter"].value
-            if not isinstance(WindowCenter, float) : WindowCenter = WINDOWCENTER
-        if (0x28, 0x1051) in dicom_file:
-            WindowWidth = dicom_file["WindowWidth"].value
-            if not isinstance(WindowWidth, float) : WindowWidth = WINDOWWIDTH
-        arraytopng = ReglageContrasteDICOM (WindowCenter,WindowWidth,img_modif_dcm) #réglages de contraste
-        volume_numpy[k,:,:]=arraytopng #ecrit une ligne correspondant à l'image
-
-        #Sauvegarde du fichier
-        im = Image.fromarray(arraytopng)
-        SAVING = os.path.basename(rootdir)+r"_{}_{}.png".format(randomnumber, j) 
-        im.save(os.path.join(Dossier_de_sauvegarde, SAVING))    
-        j+=1
-    
-    volume_numpy     = np.asarray(volume_numpy, dtype=np.float16)
+    volume_numpy, statistiques = _Conversion_serie(liste_fichiers, DossierDICOM, Dossier_de_sauvegarde, WINDOWCENTER, WINDOWWIDTH,
+                                                   Fichier_volume, None, compression_png, nombre_ecrivains, nombre_decodeurs)
+    print("   {:.1f} coupes/s, {:.1f} Mo/s de png écrits".format(statistiques["coupes_par_seconde"], statistiques["png_Mo_par_seconde"]))
+    Rapport_decodage(statistiques["decodage"])
     return volume_numpy
 
 
+def Dossier_DICOM_vers_HDF5(DossierDICOM,
+                            Fichier_HDF5,
+                            catalogue = None
+                           ):
+    """
+    Sauvegarde une série DICOM sans perte dans un fichier HDF5 compact : les pixels bruts sont gardés en int16 avec, pour chaque coupe, 
+    la pente (slope) et l'ordonnée (intercept) permettant de retrouver les UH, ainsi que l'espacement des voxels.
+    Contrairement aux images png, aucun fenêtrage n'est appliqué : le contraste est réglé à la lecture avec Charger_volume_HU,
+    il n'est donc plus nécessaire de relire les DICOM pour changer de fenêtre.
+    
+    Parameters
+    ----------
+        - DossierDICOM : string, chemin vers le dossier contenant les fichiers DICOM
+        - Fichier_HDF5 : string, chemin du fichier .h5 à créer
+        - catalogue : string, optionnel, chemin vers un catalogue créé par Catalogue_DICOM pour éviter de relire les en-têtes
+        
+    Returns
+    -------
+        - nbcoupes : int, nombre de coupes sauvegardées, None si la série a été écartée
+    
+    """
+    liste_fichiers, raison = Tri_serie_DICOM(DossierDICOM, catalogue)
+    if liste_fichiers is None:
+        print("   " + raison)
+        return
+
+    _Conversion_serie(liste_fichiers, DossierDICOM, None, 40, 400, Fichier_HDF5 = Fichier_HDF5)
+    return len(liste_fichiers)
+
+
+def Charger_volume_HU(Fichier_HDF5, coupes = None, Global_Level = None, Global_Window = None):
+    """
+    Lit un fichier créé par Dossier_DICOM_vers_HDF5 et renvoie le volume en UH, avec un réglage de contraste optionnel.
+    Seules les coupes demandées sont lues et décompressées.
+    
+    Parameters
+    ----------
+        - Fichier_HDF5 : string, chemin du fichier .h5
+        - coupes : optionnel, int, slice ou liste croissante d'indices des coupes à lire, par défaut tout le volume
+        - Global_Level : optionnel, centre de la fenetre (en UH)
+        - Global_Window : optionnel, largeur de la fenetre (en UH). Si les deux sont indiqués, le résultat est celui de ReglageContrasteDICOM
+        
+    Returns
+    -------
+        - volume : numpy float32, le volume (ou la coupe) en UH, ou après réglage du contraste (valeurs entre 0 et 255)
+    
+    """
+    if coupes is None:
+        coupes = slice(None)
+    with h5py.File(Fichier_HDF5, "r") as fichier:
+        pixels = fichier["pixels"][coupes]
+        slope = np.asarray(fichier["slope"][coupes], dtype=np.float32)
+        intercept = np.asarray(fichier["intercept"][coupes], dtype=np.float32)
+    if pixels.ndim == 3:
+        slope, intercept = slope[:, None, None], intercept[:, None, None]
+    volume = pixels * slope + intercept
+    if Global_Level is not None and Global_Window is not None:
+        volume = ReglageContrasteDICOM(Global_Level, Global_Window, volume)
+    return volume
+
+
+def Metadonnees_HDF5(Fichier_HDF5):
+    """
+    Renvoie les informations d'un fichier créé par Dossier_DICOM_vers_HDF5 sans lire les pixels.
+    
+    Returns
+    -------
+        - metadonnees : dict, contient 'forme', 'PixelSpacing', 'SliceThickness', 'EspacementZ', 'SeriesInstanceUID', 'DossierDICOM'
+    
+    """
+    with h5py.File(Fichier_HDF5, "r") as fichier:
+        metadonnees = dict(fichier.attrs)
+        metadonnees["forme"] = fichier["pixels"].shape
+    return metadonnees
+
+
+def Identifiant_serie(DossierDICOM):
+    """
+    Identifiant court et stable d'une série, tiré du chemin de son dossier. Il est utilisé dans le nom des fichiers créés :
+    convertir à nouveau une série remplace ses fichiers au lieu de créer des doublons.
+    """
+    return hashlib.sha1(os.path.abspath(DossierDICOM).encode("utf-8")).hexdigest()[:8]
+
+
+def _Empreinte_dossier(DossierDICOM):
+    """
+    Empreinte du contenu d'un dossier à partir du nom, de la taille et de la date de modification de ses fichiers, sans les lire.
+    """
+    contenu = sorted((entree.name, entree.stat().st_size, entree.stat().st_mtime_ns)
+                     for entree in os.scandir(DossierDICOM) if entree.is_file())
+    return hashlib.sha1(json.dumps(contenu).encode("utf-8")).hexdigest()
+
+
+def _Somme_controle_fichier(chemin, taille_bloc = 1 << 20):
+    """
+    sha1 du contenu d'un fichier, lu par blocs.
+    """
+    somme = hashlib.sha1()
+    with open(chemin, "rb") as fichier:
+        for bloc in iter(lambda : fichier.read(taille_bloc), b""):
+            somme.update(bloc)
+    return somme.hexdigest()
+
+
+def _Ouvrir_manifeste(chemin_manifeste):
+    """
+    Ouvre (et crée si besoin) la base SQLite du manifeste des conversions.
+    """
+    connexion = sqlite3.connect(chemin_manifeste, timeout=60)
+    connexion.execute("""CREATE TABLE IF NOT EXISTS manifeste (
+                             dossier TEXT PRIMARY KEY, empreinte TEXT, parametres TEXT, statut TEXT, message TEXT,
+                             serie_uid TEXT, nb_coupes INTEGER, sorties TEXT, somme_controle TEXT, date TEXT)""")
+    return connexion
+
+
+def _Sorties_presentes(sorties):
+    """
+    Vérifie que les fichiers créés lors d'une conversion précédente existent toujours.
+    """
+    chemins = [sorties[cle] for cle in ("volume", "hdf5") if sorties.get(cle)]
+    if sorties.get("png_nombre"):
+        chemins += [sorties["png_motif"].format(0), sorties["png_motif"].format(sorties["png_nombre"] - 1)]
+    return all(os.path.exists(chemin) for chemin in chemins)
+
+
+def _Suppression_sorties(sorties):
+    """
+    Supprime les fichiers créés lors d'une conversion précédente, avant de convertir à nouveau une série modifiée.
+    """
+    chemins = [sorties[cle] for cle in ("volume", "hdf5") if sorties.get(cle)]
+    if sorties.get("png_nombre"):
+        chemins += [sorties["png_motif"].format(j) for j in range(sorties["png_nombre"])]
+    for chemin in chemins:
+        if os.path.exists(chemin):
+            os.remove(chemin)
+
+
+def Lecture_manifeste(chemin_manifeste):
+    """
+    Renvoie le contenu du manifeste tenu par Import_DICOM_parallele : une ligne par dossier traité.
+    
+    Parameters
+    ----------
+        - chemin_manifeste : string, chemin du fichier SQLite du manifeste
+        
+    Returns
+    -------
+        - df : dataframe pandas, avec les colonnes 'dossier', 'statut', 'message', 'serie_uid', 'nb_coupes', 'png_motif', 'png_nombre',
+        'volume', 'hdf5', 'somme_controle', 'empreinte', 'parametres' et 'date'
+    
+    """
+    connexion = _Ouvrir_manifeste(chemin_manifeste)
+    df = pandas.read_sql_query("SELECT * FROM manifeste", connexion)
+    connexion.close()
+    sorties = pandas.DataFrame([json.loads(x) for x in df.pop("sorties")], index=df.index,
+                               columns=["png_motif", "png_nombre", "volume", "hdf5"])
+    return pandas.concat([df, sorties], axis=1)
+
+
+def _Import_serie(DossierDICOM, Dossier_de_sauvegarde, catalogue, Dossier_volumes, Dossier_HDF5, parametres_conversion):
+    """
+    Tâche exécutée par chaque processus de Import_DICOM_parallele : convertit une série et renvoie un compte-rendu
+    plutôt que le volume, pour ne pas faire transiter celui-ci entre les processus.
+    parametres_conversion contient les réglages transmis à _Conversion_serie (fenêtre par défaut, compression des png...).
+    
+    Returns
+    -------
+        - resultat : dict, contient les clés 'dossier', 'statut' ('succes', 'ignore' ou 'erreur'), 'message', 'nb_coupes', 'volume'
+        et 'hdf5' (chemins du .npy et du .h5 s'ils ont été demandés), 'png_motif' (nom des png, à compléter par le numéro de coupe),
+        'serie_uid', 'somme_controle' (sha1 de l'ensemble des fichiers créés), 'statistiques' (cf _Conversion_serie) et 'duree'
+    
+    """
+    debut = time.time()
+    resultat = {"dossier" : DossierDICOM, "statut" : "succes", "message" : None, "nb_coupes" : 0, "volume" : None, "hdf5" : None,
+                "png_motif" : None, "serie_uid" : None, "somme_controle" : None, "statistiques" : None}
+    try:
+        liste_fichiers, raison = Tri_serie_DICOM(DossierDICOM, catalogue)
+        if liste_fichiers is None:
+            resultat["statut"] = "ignore"
+            resultat["message"] = raison
+        else:
+            nom = "{}_{}".format(os.path.basename(DossierDICOM), Identifiant_serie(DossierDICOM))
+            Fichier_volume, Fichier_HDF5 = None, None
+            if Dossier_volumes is not None:
+                Fichier_volume = os.path.join(Dossier_volumes, nom + ".npy")
+            if Dossier_HDF5 is not None:
+                Fichier_HDF5 = os.path.join(Dossier_HDF5, nom + ".h5")
+            _, statistiques = _Conversion_serie(liste_fichiers, DossierDICOM, Dossier_de_sauvegarde,
+                                                Fichier_volume = Fichier_volume, Fichier_HDF5 = Fichier_HDF5,
+                                                **parametres_conversion)
+            somme = hashlib.sha1(str(statistiques.pop("somme_controle_png")).encode())
+            for chemin in (Fichier_volume, Fichier_HDF5):
+                if chemin is not None:
+                    somme.update(_Somme_controle_fichier(chemin).encode())
+            statistiques.pop("png")
+            resultat["statistiques"] = statistiques
+            resultat["nb_coupes"] = len(liste_fichiers)
+            resultat["volume"] = Fichier_volume
+            resultat["hdf5"] = Fichier_HDF5
+            if Dossier_de_sauvegarde is not None:
+                resultat["png_motif"] = os.path.join(Dossier_de_sauvegarde, nom + "_{}.png")
+            resultat["serie_uid"] = str(pydicom.dcmread(liste_fichiers[0], stop_before_pixels=True).get("SeriesInstanceUID", ""))
+            resultat["somme_controle"] = somme.hexdigest()
+    except Exception as erreur:
+        resultat["statut"] = "erreur"
+        resultat["message"] = "{} : {}".format(type(erreur).__name__, erreur)
+    resultat["duree"] = time.time() - debut
+    return resultat
+
+
+def Import_DICOM_parallele(Dossier_racine,
+                           Dossier_de_sauvegarde,
+                           nombre_de_processus = None,
+                           taches_en_cours_max = None,
+                           WINDOWCENTER = 40,
+                           WINDOWWIDTH = 400,
+                           catalogue = None,
+                           Dossier_volumes = None,
+                           Dossier_HDF5 = None,
+                           compression_png = 6,
+                           nombre_ecrivains = 2,
+                           nombre_decodeurs = NOMBRE_DECODEURS,
+                           manifeste = None
+                          ):
+    """
+    Equivalent de la boucle de Dossier_DICOM_vers_ImagesPNG sur fast_scandir, mais en répartissant les séries
+    entre plusieurs processus : chaque coeur du processeur convertit une série différente.
+    
+    Parameters
+    ----------
+        - Dossier_racine : string, chemin vers le dossier contenant les séries, le dossier racine est lui-même traité
+        - Dossier_de_sauvegarde : string, chemin vers le dossier où l'on veut enregistrer les fichiers png, None pour n'écrire que les volumes
+        - nombre_de_processus : int, optionnel, nombre de processus utilisés, par défaut le nombre de coeurs de la machine
+        - taches_en_cours_max : int, optionnel, nombre maximal de séries soumises en même temps, par défaut 2x le nombre de processus.
+        Limite la mémoire utilisée lorsque l'archive contient des milliers de séries.
+        - WINDOWCENTER : int, optionnel, cf Dossier_DICOM_vers_ImagesPNG
+        - WINDOWWIDTH : int, optionnel, cf Dossier_DICOM_vers_ImagesPNG
+        - catalogue : string, optionnel, chemin vers un catalogue créé par Catalogue_DICOM, partagé en lecture par les processus
+        - Dossier_volumes : string, optionnel, dossier où écrire le volume de chaque série en .npy (memmap), nommé d'après le dossier de la série
+        - Dossier_HDF5 : string, optionnel, dossier où écrire chaque série sans perte en .h5 (cf Dossier_DICOM_vers_HDF5), lors du même décodage
+        - compression_png : cf Dossier_DICOM_vers_ImagesPNG
+        - nombre_ecrivains : int, nombre de threads d'écriture des png dans chaque processus
+        - nombre_decodeurs : int, nombre de threads de décodage des coupes dans chaque processus, par défaut NOMBRE_DECODEURS :
+        chaque processus occupe déjà un coeur, plus de threads ne ferait que multiplier les coupes décodées en mémoire
+        - manifeste : string, optionnel, chemin d'un fichier SQLite où est enregistrée chaque série traitée (empreinte des fichiers
+        sources, réglages, fichiers créés et leur somme de contrôle). En relançant l'import avec le même manifeste, les séries déjà
+        converties et inchangées sont sautées (statut 'deja_converti') : seules les séries nouvelles, modifiées ou en erreur sont
+        converties à nouveau. Permet de reprendre un import interrompu. Cf Lecture_manifeste.
+        
+    Returns
+    -------
+        - resultats : liste de dict, un compte-rendu par série (cf _Import_serie), dans l'ordre où les séries se terminent
+    
+    Notes
+    -----
+    Sous Windows, l'appel doit être protégé par un bloc if __name__ == "__main__" s'il est fait depuis un script.
+    
+    """
+    dossiers = [Dossier_racine] + fast_scandir(Dossier_racine)
+    if nombre_de_processus is None:
+        nombre_de_processus = os.cpu_count() or 1
+    if taches_en_cours_max is None:
+        taches_en_cours_max = 2 * nombre_de_processus
+
+    parametres_conversion = {"WINDOWCENTER" : WINDOWCENTER, "WINDOWWIDTH" : WINDOWWIDTH,
+                             "compression_png" : compression_png, "nombre_ecrivains" : nombre_ecrivains,
+                             "nombre_decodeurs" : nombre_decodeurs}
+    #Les réglages qui modifient les fichiers créés : les changer impose de convertir à nouveau
+    parametres_manifeste = json.dumps({"WINDOWCENTER" : WINDOWCENTER, "WINDOWWIDTH" : WINDOWWIDTH, "compression_png" : compression_png,
+                                       "Dossier_de_sauvegarde" : Dossier_de_sauvegarde, "Dossier_volumes" : Dossier_volumes,
+                                       "Dossier_HDF5" : Dossier_HDF5}, sort_keys=True)
+    connexion = None if manifeste is None else _Ouvrir_manifeste(manifeste)
+    empreintes = {}
+    resultats = []
+
+    def enregistrement(tache):
+        resultat = tache.result()
+        resultats.append(resultat)
+        if connexion is not None:
+            sorties = {"png_motif" : resultat["png_motif"], "png_nombre" : resultat["nb_coupes"] if resultat["png_motif"] else 0,
+                       "volume" : resultat["volume"], "hdf5" : resultat["hdf5"]}
+            with connexion:
+                connexion.execute("INSERT OR REPLACE INTO manifeste VALUES (?,?,?,?,?,?,?,?,?,?)",
+                                  (resultat["dossier"], empreintes[resultat["dossier"]], parametres_manifeste, resultat["statut"],
+                                   resultat["message"], resultat["serie_uid"], resultat["nb_coupes"], json.dumps(sorties),
+                                   resultat["somme_controle"], datetime.datetime.now().isoformat()))
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=nombre_de_processus) as executor:
+        en_cours = set()
+        for dossier in dossiers:
+            if connexion is not None:
+                empreintes[dossier] = _Empreinte_dossier(dossier)
+                ligne = connexion.execute("SELECT empreinte, parametres, statut, sorties, nb_coupes FROM manifeste WHERE dossier = ?",
+                                          (dossier,)).fetchone()
+                if ligne is not None:
+                    sorties = json.loads(ligne[3])
+                    if (ligne[0], ligne[1]) == (empreintes[dossier], parametres_manifeste) and ligne[2] in ("succes", "ignore") \
+                       and _Sorties_presentes(sorties):
+                        resultats.append({"dossier" : dossier, "statut" : "deja_converti", "message" : None, "nb_coupes" : ligne[4],
+                                          "volume" : sorties["volume"], "hdf5" : sorties["hdf5"], "png_motif" : sorties["png_motif"],
+                                          "serie_uid" : None, "somme_controle" : None, "statistiques" : None, "duree" : 0.})
+                        continue
+                    _Suppression_sorties(sorties)
+            if len(en_cours) >= taches_en_cours_max:
+                termines, en_cours = concurrent.futures.wait(en_cours, return_when=concurrent.futures.FIRST_COMPLETED)
+                for tache in termines:
+                    enregistrement(tache)
+            en_cours.add(executor.submit(_Import_serie, dossier, Dossier_de_sauvegarde, catalogue, Dossier_volumes, Dossier_HDF5,
+                                         parametres_conversion))
+        for tache in concurrent.futures.as_completed(en_cours):
+            enregistrement(tache)
+    if connexion is not None:
+        connexion.close()
+    return resultats
+
+
 def fast_scandir(dir):
     """
     Prend un dossier contenant atant de sous-dossiers et sous-sous-dossiers que voulu et en crée la liste des sous dossiers.
@@ -164,20 +892,496 @@ def fast_scandir(dir):
     return subfolders
 
 
-def readCSV(csv_path,name=None,indexing=None):
+#Colonnes de la table 'entetes' du catalogue, dans l'ordre de la table
+COLONNES_CATALOGUE = ["chemin", "dossier", "taille", "mtime", "valide", "serie_uid", "position_x", "position_y", "position_z",
+                      "epaisseur", "orientation", "plan", "slope", "intercept", "window_center", "window_width",
+                      "partie_du_corps", "description", "lignes", "colonnes", "espacement_ligne", "espacement_colonne"]
+
+
+def _Ouvrir_catalogue(chemin_catalogue):
+    """
+    Ouvre (et crée si besoin) la base SQLite du catalogue DICOM.
+    """
+    connexion = sqlite3.connect(chemin_catalogue, timeout=60)
+    connexion.execute("""CREATE TABLE IF NOT EXISTS entetes (
+                             chemin TEXT PRIMARY KEY, dossier TEXT, taille INTEGER, mtime REAL, valide INTEGER,
+                             serie_uid TEXT, position_x REAL, position_y REAL, position_z REAL, epaisseur REAL,
+                             orientation TEXT, plan TEXT, slope REAL, intercept REAL, window_center REAL, window_width REAL,
+                             partie_du_corps TEXT, description TEXT, lignes INTEGER, colonnes INTEGER,
+                             espacement_ligne REAL, espacement_colonne REAL)""")
+    connexion.execute("CREATE INDEX IF NOT EXISTS index_dossier ON entetes (dossier)")
+    connexion.execute("CREATE INDEX IF NOT EXISTS index_serie ON entetes (serie_uid)")
+    return connexion
+
+
+def _Premiere_valeur(valeur):
+    """
+    Certains tags DICOM (WindowCenter, WindowWidth...) peuvent contenir plusieurs valeurs, on ne garde que la première.
+    """
+    if valeur is None:
+        return None
+    if isinstance(valeur, (list, tuple, pydicom.multival.MultiValue)):
+        if len(valeur) == 0:
+            return None
+        valeur = valeur[0]
+    try:
+        return float(valeur)
+    except (TypeError, ValueError):
+        return None
+
+
+def _Plan_de_coupe(orientation):
+    """
+    Déduit le plan de coupe ('axial', 'coronal' ou 'sagittal') à partir du tag ImageOrientationPatient :
+    la normale au plan de coupe est le produit vectoriel des vecteurs ligne et colonne.
+    """
+    if orientation is None or len(orientation) != 6:
+        return None
+    normale = np.abs(np.cross(np.asarray(orientation[:3], dtype=float), np.asarray(orientation[3:], dtype=float)))
+    return ["sagittal", "coronal", "axial"][int(np.argmax(normale))]
+
+
+def _Lecture_entete(chemin, dossier, taille, mtime):
+    """
+    Lit l'en-tête d'un fichier DICOM sans ses pixels et renvoie la ligne correspondante du catalogue.
+    Un fichier illisible est tout de même enregistré (valide = 0) pour ne pas être relu à chaque mise à jour.
+    """
+    ligne = dict.fromkeys(COLONNES_CATALOGUE)
+    ligne.update(chemin=chemin, dossier=dossier, taille=taille, mtime=mtime, valide=0)
+    try:
+        ds = pydicom.dcmread(chemin, force=True, stop_before_pixels=True)
+    except Exception:
+        return ligne
+    if "ImagePositionPatient" not in ds or "Rows" not in ds:
+        return ligne
+
+    position = ds.ImagePositionPatient
+    orientation = ds.get("ImageOrientationPatient", None)
+    espacement = ds.get("PixelSpacing", None)
+    ligne.update(valide             = 1,
+                 serie_uid          = str(ds.get("SeriesInstanceUID", "")),
+                 position_x         = float(position[0]),
+                 position_y         = float(position[1]),
+                 position_z         = float(position[2]),
+                 epaisseur          = _Premiere_valeur(ds.get("SliceThickness", None)),
+                 orientation        = None if orientation is None else "\\".join(str(float(x)) for x in orientation),
+                 plan               = _Plan_de_coupe(orientation),
+                 slope              = _Premiere_valeur(ds.get("RescaleSlope", 1.)),
+                 intercept          = _Premiere_valeur(ds.get("RescaleIntercept", 0.)),
+                 window_center      = _Premiere_valeur(ds.get("WindowCenter", None)),
+                 window_width       = _Premiere_valeur(ds.get("WindowWidth", None)),
+                 partie_du_corps    = str(ds.get("BodyPartExamined", "")),
+                 description        = str(ds.get("SeriesDescription", "")),
+                 lignes             = int(ds.Rows),
+                 colonnes           = int(ds.Columns),
+                 espacement_ligne   = None if espacement is None else float(espacement[0]),
+                 espacement_colonne = None if espacement is None else float(espacement[1]))
+    return ligne
+
+
+def Catalogue_DICOM(Dossier_racine, chemin_catalogue):
+    """
+    Crée ou met à jour le catalogue des en-têtes DICOM de tous les fichiers situés dans Dossier_racine et ses sous-dossiers.
+    Chaque en-tête est lu une seule fois, sans les pixels, puis enregistré dans une base SQLite indexée par chemin, taille et date de modification :
+    lors des mises à jour suivantes seuls les fichiers nouveaux ou modifiés sont relus.
+    
+    Parameters
+    ----------
+        - Dossier_racine : string, chemin vers le dossier racine contenant les séries DICOM
+        - chemin_catalogue : string, chemin vers le fichier SQLite du catalogue (créé s'il n'existe pas)
+        
+    Returns
+    -------
+        - nb_lus : int, nombre d'en-têtes lus lors de cette mise à jour
+        - nb_inchanges : int, nombre de fichiers déjà à jour dans le catalogue
+        - nb_supprimes : int, nombre de fichiers retirés du catalogue car ils n'existent plus
+    
+    """
+    connexion = _Ouvrir_catalogue(chemin_catalogue)
+    nb_lus, nb_inchanges, nb_supprimes = 0, 0, 0
+    Dossier_racine = _Chemin_catalogue(Dossier_racine) #les sous-dossiers et fichiers en héritent
+    with connexion:
+        for dossier in [Dossier_racine] + fast_scandir(Dossier_racine):
+            connus = dict((chemin, (taille, mtime)) for chemin, taille, mtime in
+                          connexion.execute("SELECT chemin, taille, mtime FROM entetes WHERE dossier = ?", (dossier,)))
+            nouvelles_lignes = []
+            for entree in os.scandir(dossier):
+                if not entree.is_file():
+                    continue
+                statistiques = entree.stat()
+                if connus.pop(entree.path, None) == (statistiques.st_size, statistiques.st_mtime):
+                    nb_inchanges += 1
+                    continue
+                nouvelles_lignes.append(_Lecture_entete(entree.path, dossier, statistiques.st_size, statistiques.st_mtime))
+            connexion.executemany("INSERT OR REPLACE INTO entetes VALUES ({})".format(",".join("?" * len(COLONNES_CATALOGUE))),
+                                  [[ligne[colonne] for colonne in COLONNES_CATALOGUE] for ligne in nouvelles_lignes])
+            #Les fichiers restants dans 'connus' ont disparu du dossier :
+            connexion.executemany("DELETE FROM entetes WHERE chemin = ?", [(chemin,) for chemin in connus])
+            nb_lus += len(nouvelles_lignes)
+            nb_supprimes += len(connus)
+    connexion.close()
+    return nb_lus, nb_inchanges, nb_supprimes
+
+
+def Requete_catalogue(chemin_catalogue,
+                      nb_coupes_min = 150,
+                      epaisseur_max = 2.5,
+                      plan = "axial",
+                      partie_du_corps = None,
+                      description = None,
+                      dossier = None
+                     ):
+    """
+    Recherche dans le catalogue les séries correspondant aux critères voulus, sans ouvrir aucun fichier DICOM.
+    
+    Parameters
+    ----------
+        - chemin_catalogue : string, chemin vers le fichier SQLite créé par Catalogue_DICOM
+        - nb_coupes_min : int, nombre minimal de coupes de la série
+        - epaisseur_max : float, épaisseur de coupe maximale (en mm), None pour ne pas filtrer
+        - plan : string parmi 'axial', 'coronal', 'sagittal', None pour ne pas filtrer
+        - partie_du_corps : string, optionnel, valeur du tag BodyPartExamined (ex : 'CHEST')
+        - description : string, optionnel, texte recherché dans SeriesDescription (syntaxe SQL LIKE, ex : '%THORAX%')
+        - dossier : string, optionnel, limite la recherche à un seul dossier
+        
+    Returns
+    -------
+        - series : dict, {dossier (chemin absolu) : liste des fichiers triés selon l'axe z}, dans le même ordre que Tri_serie_DICOM
+    
+    """
+    conditions, parametres = ["valide = 1"], []
+    if dossier is not None:
+        conditions.append("dossier = ?")
+        parametres.append(_Chemin_catalogue(dossier))
+    if partie_du_corps is not None:
+        conditions.append("partie_du_corps = ?")
+        parametres.append(partie_du_corps)
+    if description is not None:
+        conditions.append("description LIKE ?")
+        parametres.append(description)
+    criteres_serie, parametres_serie = ["COUNT(*) >= ?"], [nb_coupes_min]
+    if epaisseur_max is not None:
+        criteres_serie.append("COALESCE(MAX(epaisseur), 0) <= ?")
+        parametres_serie.append(epaisseur_max)
+    if plan is not None:
+        criteres_serie.append("MIN(plan) = ? AND MAX(plan) = ?")
+        parametres_serie += [plan, plan]
+
+    connexion = _Ouvrir_catalogue(chemin_catalogue)
+    requete = """SELECT chemin, dossier FROM entetes
+                 WHERE {conditions} AND dossier IN (SELECT dossier FROM entetes WHERE {conditions}
+                                                    GROUP BY dossier HAVING {criteres})
+                 ORDER BY dossier, position_z DESC""".format(conditions=" AND ".join(conditions),
+                                                             criteres=" AND ".join(criteres_serie))
+    series = {}
+    for chemin, dossier_serie in connexion.execute(requete, parametres + parametres + parametres_serie):
+        series.setdefault(dossier_serie, []).append(chemin)
+    connexion.close()
+    return series
+
+
+class SerieDICOM:
+    """
+    Lecteur paresseux d'une série DICOM : les coupes, triées selon l'axe z comme dans Dossier_DICOM_vers_ImagesPNG, ne sont décodées
+    qu'au moment où on les demande. S'utilise comme un volume numpy :
+        - serie[k] renvoie la coupe k, serie[10:20] ou serie[[1, 5, 9]] un petit volume, serie[k, 100:200, :] une partie de coupe
+        - len(serie), serie.shape, serie.dtype
+        - for coupe in serie : parcours de toutes les coupes, à mémoire constante
+    
+    Parameters
+    ----------
+        - DossierDICOM : string, chemin vers le dossier contenant les fichiers DICOM
+        - catalogue : string, optionnel, chemin vers un catalogue créé par Catalogue_DICOM, évite de relire les en-têtes pour le tri
+        - fenetre : optionnel, tuple (centre, largeur) en UH. Si indiqué, les coupes sont renvoyées en uint8 après réglage du contraste
+        (cf ReglageContrasteDICOM_LUT), sinon en UH (float32).
+        - prechargement : int, nombre de coupes décodées à l'avance par un thread en arrière-plan lors d'un parcours, 0 pour désactiver
+        - taille_cache : int, nombre de coupes déjà décodées gardées en mémoire pour l'accès par indice
+        - liste_fichiers : liste, optionnel, liste de fichiers déjà triés (cf Tri_serie_DICOM ou Requete_catalogue), aucun critère
+        de sélection n'est alors appliqué
+    
+    """
+    def __init__(self, DossierDICOM, catalogue = None, fenetre = None, prechargement = 0, taille_cache = 16, liste_fichiers = None):
+        if liste_fichiers is None:
+            liste_fichiers, raison = Tri_serie_DICOM(DossierDICOM, catalogue)
+            if liste_fichiers is None:
+                raise ValueError(raison)
+        self.DossierDICOM = DossierDICOM
+        self.liste_fichiers = list(liste_fichiers)
+        self.fenetre = fenetre
+        self.prechargement = prechargement
+        self.taille_cache = taille_cache
+        self._cache = collections.OrderedDict()
+        self._verrou = threading.Lock()
+        self._forme_coupe = None
+
+    def __len__(self):
+        return len(self.liste_fichiers)
+
+    @property
+    def shape(self):
+        if self._forme_coupe is None:
+            entete = pydicom.dcmread(self.liste_fichiers[0], stop_before_pixels=True)
+            self._forme_coupe = (int(entete.Rows), int(entete.Columns))
+        return (len(self),) + self._forme_coupe
+
+    @property
+    def ndim(self):
+        return 3
+
+    @property
+    def dtype(self):
+        return np.dtype(np.float32 if self.fenetre is None else np.uint8)
+
+    def _decodage(self, k):
+        dicom_file = pydicom.dcmread(self.liste_fichiers[k])
+        pixels = Decodage_pixels(dicom_file)[0]
+        slope = float(dicom_file.get("RescaleSlope", 1.))
+        intercept = float(dicom_file.get("RescaleIntercept", 0.))
+        if self.fenetre is not None:
+            return ReglageContrasteDICOM_LUT(self.fenetre[0], self.fenetre[1], pixels, slope, intercept)
+        return (pixels * slope + intercept).astype(np.float32)
+
+    def coupe(self, k):
+        """
+        Renvoie la coupe k, en la décodant si elle n'est pas déjà en cache.
+        """
+        if k < 0:
+            k += len(self)
+        if not 0 <= k < len(self):
+            raise IndexError("coupe {} hors de la série ({} coupes)".format(k, len(self)))
+        with self._verrou:
+            if k in self._cache:
+                self._cache.move_to_end(k)
+                return self._cache[k]
+        image = self._decodage(k)
+        if self.taille_cache > 0:
+            with self._verrou:
+                self._cache[k] = image
+                while len(self._cache) > self.taille_cache:
+                    self._cache.popitem(last=False)
+        return image
+
+    def __getitem__(self, index):
+        reste = ()
+        if isinstance(index, tuple):
+            index, reste = index[0], index[1:]
+        if isinstance(index, (int, np.integer)):
+            return self.coupe(int(index))[reste]
+        if isinstance(index, slice):
+            indices = range(*index.indices(len(self)))
+        else:
+            indices = np.arange(len(self))[index]
+        volume = np.empty((len(indices),) + self.shape[1:], dtype=self.dtype)
+        for i, k in enumerate(indices):
+            volume[i] = self.coupe(int(k))
+        return volume[(slice(None),) + reste]
+
+    def __array__(self, dtype = None):
+        volume = self[:]
+        return volume if dtype is None else volume.astype(dtype)
+
+    def __iter__(self):
+        if self.prechargement <= 0:
+            for k in range(len(self)):
+                yield self._decodage(k)
+            return
+
+        #Un thread décode les coupes suivantes pendant que la coupe courante est utilisée
+        file_coupes = queue.Queue(maxsize=self.prechargement)
+        arret = threading.Event()
+        def depot(element):
+            while not arret.is_set():
+                try:
+                    file_coupes.put(element, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+        def lecture():
+            try:
+                for k in range(len(self)):
+                    if arret.is_set():
+                        return
+                    depot(self._decodage(k))
+            except Exception as erreur:
+                depot(erreur)
+        thread = threading.Thread(target=lecture, daemon=True)
+        thread.start()
+        try:
+            for _ in range(len(self)):
+                element = file_coupes.get()
+                if isinstance(element, Exception):
+                    raise element
+                yield element
+        finally:
+            arret.set()
+
+
+#Colonnes identifiant un patient, une série ou un fichier : lues comme du texte (un identifiant n'est pas un nombre)
+#et indexées par readCSV si elles sont présentes
+COLONNES_CLES = ["PatientID", "patient_id", "StudyInstanceUID", "SeriesInstanceUID", "serie_uid", "SOPInstanceUID",
+                 "dossier", "fichier", "chemin", "nom"]
+
+
+def _Colonne_texte(serie):
+    """
+    Vrai pour une colonne de texte, quel que soit le type utilisé par la version de pandas (object ou string).
+    """
+    return pandas.api.types.is_object_dtype(serie.dtype) or pandas.api.types.is_string_dtype(serie.dtype)
+
+
+def _Sauvegarde_colonnes(df, chemin_cache, cle):
+    """
+    Enregistre un dataframe colonne par colonne dans un fichier .npz (sans pickle), avec sa clé de validité.
+    """
+    colonnes = {}
+    description = []
+    for numero, (nom, serie) in enumerate(df.items()):
+        prefixe = "c{}".format(numero)
+        if isinstance(serie.dtype, pandas.CategoricalDtype):
+            colonnes[prefixe] = serie.cat.codes.values
+            colonnes[prefixe + "_categories"] = np.asarray(serie.cat.categories.astype(str), dtype=str)
+            description.append([nom, "category"])
+        elif pandas.api.types.is_datetime64_any_dtype(serie.dtype):
+            colonnes[prefixe] = serie.values.astype("datetime64[ns]").view(np.int64)
+            description.append([nom, "datetime"])
+        elif _Colonne_texte(serie):
+            colonnes[prefixe] = np.asarray(serie.fillna("").astype(str), dtype=str)
+            colonnes[prefixe + "_manquant"] = serie.isna().values
+            description.append([nom, "texte"])
+        else:
+            colonnes[prefixe] = serie.to_numpy()
+            description.append([nom, "numpy"])
+    colonnes["description"] = np.array(json.dumps({"cle" : cle, "colonnes" : description}))
+    with open(chemin_cache, "wb") as fichier: #un objet fichier évite que numpy ajoute '.npz' au nom
+        np.savez(fichier, **colonnes)
+
+
+def _Lecture_colonnes(chemin_cache, cle):
+    """
+    Relit un dataframe enregistré par _Sauvegarde_colonnes, ou renvoie None si le cache n'est plus valable.
+    """
+    try:
+        with np.load(chemin_cache) as colonnes:
+            description = json.loads(str(colonnes["description"]))
+            if description["cle"] != cle:
+                return None
+            donnees = collections.OrderedDict()
+            for numero, (nom, type_colonne) in enumerate(description["colonnes"]):
+                valeurs = colonnes["c{}".format(numero)]
+                if type_colonne == "category":
+                    valeurs = pandas.Categorical.from_codes(valeurs, colonnes["c{}_categories".format(numero)])
+                elif type_colonne == "datetime":
+                    valeurs = valeurs.view("datetime64[ns]")
+                elif type_colonne == "texte":
+                    valeurs = valeurs.astype(object)
+                    valeurs[colonnes["c{}_manquant".format(numero)]] = np.nan
+                donnees[nom] = valeurs
+    except (OSError, KeyError, ValueError):
+        return None
+    return pandas.DataFrame(donnees)
+
+
+def readCSV(csv_path, name=None, indexing=None, schema=None, categories=0.1, cache=False, delimiter=","):
     """
     Fonction simple pour lire le CSV et le garder en mémoire sous la forme d'un datafile, plus facilement lisible en utilisant pandas
     si on rentre name (un des fichiers numpy disponibles), la fonction affiche cette valeur
     On peut rentrer un string pour l'arg indexing pour demander a classer selon la colonne.
+
+    Les types des colonnes sont déduits du contenu (ou imposés par schema), les colonnes de texte qui se répètent beaucoup
+    (labels, classes) deviennent des 'category' pandas, bien plus légères. Avec cache=True, le tableau lu est gardé dans un
+    fichier 'csv_path.cache.npz' écrit à côté du CSV, relu directement tant que le CSV et les réglages n'ont pas changé.
+
+    Parameters
+    ----------
+        - csv_path : string, chemin du fichier CSV
+        - name : optionnel, valeur de l'index dont la ligne est affichée
+        - indexing : string ou liste de string, colonne(s) utilisée(s) comme index (elles ne sont alors plus des colonnes du
+        tableau) ; 'auto' pour indexer sur la première colonne de COLONNES_CLES présente, avec un index trié pour des recherches
+        rapides avec df.loc ; None (par défaut) ou False pour ne pas indexer
+        - schema : dict {colonne : type} imposant le type de certaines colonnes, ou str pour tout lire comme du texte (comme
+        les versions précédentes de cette fonction)
+        - categories : float, une colonne de texte devient 'category' si son nombre de valeurs différentes est inférieur
+        à cette proportion du nombre de lignes ; 0 pour désactiver
+        - cache : boolean, utilise et met à jour le cache 'csv_path.cache.npz' (crée un fichier dans le dossier du CSV)
+        - delimiter : string, séparateur des colonnes
+
+    Returns
+    -------
+        - df : dataframe pandas
+
     """
-    df=pandas.read_csv(csv_path, delimiter=",",dtype=str)
-    if indexing != None :
+    etat = os.stat(csv_path)
+    description_schema = str(sorted((k, str(v)) for k, v in schema.items())) if isinstance(schema, dict) else str(schema)
+    cle = [etat.st_size, etat.st_mtime, description_schema, categories, delimiter]
+    chemin_cache = csv_path + ".cache.npz"
+    df = _Lecture_colonnes(chemin_cache, cle) if cache and os.path.exists(chemin_cache) else None
+    if df is None:
+        if schema is str:
+            dtype = str
+        else:
+            dtype = {colonne : str for colonne in COLONNES_CLES}
+            dtype.update(schema or {})
+        df = pandas.read_csv(csv_path, delimiter=delimiter, dtype=dtype)
+        if categories and schema is not str:
+            for colonne in df.columns:
+                if _Colonne_texte(df[colonne]) and colonne not in COLONNES_CLES and df[colonne].nunique() < categories * len(df):
+                    df[colonne] = df[colonne].astype("category")
+        if cache:
+            try:
+                _Sauvegarde_colonnes(df, chemin_cache, cle)
+            except (OSError, ValueError): #dossier en lecture seule, ou colonne d'un type que numpy ne sait pas enregistrer
+                pass
+
+    if isinstance(indexing, str) and indexing == "auto":
+        indexing = next((colonne for colonne in COLONNES_CLES if colonne in df.columns), None)
+        if indexing is not None:
+            df.set_index(indexing, inplace=True)
+            df.sort_index(inplace=True)
+    elif indexing is not None and indexing is not False:
         df.set_index(indexing, inplace=True)
     if name:
         print(df.loc[name])
     return df
 
 
+def Jointure_labels_fichiers(labels, manifeste, cle_labels = "SeriesInstanceUID", cle_manifeste = "serie_uid", par_coupe = False):
+    """
+    Associe à chaque ligne d'un tableau de labels les fichiers créés par Import_DICOM_parallele pour la série correspondante :
+    volume .npy, fichier .h5, et png.
+
+    Parameters
+    ----------
+        - labels : dataframe pandas (cf readCSV) ou chemin d'un CSV
+        - manifeste : string, chemin du manifeste de Import_DICOM_parallele, ou dataframe renvoyé par Lecture_manifeste
+        - cle_labels : string, colonne (ou nom de l'index) des labels qui identifie la série
+        - cle_manifeste : string, colonne correspondante du manifeste : 'serie_uid' (SeriesInstanceUID) ou 'dossier'
+        - par_coupe : boolean, une ligne par png (colonnes 'coupe' et 'png') au lieu d'une ligne par série
+
+    Returns
+    -------
+        - df : dataframe pandas, les labels des séries converties avec les colonnes 'volume', 'hdf5', 'png_motif', 'nb_coupes'
+        (et 'coupe', 'png' si par_coupe)
+
+    """
+    if isinstance(labels, str):
+        labels = readCSV(labels)
+    if isinstance(manifeste, str):
+        manifeste = Lecture_manifeste(manifeste)
+    manifeste = manifeste[manifeste["statut"] == "succes"]
+    manifeste = manifeste[[cle_manifeste, "volume", "hdf5", "png_motif", "nb_coupes"]].set_index(cle_manifeste)
+    if cle_labels in labels.index.names:
+        labels = labels.reset_index()
+    df = labels.merge(manifeste, how="inner", left_on=cle_labels, right_index=True)
+    print("{} lignes de labels sur {} associées à une série convertie".format(len(df), len(labels)))
+    if par_coupe:
+        avec_png = df[df["png_motif"].notna()]
+        nombres = avec_png["nb_coupes"].astype(int).values
+        df = avec_png.loc[avec_png.index.repeat(nombres)].reset_index(drop=True)
+        df["coupe"] = np.concatenate([np.arange(n) for n in nombres]) if len(nombres) else []
+        df["png"] = [motif.format(j) for motif, j in zip(df["png_motif"], df["coupe"])]
+    return df
+
+
 def ReglageContrasteDICOM (Global_Level,Global_Window,imageDICOM):
     """
     Les valeurs des voxels en DICOM sont entre -2000 et +4000, pour afficher une image en échelle de gris (255 possibilités de gris sur un ordinateur classique) il faut réduire les 6000 possibilités à 255. Cette fonction est nécessaire avant d'afficher une image mais fait perdre des données (passage de 16 bits à 8 bits par pixel).
@@ -200,26 +1404,315 @@ def ReglageContrasteDICOM (Global_Level,Global_Window,imageDICOM):
     Ne fonctionne PAS si l'image a déjà été modifiée.
     
     """
-    limite_inf   = Global_Level -  (Global_Window / 2)
-    limite_sup = Global_Level + (Global_Window / 2)
-    image_avec_contraste = np.clip (imageDICOM, limite_inf , limite_sup )
-    image_avec_contraste = image_avec_contraste - limite_inf 
-    image_avec_contraste = image_avec_contraste / (limite_sup  - limite_inf )
-    image_avec_contraste *= 255
-    return image_avec_contraste 
+    limite_inf   = Global_Level -  (Global_Window / 2)
+    limite_sup = Global_Level + (Global_Window / 2)
+    image_avec_contraste = np.clip (imageDICOM, limite_inf , limite_sup )
+    image_avec_contraste = image_avec_contraste - limite_inf 
+    image_avec_contraste = image_avec_contraste / (limite_sup  - limite_inf )
+    image_avec_contraste *= 255
+    return image_avec_contraste 
+
+
+#Fenêtres usuelles en scanner, (centre, largeur) en UH
+FENETRES_CT = {"poumon"    : (-600, 1500),
+               "mediastin" : (40, 400),
+               "os"        : (400, 1800)}
+
+
+@functools.lru_cache(maxsize=64)
+def Table_contraste(Global_Level, Global_Window, slope = 1., intercept = 0., signe = False):
+    """
+    Précalcule le résultat de ReglageContrasteDICOM pour chacune des 65536 valeurs possibles d'un pixel DICOM 16 bits.
+    Les tables sont gardées en mémoire : une même combinaison de réglages n'est calculée qu'une fois.
+    
+    Parameters
+    ----------
+        - Global_Level : centre de la fenetre (en UH)
+        - Global_Window : largeur de la fenetre (en UH)
+        - slope : float, RescaleSlope du fichier DICOM
+        - intercept : float, RescaleIntercept du fichier DICOM
+        - signe : boolean, True si les pixels bruts sont en int16, False s'ils sont en uint16
+        
+    Returns
+    -------
+        - table : numpy uint8 de 65536 valeurs, en lecture seule, à indexer par les pixels bruts vus en uint16
+    
+    """
+    valeurs = np.arange(65536, dtype=np.uint16)
+    if signe:
+        valeurs = valeurs.view(np.int16)
+    table = ReglageContrasteDICOM(Global_Level, Global_Window, valeurs * float(slope) + float(intercept))
+    table = np.rint(table).astype(np.uint8)
+    table.flags.writeable = False
+    return table
+
+
+def ReglageContrasteDICOM_LUT(Global_Level, Global_Window, imageDICOM_brute, slope = 1., intercept = 0.):
+    """
+    Idem que ReglageContrasteDICOM mais directement à partir des pixels bruts (pixel_array), sans passer par les UH en float :
+    chaque pixel est remplacé par sa valeur dans une table précalculée (cf Table_contraste).
+    Le résultat est arrondi en uint8, prêt à être sauvegardé en png.
+    
+    Parameters
+    ----------
+        - Global_Level : centre de la fenetre (en UH)
+        - Global_Window : largeur de la fenetre (en UH)
+        - imageDICOM_brute : image ou volume numpy d'entiers, tel que renvoyé par pixel_array
+        - slope : float, RescaleSlope du fichier DICOM
+        - intercept : float, RescaleIntercept du fichier DICOM
+        
+    Returns
+    -------
+        - image_avec_contraste : numpy uint8, l'image ou le volume après réglage du contraste.
+    
+    Notes
+    -----
+    Les images qui ne sont pas en entiers de 8 ou 16 bits passent par ReglageContrasteDICOM.
+    
+    """
+    imageDICOM_brute = np.asarray(imageDICOM_brute)
+    if imageDICOM_brute.dtype in (np.uint8, np.int8):
+        imageDICOM_brute = imageDICOM_brute.astype(np.int16)
+    if imageDICOM_brute.dtype == np.uint16:
+        return Table_contraste(Global_Level, Global_Window, slope, intercept, False)[imageDICOM_brute]
+    if imageDICOM_brute.dtype == np.int16:
+        return Table_contraste(Global_Level, Global_Window, slope, intercept, True)[imageDICOM_brute.view(np.uint16)]
+    image_avec_contraste = ReglageContrasteDICOM(Global_Level, Global_Window, imageDICOM_brute * slope + intercept)
+    return np.rint(image_avec_contraste).astype(np.uint8)
+
+
+def Fenetres_multiples(imageDICOM_brute, slope = 1., intercept = 0., fenetres = ("poumon", "mediastin", "os")):
+    """
+    Applique plusieurs fenêtres à la fois à partir d'un seul décodage, chaque fenêtre devenant un canal de l'image.
+    Utile pour donner à un réseau l'équivalent des différentes fenêtres de lecture du radiologue, ou pour remplir les 3 canaux
+    attendus par les réseaux de TransferLearning.
+    
+    Parameters
+    ----------
+        - imageDICOM_brute : image ou volume numpy d'entiers, tel que renvoyé par pixel_array
+        - slope : float, RescaleSlope du fichier DICOM
+        - intercept : float, RescaleIntercept du fichier DICOM
+        - fenetres : liste de noms de FENETRES_CT ou de tuples (centre, largeur) en UH
+        
+    Returns
+    -------
+        - image_multi : numpy uint8, de taille [*taille de l'image, nombre de fenêtres]
+    
+    """
+    imageDICOM_brute = np.asarray(imageDICOM_brute)
+    image_multi = np.empty(imageDICOM_brute.shape + (len(fenetres),), dtype=np.uint8)
+    for canal, fenetre in enumerate(fenetres):
+        if isinstance(fenetre, str):
+            fenetre = FENETRES_CT[fenetre]
+        image_multi[..., canal] = ReglageContrasteDICOM_LUT(fenetre[0], fenetre[1], imageDICOM_brute, slope, intercept)
+    return image_multi
+
+
+def Benchmark_contraste(volume_brut, slope = 1., intercept = 0., Global_Level = 40, Global_Window = 400, repetitions = 3):
+    """
+    Compare le temps de réglage du contraste d'un volume entier entre ReglageContrasteDICOM et ReglageContrasteDICOM_LUT.
+    
+    Parameters
+    ----------
+        - volume_brut : volume numpy d'entiers 16 bits, tel que renvoyé par pixel_array pour chaque coupe
+        - slope, intercept : float, réglages DICOM du volume
+        - Global_Level, Global_Window : fenêtre utilisée (en UH)
+        - repetitions : int, nombre de mesures, la meilleure est gardée
+        
+    Returns
+    -------
+        - resultats : dict, temps en secondes de chaque méthode ('float', 'lut', 'creation_table') et 'acceleration'
+    
+    """
+    def chrono(fonction):
+        meilleur = float("inf")
+        for _ in range(repetitions):
+            debut = time.perf_counter()
+            fonction()
+            meilleur = min(meilleur, time.perf_counter() - debut)
+        return meilleur
+
+    Table_contraste.cache_clear()
+    debut = time.perf_counter()
+    ReglageContrasteDICOM_LUT(Global_Level, Global_Window, volume_brut[:1], slope, intercept)
+    creation_table = time.perf_counter() - debut
+
+    resultats = {"float"          : chrono(lambda : ReglageContrasteDICOM(Global_Level, Global_Window, volume_brut * slope + intercept)),
+                 "lut"            : chrono(lambda : ReglageContrasteDICOM_LUT(Global_Level, Global_Window, volume_brut, slope, intercept)),
+                 "creation_table" : creation_table}
+    resultats["acceleration"] = resultats["float"] / resultats["lut"]
+    print("ReglageContrasteDICOM : {:.3f} s, LUT : {:.3f} s (+{:.3f} s pour la table), soit x{:.1f}".format(
+        resultats["float"], resultats["lut"], creation_table, resultats["acceleration"]))
+    return resultats
+
+
+#Statistiques déjà calculées dans ce processus, par fichier de volume (cf Statistiques_volume)
+_CACHE_STATISTIQUES = {}
+
+
+def _Lecture_par_blocs(volume, taille_bloc):
+    """
+    Renvoie les blocs successifs de coupes d'un volume : array numpy ou memmap, SerieDICOM (en UH),
+    fichier .npy (ouvert en memmap) ou fichier .h5 (converti en UH avec Charger_volume_HU).
+    """
+    if isinstance(volume, str) and volume.endswith((".h5", ".hdf5")):
+        nb_coupes = Metadonnees_HDF5(volume)["forme"][0]
+        for debut in range(0, nb_coupes, taille_bloc):
+            yield Charger_volume_HU(volume, coupes=slice(debut, min(debut + taille_bloc, nb_coupes)))
+        return
+    if isinstance(volume, str):
+        volume = Ouvrir_volume(volume)
+    for debut in range(0, len(volume), taille_bloc):
+        yield np.asarray(volume[debut:debut + taille_bloc])
+
+
+def _Fusion_statistiques(s1, s2):
+    """
+    Réunit les statistiques de deux ensembles de voxels (formule de Chan et al. pour la variance).
+    """
+    if s1 is None:
+        return s2
+    n = s1["nb_voxels"] + s2["nb_voxels"]
+    delta = s2["moyenne"] - s1["moyenne"]
+    return {"nb_voxels"  : n,
+            "min"        : min(s1["min"], s2["min"]),
+            "max"        : max(s1["max"], s2["max"]),
+            "moyenne"    : s1["moyenne"] + delta * s2["nb_voxels"] / n,
+            "M2"         : s1["M2"] + s2["M2"] + delta ** 2 * s1["nb_voxels"] * s2["nb_voxels"] / n,
+            "histogramme": s1["histogramme"] + s2["histogramme"],
+            "bornes"     : s1["bornes"]}
+
+
+def _Statistiques_bloc(bloc, bornes_histogramme, largeur_classe):
+    """
+    Statistiques d'un bloc de coupes, en un seul passage sur les données en mémoire.
+    """
+    bloc = bloc.astype(np.float64, copy=False).reshape(-1)
+    moyenne = bloc.mean()
+    classes = np.clip(bloc, bornes_histogramme[0], bornes_histogramme[1] - largeur_classe)
+    classes -= bornes_histogramme[0]
+    classes //= largeur_classe
+    nb_classes = int(np.ceil((bornes_histogramme[1] - bornes_histogramme[0]) / largeur_classe))
+    return {"nb_voxels"  : bloc.size,
+            "min"        : float(bloc.min()),
+            "max"        : float(bloc.max()),
+            "moyenne"    : float(moyenne),
+            "M2"         : float(np.square(bloc - moyenne).sum()),
+            "histogramme": np.bincount(classes.astype(np.intp), minlength=nb_classes),
+            "bornes"     : list(bornes_histogramme)}
+
+
+def _Resultat_statistiques(statistiques, largeur_classe):
+    """
+    Met en forme le résultat final à partir des sommes accumulées.
+    """
+    return {"nb_voxels"      : int(statistiques["nb_voxels"]),
+            "min"            : statistiques["min"],
+            "max"            : statistiques["max"],
+            "moyenne"        : statistiques["moyenne"],
+            "ecart_type"     : float(np.sqrt(statistiques["M2"] / max(statistiques["nb_voxels"], 1))),
+            "M2"             : statistiques["M2"],
+            "histogramme"    : np.asarray(statistiques["histogramme"], dtype=np.int64),
+            "bornes"         : list(statistiques["bornes"]),
+            "largeur_classe" : largeur_classe}
+
+
+def Statistiques_volume(volume, taille_bloc = 16, bornes_histogramme = (-1024, 3072), largeur_classe = 1, cache = True):
+    """
+    Calcule en un seul passage, bloc de coupes par bloc de coupes, le minimum, le maximum, la moyenne, l'écart-type et
+    l'histogramme d'un volume : le volume n'a jamais besoin d'être chargé entièrement en mémoire.
+    Pour un fichier, le résultat est gardé en mémoire pour ce processus et dans un fichier json à côté du volume
+    ('volume.npy.stats.json'), tous deux invalidés si le fichier ou les réglages changent.
+
+    Parameters
+    ----------
+        - volume : array numpy, memmap, SerieDICOM, ou chemin d'un fichier .npy ou .h5 (en UH)
+        - taille_bloc : int, nombre de coupes lues à chaque fois
+        - bornes_histogramme : tuple, (min, max) de l'histogramme, en UH pour un volume en UH ; les valeurs en dehors
+        sont comptées dans la première ou la dernière classe
+        - largeur_classe : float, largeur de chaque classe de l'histogramme
+        - cache : boolean, utilise et remplit le cache pour les fichiers
+
+    Returns
+    -------
+        - statistiques : dict, 'nb_voxels', 'min', 'max', 'moyenne', 'ecart_type', 'histogramme' (array numpy),
+        'bornes', 'largeur_classe' ('M2' sert à réunir plusieurs volumes, cf Statistiques_dataset)
+
+    """
+    fichier_stats = None
+    if cache and isinstance(volume, str):
+        etat = os.stat(volume)
+        cle = [os.path.abspath(volume), etat.st_size, etat.st_mtime, list(bornes_histogramme), largeur_classe]
+        if json.dumps(cle) in _CACHE_STATISTIQUES:
+            return _CACHE_STATISTIQUES[json.dumps(cle)]
+        fichier_stats = volume + ".stats.json"
+        if os.path.exists(fichier_stats):
+            with open(fichier_stats) as fichier:
+                sauvegarde = json.load(fichier)
+            if sauvegarde.get("cle") == cle:
+                statistiques = _Resultat_statistiques(sauvegarde["statistiques"], largeur_classe)
+                _CACHE_STATISTIQUES[json.dumps(cle)] = statistiques
+                return statistiques
+
+    statistiques = None
+    for bloc in _Lecture_par_blocs(volume, taille_bloc):
+        statistiques = _Fusion_statistiques(statistiques, _Statistiques_bloc(bloc, bornes_histogramme, largeur_classe))
+    if statistiques is None:
+        raise ValueError("Le volume est vide")
+    statistiques = _Resultat_statistiques(statistiques, largeur_classe)
+
+    if fichier_stats is not None:
+        _CACHE_STATISTIQUES[json.dumps(cle)] = statistiques
+        sauvegarde = dict(statistiques, histogramme=statistiques["histogramme"].tolist())
+        try:
+            with open(fichier_stats, "w") as fichier:
+                json.dump({"cle" : cle, "statistiques" : sauvegarde}, fichier)
+        except OSError: #dossier en lecture seule : le cache reste en mémoire
+            pass
+    return statistiques
+
+
+def Statistiques_dataset(Fichiers_volume, nombre_de_threads = 4, **parametres):
+    """
+    Statistiques de l'ensemble des voxels de plusieurs volumes, par exemple pour normaliser tout un jeu d'entrainement
+    avec les mêmes valeurs. Chaque volume est lu une seule fois, en parallèle, et son résultat est mis en cache (cf Statistiques_volume).
+
+    Parameters
+    ----------
+        - Fichiers_volume : liste des chemins des volumes (.npy ou .h5)
+        - nombre_de_threads : int, nombre de volumes lus en même temps
+        - parametres : réglages transmis à Statistiques_volume (taille_bloc, bornes_histogramme, largeur_classe, cache)
+
+    Returns
+    -------
+        - statistiques : dict, comme Statistiques_volume, pour tous les volumes réunis
+
+    """
+    statistiques = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nombre_de_threads) as executeur:
+        for resultat in executeur.map(lambda f : Statistiques_volume(f, **parametres), Fichiers_volume):
+            statistiques = _Fusion_statistiques(statistiques, resultat)
+    return _Resultat_statistiques(statistiques, parametres.get("largeur_classe", 1))
 
 
-def Norm0_1 (volume_array):
+def Norm0_1 (volume_array, statistiques = None, en_place = False, taille_bloc = 16):
     """
     les scanners ont des voxels dont la valeur est négative, ce qui sera mal interprété pour une image, il faut donc normaliser entre 0 et 1. Cela permet notamment de les afficher sous un format image apres un facteur de *255.
+    Le minimum, le maximum et la moyenne sont calculés en un seul passage par Statistiques_volume, puis la normalisation
+    est faite bloc de coupes par bloc de coupes, sans copie temporaire du volume entier.
     
     Parameters
     ----------
-        - volume_array : numpy, volume scanner [nb_de_coupes, largeur, profondeur]
+        - volume_array : numpy, volume scanner [nb_de_coupes, largeur, profondeur], memmap ou chemin d'un fichier .npy
+        - statistiques : dict, résultat de Statistiques_volume ou Statistiques_dataset à utiliser (par exemple pour normaliser
+        tous les volumes d'un dataset de la même façon), calculé sur ce volume si None
+        - en_place : boolean, écrit le résultat dans volume_array lui-même (qui doit être en float, et ouvert en écriture pour un memmap
+        ou un fichier) au lieu de créer un nouveau volume
+        - taille_bloc : int, nombre de coupes traitées à chaque fois
         
     Returns
     -------
-        - volume_array_scale : numpy, le même volume mais avec des voxels entre o et 1.
+        - volume_array_scale : numpy, le même volume mais avec des voxels entre o et 1 (en float32 si le volume était en entiers).
         - a : float, valeur minimale avant normalisation
         - b : float, valeur maximale avant normalisation
         - c : float, valeur moyenne avant normalisation
@@ -229,12 +1722,28 @@ def Norm0_1 (volume_array):
     Ne fonctionne QUE si l'image a déjà été normalisée. 
     
     """
-    a,b,c=volume_array.min(),volume_array.max(),volume_array.mean()
-    volume_array_scale=(volume_array-a)/(b-a)
+    if statistiques is None:
+        statistiques = Statistiques_volume(volume_array, taille_bloc = taille_bloc)
+    a,b,c=statistiques["min"],statistiques["max"],statistiques["moyenne"]
+    if isinstance(volume_array, str):
+        volume_array = Ouvrir_volume(volume_array, mode = "r+" if en_place else "r")
+    if en_place:
+        if not np.issubdtype(volume_array.dtype, np.floating):
+            raise TypeError("La normalisation en place nécessite un volume en float, pas en {}".format(volume_array.dtype))
+        volume_array_scale = volume_array
+    else:
+        dtype = volume_array.dtype if np.issubdtype(volume_array.dtype, np.floating) else np.float32
+        volume_array_scale = np.empty(volume_array.shape, dtype = dtype)
+    for debut in range(0, len(volume_array), taille_bloc):
+        bloc = volume_array_scale[debut:debut + taille_bloc]
+        if not en_place:
+            bloc[...] = volume_array[debut:debut + taille_bloc]
+        bloc -= a
+        bloc /= (b-a)
     return volume_array_scale,a,b,c
 
 
-def WL_scaled (Global_Level,Global_Window,array,a,b):
+def WL_scaled (Global_Level,Global_Window,array,a,b, sortie = None):
     """
     Idem que ReglageContrasteDICOM mais corrigé par les facteurs a et b qui correpsondent au min et max, 
     >>> à utiliser à la place de ReglageContrasteDICOM si on a utilisé Norm0_1
@@ -252,6 +1761,8 @@ def WL_scaled (Global_Level,Global_Window,array,a,b):
         - array : image ou volume numpy chargé en mémoire
         - a : minimum en UH avant normalisation
         - b : maximum en UH avant normalisation
+        - sortie : array numpy en float de même forme que array où écrire le résultat, None pour en créer un ; 
+        passer array lui-même pour travailler en place
         
     Returns
     -------
@@ -267,29 +1778,36 @@ def WL_scaled (Global_Level,Global_Window,array,a,b):
     limite_sup = Global_Level + (Global_Window / 2)
     limite_inf   = limite_inf/b
     limite_sup   = limite_sup/b
-    image_ret=np.clip(array, limite_inf, limite_sup)
-    image_ret=image_ret-limite_inf
-    image_ret=image_ret/(limite_sup-limite_inf)
+    #un seul volume est créé (ou aucun avec sortie) au lieu d'un par opération
+    if sortie is None and not np.issubdtype(np.asarray(array).dtype, np.floating):
+        sortie = np.empty(np.shape(array), dtype=np.float32)
+    image_ret=np.clip(array, limite_inf, limite_sup, out=sortie)
+    image_ret-=limite_inf
+    image_ret/=(limite_sup-limite_inf)
     return image_ret
 
 
-def affichage3D(volume, k, axis=0):
+def affichage3D(volume, k, axis=0, cache=None):
     """
     affiche la coupe numéro k d'un volume, selon son axe axis
 
     Parameters
     ----------
-        - volume : volume numpy chargé en mémoire
+        - volume : volume numpy chargé en mémoire, ou SerieDICOM (seule la coupe affichée est alors décodée en axial)
         - k : int, numéro de coupe
         - axis : int, 0 : axial ; 1 : coronal ; 2 : sag (dans le cas d'un volume chargé en axial)
+        - cache : CacheReformatage, optionnel, lit les coupes coronales et sagittales dans une copie contiguë gardée en mémoire,
+        beaucoup plus rapide quand on affiche plusieurs coupes d'un même volume (cf aussi DefilementCoupes)
     
     """
     f = plt.figure()
-    if axis == 0:
+    if cache is not None:
+        image1 = cache.coupe(volume, k, axis)
+    elif axis == 0:
         image1 = volume[k,:,:]
-    if axis == 1:
+    elif axis == 1:
         image1 = volume[:,k,:]
-    if axis == 2:
+    elif axis == 2:
         image1 = volume[:,:,k]
     plt.imshow(image1,cmap='gray')
     plt.show()
@@ -312,7 +1830,7 @@ def affichage2D(volume):
     return
 
 
-def AffichageMulti(volume, frequence, axis=0, FIGSIZE = 40):
+def AffichageMulti(volume, frequence, axis=0, FIGSIZE = 40, mosaique = False, **parametres):
     """
     affiche toutes les coupes d'un volume selon l'axe axis, avec une frequence entre les coupes définie
     
@@ -322,20 +1840,25 @@ def AffichageMulti(volume, frequence, axis=0, FIGSIZE = 40):
         - frequence : int, espace inter coupe (en voxels)
         - axis : int, 0 : axial ; 1 : coronal ; 2 : sag (dans le cas d'un volume chargé en axial)
         - FIGSIZE : taille des images pour l'affichage.
+        - mosaique : boolean, affiche toutes les coupes en une seule image avec AffichageMosaique, beaucoup plus rapide
+        pour un grand nombre de coupes
+        - parametres : réglages transmis à AffichageMosaique (colonnes, taille_vignette, fenetre, numeros, Fichier_png)
     
     """
+    if mosaique:
+        AffichageMosaique(volume, frequence, axis, FIGSIZE = FIGSIZE, **parametres)
+        return
     coupes = np.shape(volume)[axis]
-    nb_images = coupes // frequence
+    indices = range(0, coupes, frequence)
+    nb_images = len(indices)
     fig=plt.figure(figsize=(FIGSIZE, FIGSIZE))
     columns = 6
     if nb_images % columns >0 :
         rows = (nb_images // columns)+1
     else :
         rows = nb_images // columns
-    for i in range(nb_images):
-        i+=1
-        fig.add_subplot(rows, columns, i)
-        dix = frequence * i
+    for i, dix in enumerate(indices):
+        fig.add_subplot(rows, columns, i+1)
         if axis == 0:
             plt.imshow(volume[dix,:,:], cmap='gray')
         elif axis == 1:
@@ -344,16 +1867,984 @@ def AffichageMulti(volume, frequence, axis=0, FIGSIZE = 40):
             plt.imshow(volume[:,:,dix], cmap='gray')
     plt.show(block=True)
     return
-    
+
+
+def AffichageMosaique(volume, frequence = 1, axis = 0, colonnes = 8, taille_vignette = 128, fenetre = None, numeros = True,
+                      Fichier_png = None, afficher = True, FIGSIZE = 20):
+    """
+    Affiche les coupes choisies d'un volume en une seule image (mosaïque) : les coupes sont réduites, converties en uint8
+    et assemblées dans un seul tableau numpy, affiché avec un seul imshow. Un examen entier reste ainsi rapide à parcourir,
+    même pour plusieurs centaines de coupes.
+
+    Parameters
+    ----------
+        - volume : volume numpy chargé en mémoire, memmap ou SerieDICOM (seules les coupes affichées sont lues)
+        - frequence : int, espace inter coupe (en voxels)
+        - axis : int, 0 : axial ; 1 : coronal ; 2 : sag (dans le cas d'un volume chargé en axial)
+        - colonnes : int, nombre de vignettes par ligne
+        - taille_vignette : int, taille maximale en pixels du plus grand côté de chaque vignette
+        - fenetre : tuple (Global_Level, Global_Window) en UH, optionnel ; sinon les valeurs sont étalées entre le minimum et le
+        maximum des coupes affichées
+        - numeros : boolean, écrit le numéro de chaque coupe dans le coin de sa vignette
+        - Fichier_png : string, optionnel, chemin où sauvegarder la mosaïque en png
+        - afficher : boolean, affiche la mosaïque avec matplotlib
+        - FIGSIZE : largeur de la figure pour l'affichage
+
+    Returns
+    -------
+        - mosaique : array numpy uint8 (lignes * hauteur_vignette, colonnes * largeur_vignette)
+
+    """
+    indices = list(range(0, np.shape(volume)[axis], frequence))
+    forme = [n for i, n in enumerate(np.shape(volume)) if i != axis]
+    pas = max(1, int(np.ceil(max(forme) / taille_vignette)))
+    hauteur, largeur = -(-forme[0] // pas), -(-forme[1] // pas)
+    colonnes = min(colonnes, len(indices))
+    lignes = -(-len(indices) // colonnes)
+
+    vignettes = np.empty((len(indices), hauteur, largeur), dtype=np.float32)
+    for n, k in enumerate(indices):
+        index = [slice(None, None, pas)] * 3
+        index[axis] = k
+        vignettes[n] = volume[tuple(index)]
+    if fenetre is not None:
+        minimum, maximum = fenetre[0] - fenetre[1] / 2., fenetre[0] + fenetre[1] / 2.
+    else:
+        minimum, maximum = float(vignettes.min()), float(vignettes.max())
+    vignettes -= minimum
+    vignettes *= 255. / max(maximum - minimum, 1e-6)
+    np.clip(vignettes, 0, 255, out=vignettes)
+
+    mosaique = np.zeros((lignes * hauteur, colonnes * largeur), dtype=np.uint8)
+    for n in range(len(indices)):
+        ligne, colonne = divmod(n, colonnes)
+        mosaique[ligne * hauteur:(ligne + 1) * hauteur, colonne * largeur:(colonne + 1) * largeur] = vignettes[n]
+    if numeros:
+        image = Image.fromarray(mosaique)
+        dessin = ImageDraw.Draw(image)
+        for n, k in enumerate(indices):
+            ligne, colonne = divmod(n, colonnes)
+            #fond noir sous le numéro pour qu'il reste lisible (police par défaut de PIL : environ 6x11 pixels par chiffre)
+            dessin.rectangle([colonne * largeur, ligne * hauteur, colonne * largeur + 6 * len(str(k)) + 3, ligne * hauteur + 12], fill=0)
+            dessin.text((colonne * largeur + 2, ligne * hauteur + 1), str(k), fill=255)
+        mosaique = np.asarray(image)
+
+    if Fichier_png is not None:
+        Image.fromarray(mosaique).save(Fichier_png)
+    if afficher:
+        plt.figure(figsize=(FIGSIZE, FIGSIZE * mosaique.shape[0] / mosaique.shape[1]))
+        plt.imshow(mosaique, cmap='gray', vmin=0, vmax=255, interpolation='nearest')
+        plt.axis('off')
+        plt.show()
+    return mosaique
+
+
+class CacheReformatage:
+    """
+    Garde en mémoire des copies contiguës des reformatages coronaux et sagittaux de volumes axiaux : une coupe coronale
+    ou sagittale d'un volume axial est dispersée dans tout le tableau, alors que dans la copie elle est d'un seul tenant.
+    Chaque copie est construite une seule fois, en lisant le volume dans l'ordre des coupes (efficace pour un memmap ou
+    une SerieDICOM), éventuellement réduite, puis sert pour toutes les coupes suivantes. Les copies les moins récemment
+    utilisées sont supprimées quand le budget mémoire est dépassé.
+
+    Parameters
+    ----------
+        - budget_Mo : float, mémoire maximale occupée par les copies, en Mo
+        - taille_bloc : int, nombre de coupes axiales lues à la fois pour construire une copie
+
+    """
+    def __init__(self, budget_Mo = 512, taille_bloc = 32):
+        self.budget = budget_Mo * 1e6
+        self.taille_bloc = taille_bloc
+        self._copies = collections.OrderedDict()
+        self._hors_budget_signales = set()
+        self._verrou = threading.Lock()
+
+    @property
+    def occupation(self):
+        """Mémoire occupée par les copies, en octets."""
+        return sum(copie.nbytes for _, copie in self._copies.values())
+
+    def _hors_budget(self, volume, axis, reduction):
+        """
+        Vrai si la copie réorganisée ne tiendrait pas dans le budget, sans la construire ; signalé une fois par reformatage.
+        """
+        octets = np.prod([len(range(0, n, reduction)) for n in np.shape(volume)], dtype=np.int64) \
+                 * (4 if isinstance(volume, SerieDICOM) else np.dtype(volume.dtype).itemsize)
+        if octets <= self.budget:
+            return False
+        cle = (id(volume), axis, reduction)
+        with self._verrou:
+            if cle not in self._hors_budget_signales:
+                self._hors_budget_signales.add(cle)
+                print("Reformatage de {:.0f} Mo, supérieur au budget du cache : les coupes sont lues directement dans le volume".format(
+                      octets / 1e6))
+        return True
+
+    def _construction(self, volume, axis, reduction):
+        forme = [len(range(0, n, reduction)) for n in np.shape(volume)]
+        if axis == 0:
+            copie = np.empty(forme, dtype=np.float32 if isinstance(volume, SerieDICOM) else volume.dtype)
+        else:
+            ordre = (1, 0, 2) if axis == 1 else (2, 0, 1)
+            copie = np.empty([forme[i] for i in ordre], dtype=np.float32 if isinstance(volume, SerieDICOM) else volume.dtype)
+        coupes = range(0, np.shape(volume)[0], reduction)
+        for debut in range(0, len(coupes), self.taille_bloc):
+            indices = coupes[debut:debut + self.taille_bloc]
+            bloc = np.asarray(volume[indices.start:indices.stop:reduction, ::reduction, ::reduction])
+            if axis == 0:
+                copie[debut:debut + len(bloc)] = bloc
+            elif axis == 1:
+                copie[:, debut:debut + len(bloc)] = bloc.transpose(1, 0, 2)
+            else:
+                copie[:, debut:debut + len(bloc)] = bloc.transpose(2, 0, 1)
+        return copie
+
+    def reformatage(self, volume, axis, reduction = 1):
+        """
+        Renvoie le volume réorganisé pour que l'axe axis soit le premier : reformatage(volume, 1)[k] est la coupe coronale k.
+        Si la copie dépasse le budget, un volume numpy ou memmap est renvoyé sous forme de vue (sans copie), une SerieDICOM
+        est copiée sans être gardée.
+
+        Parameters
+        ----------
+            - volume : volume numpy, memmap ou SerieDICOM, chargé en axial
+            - axis : int, 0 : axial ; 1 : coronal ; 2 : sag
+            - reduction : int, ne garde qu'un voxel sur reduction dans chaque direction
+        
+        """
+        if axis == 0 and reduction == 1 and isinstance(volume, np.ndarray):
+            return volume
+        if self._hors_budget(volume, axis, reduction):
+            if isinstance(volume, np.ndarray):
+                return np.moveaxis(volume, axis, 0)[::reduction, ::reduction, ::reduction]
+            return self._construction(volume, axis, reduction)
+        cle = (id(volume), axis, reduction)
+        with self._verrou:
+            if cle in self._copies:
+                reference, copie = self._copies[cle]
+                if reference() is volume:
+                    self._copies.move_to_end(cle)
+                    return copie
+                del self._copies[cle] #l'ancien volume a disparu et son id a été réutilisé
+        copie = self._construction(volume, axis, reduction)
+        with self._verrou:
+            self._copies[cle] = (weakref.ref(volume), copie)
+            while self.occupation > self.budget:
+                self._copies.popitem(last=False)
+        return copie
+
+    def coupe(self, volume, k, axis = 0, reduction = 1):
+        """
+        Renvoie la coupe k du volume selon l'axe axis, à partir de la copie en cache, ou directement dans le volume
+        si la copie dépasse le budget.
+        """
+        if not (axis == 0 and reduction == 1 and isinstance(volume, np.ndarray)) and self._hors_budget(volume, axis, reduction):
+            index = [slice(None, None, reduction)] * 3
+            index[axis] = k // reduction * reduction
+            return np.asarray(volume[tuple(index)])
+        return self.reformatage(volume, axis, reduction)[k // reduction]
+
+    def vider(self):
+        with self._verrou:
+            self._copies.clear()
+            self._hors_budget_signales.clear()
+
+
+class DefilementCoupes:
+    """
+    Affiche un volume coupe par coupe dans une seule figure : changer de coupe ne fait que remplacer les pixels de l'image
+    déjà affichée, sans recréer de figure. Se parcourt avec la molette de la souris ou les flèches haut/bas (avec un backend
+    interactif, par exemple %matplotlib widget ou %matplotlib notebook dans jupyter), ou avec afficher(k).
+
+    Parameters
+    ----------
+        - volume : volume numpy, memmap ou SerieDICOM, chargé en axial
+        - axis : int, 0 : axial ; 1 : coronal ; 2 : sag
+        - cache : CacheReformatage, optionnel, un nouveau cache est créé si None
+        - fenetre : tuple (Global_Level, Global_Window) en UH, optionnel ; sinon le contraste est réglé sur la première coupe affichée
+        - reduction : int, ne garde qu'un voxel sur reduction dans chaque direction, pour parcourir rapidement un grand volume
+        - k : int, numéro de la première coupe affichée, celle du milieu si None
+        - FIGSIZE : taille de la figure
+
+    """
+    def __init__(self, volume, axis = 0, cache = None, fenetre = None, reduction = 1, k = None, FIGSIZE = 8):
+        self.volume = volume
+        self.axis = axis
+        self.cache = cache if cache is not None else CacheReformatage()
+        self.reduction = reduction
+        self.nb_coupes = np.shape(volume)[axis]
+        self.k = self.nb_coupes // 2 if k is None else k
+        coupe = self.cache.coupe(volume, self.k, axis, reduction)
+        if fenetre is not None:
+            vmin, vmax = fenetre[0] - fenetre[1] / 2., fenetre[0] + fenetre[1] / 2.
+        else:
+            vmin, vmax = float(np.min(coupe)), float(np.max(coupe))
+        self.figure, self.axes = plt.subplots(figsize=(FIGSIZE, FIGSIZE))
+        self.image = self.axes.imshow(coupe, cmap='gray', vmin=vmin, vmax=vmax, interpolation='nearest')
+        self.axes.axis('off')
+        self.axes.set_title("Coupe {} / {}".format(self.k, self.nb_coupes - 1))
+        self.figure.canvas.mpl_connect("scroll_event", self._molette)
+        self.figure.canvas.mpl_connect("key_press_event", self._clavier)
+        plt.show()
+
+    def afficher(self, k):
+        """
+        Affiche la coupe k (ramenée entre la première et la dernière coupe).
+        """
+        self.k = int(np.clip(k, 0, self.nb_coupes - 1))
+        self.image.set_data(self.cache.coupe(self.volume, self.k, self.axis, self.reduction))
+        self.axes.set_title("Coupe {} / {}".format(self.k, self.nb_coupes - 1))
+        self.figure.canvas.draw_idle()
+
+    def _molette(self, evenement):
+        self.afficher(self.k + (self.reduction if evenement.button == "up" else -self.reduction))
+
+    def _clavier(self, evenement):
+        if evenement.key in ("up", "right"):
+            self.afficher(self.k + self.reduction)
+        elif evenement.key in ("down", "left"):
+            self.afficher(self.k - self.reduction)
+
+
+#___________________________________________________________________________________________
+#___________________FONCTIONS POUR REECHANTILLONNER LES VOLUMES_____________________________
+#___________________________________________________________________________________________
+
+
+def Espacement_serie(source, catalogue = None):
+    """
+    Renvoie la taille des voxels d'une série, en mm, dans l'ordre des axes des volumes (z, lignes, colonnes).
+    L'espacement en z est mesuré entre les positions des coupes (ImagePositionPatient), plus fiable que SliceThickness
+    quand les coupes se chevauchent.
+
+    Parameters
+    ----------
+        - source : string, dossier DICOM ou fichier .h5 créé par Dossier_DICOM_vers_HDF5, ou SerieDICOM
+        - catalogue : string, optionnel, chemin vers un catalogue créé par Catalogue_DICOM pour le tri d'un dossier DICOM
+
+    Returns
+    -------
+        - espacement : tuple de 3 float, (z, lignes, colonnes) en mm
+
+    """
+    if isinstance(source, str) and source.endswith((".h5", ".hdf5")):
+        metadonnees = Metadonnees_HDF5(source)
+        espacement_z = metadonnees.get("EspacementZ", metadonnees.get("SliceThickness"))
+        return (float(espacement_z),) + tuple(float(x) for x in metadonnees["PixelSpacing"])
+    if isinstance(source, SerieDICOM):
+        liste_fichiers = source.liste_fichiers
+    else:
+        liste_fichiers, raison = Tri_serie_DICOM(source, catalogue)
+        if liste_fichiers is None:
+            raise ValueError(raison)
+    entetes = [pydicom.dcmread(f, specific_tags=["ImagePositionPatient", "PixelSpacing", "SliceThickness"])
+               for f in (liste_fichiers[0], liste_fichiers[-1])]
+    if len(liste_fichiers) > 1:
+        espacement_z = abs(float(entetes[-1].ImagePositionPatient[2]) - float(entetes[0].ImagePositionPatient[2]))
+        espacement_z /= len(liste_fichiers) - 1
+    else:
+        espacement_z = float(entetes[0].SliceThickness)
+    return (espacement_z,) + tuple(float(x) for x in entetes[0].PixelSpacing)
+
+
+def Forme_reechantillonnee(forme, espacement, espacement_cible):
+    """
+    Forme d'un volume après rééchantillonnage : le premier voxel reste en place et l'étendue du volume est conservée.
+    """
+    return tuple(int(np.floor((n - 1) * e / c + 1e-6)) + 1 for n, e, c in zip(forme, espacement, espacement_cible))
+
+
+def Reechantillonnage_volume(volume,
+                             espacement,
+                             espacement_cible = (1., 1., 1.),
+                             masque = False,
+                             Fichier_sortie = None,
+                             taille_bloc = 32,
+                             nombre_de_threads = 4
+                            ):
+    """
+    Rééchantillonne un volume à une taille de voxel donnée, pour que le réseau voie toutes les séries à la même échelle.
+    Le volume de sortie est calculé par blocs de coupes, en parallèle : chaque bloc ne lit que les coupes d'origine
+    dont il a besoin, ce qui permet de traiter des volumes en memmap ou des SerieDICOM sans les charger entièrement.
+    Réduire tôt les séries fines (coupes de 0.6 mm par exemple) diminue d'autant le stockage et la durée de l'entrainement.
+
+    Parameters
+    ----------
+        - volume : array numpy, memmap, SerieDICOM ou chemin d'un fichier .npy, [nb_de_coupes, lignes, colonnes]
+        - espacement : tuple, taille des voxels du volume en mm (z, lignes, colonnes), cf Espacement_serie
+        - espacement_cible : tuple, taille des voxels voulue en mm (z, lignes, colonnes)
+        - masque : boolean, True pour un masque de segmentation : interpolation au plus proche voisin (les labels restent entiers,
+        le type est conservé) ; sinon interpolation linéaire, résultat en float32
+        - Fichier_sortie : string, optionnel, fichier .npy où écrire le résultat directement (memmap)
+        - taille_bloc : int, nombre de coupes de sortie calculées par bloc
+        - nombre_de_threads : int, nombre de blocs calculés en même temps
+
+    Returns
+    -------
+        - volume_reechantillonne : array numpy (ou memmap si Fichier_sortie est indiqué)
+
+    """
+    if isinstance(volume, str):
+        volume = Ouvrir_volume(volume)
+    forme = tuple(volume.shape)
+    forme_sortie = Forme_reechantillonnee(forme, espacement, espacement_cible)
+    #Pas d'échantillonnage en voxels d'origine, pour chaque axe
+    facteurs = np.array(espacement_cible, dtype=np.float64) / np.array(espacement, dtype=np.float64)
+    ordre = 0 if masque else 1
+    dtype = volume.dtype if masque else np.float32
+    sortie = Allocation_volume(forme_sortie, dtype=dtype, Fichier_volume=Fichier_sortie)
+
+    def bloc(debut):
+        fin = min(debut + taille_bloc, forme_sortie[0])
+        #Coupes d'origine nécessaires au bloc, avec une coupe de marge pour l'interpolation
+        premiere = int(np.floor(debut * facteurs[0]))
+        derniere = min(int(np.ceil((fin - 1) * facteurs[0])) + 2, forme[0])
+        entree = np.asarray(volume[premiere:derniere])
+        if not masque:
+            entree = entree.astype(np.float32, copy=False)
+        sortie[debut:fin] = scipy.ndimage.affine_transform(entree, facteurs, offset=(debut * facteurs[0] - premiere, 0, 0),
+                                                           output_shape=(fin - debut,) + forme_sortie[1:], order=ordre,
+                                                           mode="nearest", output=dtype)
+
+    debut = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nombre_de_threads) as executeur:
+        list(executeur.map(bloc, range(0, forme_sortie[0], taille_bloc)))
+    if Fichier_sortie is not None:
+        sortie.flush()
+    duree = time.perf_counter() - debut
+    print("{} -> {} ({:.2f} -> {:.2f} Mvoxels) en {:.1f} s".format(forme, forme_sortie, np.prod(forme) / 1e6,
+                                                                   np.prod(forme_sortie) / 1e6, duree))
+    return sortie
+
+
+#___________________________________________________________________________________________
+#___________________FONCTIONS POUR CREER LES PIPELINES D'ENTRAINEMENT________________________
+#___________________________________________________________________________________________
+
+#Laisse tf.data choisir le nombre de threads et la taille des tampons selon la machine
+AUTOTUNE = getattr(tf.data, "AUTOTUNE", tf.data.experimental.AUTOTUNE)
+
+#Extensions des images lues dans les sous-dossiers de classe, comme flow_from_directory
+EXTENSIONS_IMAGES = (".png", ".jpg", ".jpeg", ".bmp", ".gif")
+
+#Itérateurs en cours sur les tf.data.Dataset, pour que ComparaisonResultats puisse défiler d'un appel à l'autre
+_ITERATEURS_DATASETS = weakref.WeakKeyDictionary()
+
+
+def Liste_images_classes(Dossier, classes = None, validation_split = None, subset = None):
+    """
+    Liste les images d'un dossier organisé en un sous-dossier par classe, dans le même ordre et avec la même séparation
+    entrainement / validation que flow_from_directory de keras.
+
+    Parameters
+    ----------
+        - Dossier : string, dossier contenant un sous-dossier par classe
+        - classes : list, liste des sous-dossiers à utiliser, tous par ordre alphabétique si None
+        - validation_split : float entre 0 et 1, proportion des images de chaque classe réservée à la validation
+        - subset : 'training' ou 'validation', utilisé seulement avec validation_split
+
+    Returns
+    -------
+        - chemins : liste des chemins des images
+        - labels : liste des numéros de classe
+        - classes : liste des noms de classe, dans l'ordre des numéros
+
+    """
+    if classes is None:
+        classes = sorted(d for d in os.listdir(Dossier) if os.path.isdir(os.path.join(Dossier, d)))
+    chemins = []
+    labels = []
+    for numero, classe in enumerate(classes):
+        fichiers = sorted(f for f in os.listdir(os.path.join(Dossier, classe)) if f.lower().endswith(EXTENSIONS_IMAGES))
+        if validation_split:
+            separation = int(validation_split * len(fichiers))
+            fichiers = fichiers[:separation] if subset == "validation" else fichiers[separation:]
+        chemins += [os.path.join(Dossier, classe, f) for f in fichiers]
+        labels += [numero] * len(fichiers)
+    return chemins, labels, list(classes)
+
+
+def Dataset_depuis_dossier(Dossier,
+                           taille = (256,256),
+                           channels = 1,
+                           batch_size = 32,
+                           classes = None,
+                           validation_split = None,
+                           subset = None,
+                           melange = True,
+                           graine = 42,
+                           cache = True,
+                           taille_tampon_melange = 1000,
+                           rescale = 1/255.,
+                           interpolation = "bilinear"
+                          ):
+    """
+    Remplace flow_from_directory de keras par un pipeline tf.data : les images sont lues et redimensionnées en parallèle
+    par tensorflow, gardées en cache après la première epoch, mélangées, groupées en batchs et préparées pendant
+    que le réseau calcule le batch précédent (prefetch).
+    Le dataset s'utilise directement dans model.fit, model.predict, TransferLearning et ComparaisonResultats.
+    Il ne fait pas de data augmentation : voir Augmentation_dataset.
+
+    Parameters
+    ----------
+        - Dossier : string, dossier contenant un sous-dossier par classe (comme pour flow_from_directory)
+        - taille : tuple, (hauteur, largeur) des images en sortie
+        - channels : int, 1 pour des images en niveaux de gris, 3 pour les réseaux du transfer learning
+        - batch_size : int, nombre d'images par batch
+        - classes : list, liste des sous-dossiers à utiliser, tous par ordre alphabétique si None
+        - validation_split : float, proportion des images de chaque classe réservée à la validation
+        - subset : 'training' ou 'validation', utilisé seulement avec validation_split
+        - melange : boolean, mélange les images à chaque epoch (mettre False pour le jeu de test)
+        - graine : int, point de départ du mélange
+        - cache : True pour garder les images décodées en mémoire, string pour un fichier de cache sur le disque 
+        (utile si le dataset ne tient pas en mémoire), False pour relire les images à chaque epoch
+        - taille_tampon_melange : int, nombre d'images décodées parmi lesquelles le mélange est tiré quand le cache est utilisé
+        - rescale : float, facteur appliqué aux pixels, 1/255. ramène les png entre 0 et 1 comme dans le tutoriel
+        - interpolation : string, méthode de tf.image.resize : 'bilinear', 'nearest', 'area', 'bicubic'...
+
+    Returns
+    -------
+        - dataset : tf.data.Dataset de batchs (images, labels en one-hot)
+        - classes : liste des noms de classe, dans l'ordre des labels
+
+    """
+    chemins, labels, classes = Liste_images_classes(Dossier, classes, validation_split, subset)
+    if len(chemins) == 0:
+        raise ValueError("Aucune image trouvée dans {}".format(Dossier))
+    nombre_classes = len(classes)
+
+    def lecture(chemin, label):
+        image = tf.io.decode_image(tf.io.read_file(chemin), channels=channels, expand_animations=False)
+        image = tf.image.resize(image, taille, method=interpolation) * rescale
+        return image, tf.one_hot(label, nombre_classes)
+
+    dataset = tf.data.Dataset.from_tensor_slices((chemins, labels))
+    if cache is False:
+        #Sans cache, mélanger les chemins avant la lecture ne coûte presque rien
+        if melange:
+            dataset = dataset.shuffle(len(chemins), seed=graine, reshuffle_each_iteration=True)
+        dataset = dataset.map(lecture, num_parallel_calls=AUTOTUNE)
+    else:
+        dataset = dataset.map(lecture, num_parallel_calls=AUTOTUNE)
+        dataset = dataset.cache() if cache is True else dataset.cache(cache)
+        if melange:
+            dataset = dataset.shuffle(min(taille_tampon_melange, len(chemins)), seed=graine, reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size).prefetch(AUTOTUNE)
+    print("{} images trouvées, {} classes : {}".format(len(chemins), nombre_classes, classes))
+    return dataset, classes
+
+
+def Dataset_depuis_volumes(Fichiers_volume,
+                           Fichiers_masque = None,
+                           batch_size = 8,
+                           taille = None,
+                           melange = True,
+                           graine = 42,
+                           rescale = 1/255.
+                          ):
+    """
+    Crée un pipeline tf.data de coupes axiales à partir des volumes .npy écrits par Dossier_DICOM_vers_ImagesPNG
+    (ou Import_DICOM_parallele), avec leurs masques de segmentation éventuels pour U_Net.
+    Les volumes sont ouverts en memmap : seules les coupes de chaque batch sont lues sur le disque, en parallèle.
+
+    Parameters
+    ----------
+        - Fichiers_volume : liste des fichiers .npy des volumes
+        - Fichiers_masque : liste des fichiers .npy des masques, dans le même ordre, ou None
+        - batch_size : int, nombre de coupes par batch
+        - taille : tuple, (hauteur, largeur) si les coupes doivent être redimensionnées, None sinon
+        - melange : boolean, mélange les coupes à chaque epoch
+        - graine : int, point de départ du mélange
+        - rescale : float, facteur appliqué aux coupes (pas aux masques)
+
+    Returns
+    -------
+        - dataset : tf.data.Dataset de batchs de coupes (batch, hauteur, largeur, 1), ou de paires (coupes, masques)
+
+    """
+    volumes = [Ouvrir_volume(f) for f in Fichiers_volume]
+    masques = [Ouvrir_volume(f) for f in Fichiers_masque] if Fichiers_masque is not None else None
+    forme = volumes[0].shape[1:]
+    for volume in volumes:
+        if volume.shape[1:] != forme:
+            raise ValueError("Les volumes n'ont pas tous la même taille de coupe : {} et {}".format(forme, volume.shape[1:]))
+    numeros_volume = np.concatenate([np.full(len(v), i, dtype=np.int64) for i, v in enumerate(volumes)])
+    numeros_coupe = np.concatenate([np.arange(len(v), dtype=np.int64) for v in volumes])
+
+    def lecture_coupe(i, k):
+        coupe = np.asarray(volumes[i][k], dtype=np.float32)[..., None] * np.float32(rescale)
+        if masques is None:
+            return coupe
+        return coupe, np.asarray(masques[i][k], dtype=np.float32)[..., None]
+
+    def lecture(i, k):
+        if masques is None:
+            coupe = tf.numpy_function(lecture_coupe, [i, k], tf.float32)
+            coupe.set_shape(forme + (1,))
+            return coupe if taille is None else tf.image.resize(coupe, taille)
+        coupe, masque = tf.numpy_function(lecture_coupe, [i, k], [tf.float32, tf.float32])
+        coupe.set_shape(forme + (1,))
+        masque.set_shape(forme + (1,))
+        if taille is not None:
+            coupe = tf.image.resize(coupe, taille)
+            masque = tf.image.resize(masque, taille, method="nearest")
+        return coupe, masque
+
+    dataset = tf.data.Dataset.from_tensor_slices((numeros_volume, numeros_coupe))
+    if melange:
+        dataset = dataset.shuffle(len(numeros_coupe), seed=graine, reshuffle_each_iteration=True)
+    return dataset.map(lecture, num_parallel_calls=AUTOTUNE).batch(batch_size).prefetch(AUTOTUNE)
+
+
+def Augmentation_par_lot(images,
+                         masques = None,
+                         rotation = 15.,
+                         decalage = 0.2,
+                         zoom = 0.3,
+                         flip_horizontal = False,
+                         flip_vertical = False,
+                         jitter_contraste = 0.,
+                         jitter_luminosite = 0.,
+                         fenetre = None,
+                         jitter_fenetre = (0., 0.),
+                         generateur = None
+                        ):
+    """
+    Data augmentation d'un batch entier en une fois, avec numpy : rotation, décalage, zoom et flips sont réunis en une matrice
+    affine par image, puis tout le batch est rééchantillonné en une seule interpolation bilinéaire (les masques en plus proche voisin).
+    Les réglages par défaut reprennent ceux de l'ImageDataGenerator du tutoriel (rotation 15°, décalage 0.2, zoom 0.3, fill_mode 'nearest').
+
+    Parameters
+    ----------
+        - images : array numpy (batch, hauteur, largeur) ou (batch, hauteur, largeur, channels)
+        - masques : array numpy de même batch, hauteur et largeur que images (pour U_Net), ou None
+        - rotation : float, angle maximal de rotation en degrés
+        - decalage : float, décalage maximal en proportion de la hauteur et de la largeur
+        - zoom : float, les facteurs de zoom sont tirés entre 1 - zoom et 1 + zoom, indépendamment pour chaque axe
+        - flip_horizontal, flip_vertical : boolean, retourne la moitié des images selon cet axe
+        - jitter_contraste : float, les pixels sont multipliés par un facteur tiré entre 1 - jitter_contraste et 1 + jitter_contraste
+        - jitter_luminosite : float, ajoute une valeur tirée entre -jitter_luminosite et +jitter_luminosite
+        - fenetre : tuple (Global_Level, Global_Window) en UH si les images sont en UH : le fenêtrage est alors appliqué
+        après l'augmentation et la sortie est entre 0 et 1, comme WL_scaled
+        - jitter_fenetre : tuple (UH, UH), variation maximale du centre et de la largeur de la fenêtre, utilisée avec fenetre
+        - generateur : np.random.RandomState, rend l'augmentation reproductible ; un nouveau générateur aléatoire si None
+
+    Returns
+    -------
+        - images_augmentees : array numpy float32 de même forme que images
+        - masques_augmentes : array numpy de même forme et type que masques, seulement si masques est fourni
+
+    """
+    if generateur is None:
+        generateur = np.random.RandomState()
+    images = np.asarray(images, dtype=np.float32)
+    sans_channel = images.ndim == 3
+    if sans_channel:
+        images = images[..., None]
+    batch, hauteur, largeur, channels = images.shape
+
+    #Tirage des paramètres de chaque image du batch
+    angles = np.deg2rad(generateur.uniform(-rotation, rotation, batch))
+    zooms = generateur.uniform(1 - zoom, 1 + zoom, (batch, 2))
+    decalages = generateur.uniform(-decalage, decalage, (batch, 2)) * (hauteur, largeur)
+    signes = np.ones((batch, 2))
+    if flip_vertical:
+        signes[:, 0] = generateur.choice((-1., 1.), batch)
+    if flip_horizontal:
+        signes[:, 1] = generateur.choice((-1., 1.), batch)
+
+    #Matrices (batch, 2, 2) qui donnent, pour chaque pixel de sortie, sa position dans l'image d'origine
+    cos, sin = np.cos(angles), np.sin(angles)
+    matrices = np.stack([np.stack([cos, -sin], -1), np.stack([sin, cos], -1)], -2)
+    matrices = matrices * zooms[:, None, :] * signes[:, :, None]
+    matrices = matrices.astype(np.float32)
+    centre_l, centre_c = (hauteur - 1) / 2., (largeur - 1) / 2.
+    #La grille de sortie est séparable : les positions sources se calculent par simple diffusion (broadcasting), en float32
+    grille_l = (np.arange(hauteur, dtype=np.float32) - centre_l)[None, :, None]
+    grille_c = (np.arange(largeur, dtype=np.float32) - centre_c)[None, None, :]
+    origine = (np.array([centre_l, centre_c]) + decalages).astype(np.float32)
+    lignes = matrices[:, 0, 0, None, None] * grille_l + matrices[:, 0, 1, None, None] * grille_c + origine[:, 0, None, None]
+    colonnes = matrices[:, 1, 0, None, None] * grille_l + matrices[:, 1, 1, None, None] * grille_c + origine[:, 1, None, None]
+    #fill_mode 'nearest' : les positions hors de l'image prennent la valeur du bord. La borne haute est juste sous le dernier pixel
+    #pour que les 4 voisins de l'interpolation soient toujours dans l'image, sans test supplémentaire
+    np.clip(lignes, 0, np.nextafter(np.float32(hauteur - 1), np.float32(0)), out=lignes)
+    np.clip(colonnes, 0, np.nextafter(np.float32(largeur - 1), np.float32(0)), out=colonnes)
+    debut_batch = (np.arange(batch, dtype=np.intp) * hauteur * largeur)[:, None, None]
+
+    #Interpolation bilinéaire de tout le batch à partir des 4 voisins : les voisins de droite et du dessous sont lus
+    #dans des vues décalées du batch, avec les mêmes indices
+    l0 = np.floor(lignes)
+    c0 = np.floor(colonnes)
+    dl = lignes - l0
+    dc = colonnes - c0
+    haut_gauche = (l0 * largeur + c0).astype(np.intp)
+    haut_gauche += debut_batch
+    pixels = images.reshape(-1) if channels == 1 else images.reshape(-1, channels)
+    if channels > 1:
+        dl, dc = dl[..., None], dc[..., None]
+    gauche = np.take(pixels, haut_gauche, axis=0)
+    haut = gauche + (np.take(pixels[1:], haut_gauche, axis=0) - gauche) * dc
+    gauche = np.take(pixels[largeur:], haut_gauche, axis=0)
+    bas = gauche + (np.take(pixels[largeur + 1:], haut_gauche, axis=0) - gauche) * dc
+    images_augmentees = haut + (bas - haut) * dl
+    images_augmentees = images_augmentees.reshape(batch, hauteur, largeur, channels)
+
+    #Variations d'intensité
+    if jitter_contraste or jitter_luminosite:
+        contraste = generateur.uniform(1 - jitter_contraste, 1 + jitter_contraste, (batch, 1, 1, 1))
+        luminosite = generateur.uniform(-jitter_luminosite, jitter_luminosite, (batch, 1, 1, 1))
+        images_augmentees *= contraste.astype(np.float32)
+        images_augmentees += luminosite.astype(np.float32)
+    if fenetre is not None:
+        centres = fenetre[0] + generateur.uniform(-jitter_fenetre[0], jitter_fenetre[0], (batch, 1, 1, 1))
+        largeurs = fenetre[1] + generateur.uniform(-jitter_fenetre[1], jitter_fenetre[1], (batch, 1, 1, 1))
+        images_augmentees -= (centres - largeurs / 2.).astype(np.float32)
+        images_augmentees /= largeurs.astype(np.float32)
+        np.clip(images_augmentees, 0, 1, out=images_augmentees)
+
+    if sans_channel:
+        images_augmentees = images_augmentees[..., 0]
+    if masques is None:
+        return images_augmentees
+
+    #Les masques suivent la même transformation, au plus proche voisin pour garder des labels entiers
+    masques = np.asarray(masques)
+    voisins = (np.rint(lignes) * largeur + np.rint(colonnes)).astype(np.intp)
+    voisins += debut_batch
+    masques_augmentes = np.take(masques.reshape((batch * hauteur * largeur,) + masques.shape[3:]), voisins, axis=0)
+    return images_augmentees, masques_augmentes
+
+
+def Augmentation_dataset(dataset, masques = False, graine = 42, **parametres):
+    """
+    Ajoute Augmentation_par_lot à un tf.data.Dataset de batchs (par exemple celui de Dataset_depuis_dossier ou Dataset_depuis_volumes).
+    Les batchs sont augmentés un par un dans l'ordre, avec un seul générateur aléatoire : la suite des augmentations est donc
+    reproductible à partir de la graine, et différente à chaque epoch. Le prefetch fait travailler l'augmentation pendant
+    que le réseau calcule.
+
+    Parameters
+    ----------
+        - dataset : tf.data.Dataset de batchs (images, labels) ou (images, masques)
+        - masques : boolean, True si le deuxième élément est un masque à transformer avec les images (U_Net)
+        - graine : int, point de départ du générateur aléatoire
+        - parametres : réglages transmis à Augmentation_par_lot (rotation, decalage, zoom, flip_horizontal...)
+
+    Returns
+    -------
+        - dataset : tf.data.Dataset augmenté
+
+    """
+    generateur = np.random.RandomState(graine)
+
+    def augmentation_images(images):
+        return Augmentation_par_lot(images, generateur=generateur, **parametres)
+
+    def augmentation_paire(images, masques_batch):
+        images, masques_batch = Augmentation_par_lot(images, masques_batch, generateur=generateur, **parametres)
+        return images, masques_batch
+
+    def augmentation(x, y):
+        if masques:
+            x_augmente, y_augmente = tf.numpy_function(augmentation_paire, [x, y], [tf.float32, y.dtype])
+            y_augmente.set_shape(y.shape)
+        else:
+            x_augmente, y_augmente = tf.numpy_function(augmentation_images, [x], tf.float32), y
+        x_augmente.set_shape(x.shape)
+        return x_augmente, y_augmente
+
+    return dataset.map(augmentation).prefetch(AUTOTUNE)
+
+
+def _Positions_patchs(taille, taille_patch, pas):
+    """
+    Positions de départ des patchs le long d'un axe, en couvrant l'image jusqu'au bord.
+    """
+    positions = list(range(0, taille - taille_patch + 1, pas))
+    if positions[-1] != taille - taille_patch:
+        positions.append(taille - taille_patch)
+    return np.array(positions)
+
+
+def Index_patchs(Fichiers_masque, taille_patch = (256,256), pas = None, seuil = 1, taille_bloc = 16, Fichier_index = None):
+    """
+    Parcourt une fois les masques de segmentation et recense les patchs qui contiennent de la cible (positifs) ou non (négatifs),
+    sur une grille de pas régulier. Le calcul utilise une image intégrale par coupe : chaque patch est compté en 4 lectures.
+
+    Parameters
+    ----------
+        - Fichiers_masque : liste des chemins des masques .npy (même forme que les volumes correspondants)
+        - taille_patch : tuple, (hauteur, largeur) des patchs
+        - pas : int, écart entre deux positions de la grille, la moitié de la taille du patch si None
+        - seuil : int, nombre minimal de pixels de cible pour qu'un patch soit positif
+        - taille_bloc : int, nombre de coupes de masque lues à chaque fois
+        - Fichier_index : string, optionnel, fichier .npz où garder l'index ; il est relu tant que les masques et les réglages
+        n'ont pas changé
+
+    Returns
+    -------
+        - positifs : array numpy int32 (n, 4), une ligne par patch : numéro du volume, coupe, ligne et colonne du coin haut gauche
+        - negatifs : array numpy int32 (m, 4), idem pour les patchs sans cible
+
+    """
+    if pas is None:
+        pas = taille_patch[0] // 2
+    cle = json.dumps([[os.path.abspath(f), os.path.getmtime(f)] for f in Fichiers_masque] + [list(taille_patch), pas, seuil])
+    if Fichier_index is not None and not Fichier_index.endswith(".npz"):
+        Fichier_index += ".npz" #nom sous lequel np.savez l'enregistre
+    if Fichier_index is not None and os.path.exists(Fichier_index):
+        with np.load(Fichier_index) as index:
+            if str(index["cle"]) == cle:
+                return index["positifs"], index["negatifs"]
+
+    positifs, negatifs = [], []
+    for numero, fichier in enumerate(Fichiers_masque):
+        masque = Ouvrir_volume(fichier)
+        lignes = _Positions_patchs(masque.shape[1], taille_patch[0], pas)
+        colonnes = _Positions_patchs(masque.shape[2], taille_patch[1], pas)
+        for debut in range(0, len(masque), taille_bloc):
+            bloc = np.asarray(masque[debut:debut + taille_bloc]) > 0
+            integrale = np.zeros((len(bloc), bloc.shape[1] + 1, bloc.shape[2] + 1), dtype=np.int32)
+            np.cumsum(np.cumsum(bloc, axis=1, dtype=np.int32), axis=2, out=integrale[:, 1:, 1:])
+            haut, bas = lignes[:, None], lignes[:, None] + taille_patch[0]
+            gauche, droite = colonnes[None, :], colonnes[None, :] + taille_patch[1]
+            sommes = integrale[:, bas, droite] - integrale[:, haut, droite] - integrale[:, bas, gauche] + integrale[:, haut, gauche]
+            k, i, j = np.nonzero(sommes >= seuil)
+            positifs.append(np.stack([np.full(len(k), numero), k + debut, lignes[i], colonnes[j]], -1))
+            k, i, j = np.nonzero(sommes == 0)
+            negatifs.append(np.stack([np.full(len(k), numero), k + debut, lignes[i], colonnes[j]], -1))
+    positifs = np.concatenate(positifs).astype(np.int32)
+    negatifs = np.concatenate(negatifs).astype(np.int32)
+    if Fichier_index is not None:
+        np.savez(Fichier_index, positifs=positifs, negatifs=negatifs, cle=cle)
+    print("{} patchs avec cible, {} patchs sans cible".format(len(positifs), len(negatifs)))
+    return positifs, negatifs
+
+
+class SequencePatchs(keras.utils.Sequence):
+    """
+    Fournit à U_Net des batchs de patchs (image, masque) tirés dans des volumes et masques entiers, par exemple des patchs
+    256x256 dans des coupes 512x512, avec une proportion fixée de patchs contenant de la cible pour ne pas entrainer le réseau
+    presque uniquement sur du fond.
+    Les volumes sont ouverts en memmap : seule la région de chaque patch est lue sur le disque. Chaque batch ne dépend que de
+    l'epoch, de son numéro et de la graine, ce qui permet à keras de les préparer en parallèle :
+        model.fit(sequence, epochs=..., workers=4, use_multiprocessing=True)
+
+    Parameters
+    ----------
+        - Fichiers_volume : liste des chemins des volumes .npy
+        - Fichiers_masque : liste des chemins des masques .npy, dans le même ordre
+        - taille_patch : tuple, (hauteur, largeur), à accorder avec input_size de U_Net
+        - batch_size : int, nombre de patchs par batch
+        - proportion_positifs : float entre 0 et 1, proportion de patchs avec cible dans chaque batch
+        - patchs_par_epoch : int, nombre de patchs tirés par epoch, le nombre de patchs avec cible si None
+        - pas : int, pas de la grille des patchs (cf Index_patchs)
+        - seuil : int, nombre minimal de pixels de cible pour un patch positif
+        - decalage_aleatoire : boolean, déplace chaque patch d'au plus un demi-pas autour de sa position dans la grille
+        - rescale : float, facteur appliqué aux images (les volumes enregistrés par Dossier_DICOM_vers_ImagesPNG sont entre 0 et 255)
+        - augmentation : dict, optionnel, réglages d'Augmentation_par_lot appliqués à chaque batch
+        - graine : int, point de départ des tirages
+        - Fichier_index : string, optionnel, fichier .npz où garder l'index des patchs (cf Index_patchs)
+
+    """
+    def __init__(self, Fichiers_volume, Fichiers_masque, taille_patch = (256,256), batch_size = 16, proportion_positifs = 0.5,
+                 patchs_par_epoch = None, pas = None, seuil = 1, decalage_aleatoire = True, rescale = 1/255.,
+                 augmentation = None, graine = 42, Fichier_index = None):
+        super(SequencePatchs, self).__init__()
+        self.Fichiers_volume = list(Fichiers_volume)
+        self.Fichiers_masque = list(Fichiers_masque)
+        self.taille_patch = tuple(taille_patch)
+        self.batch_size = batch_size
+        self.proportion_positifs = proportion_positifs
+        self.pas = pas if pas is not None else taille_patch[0] // 2
+        self.decalage_aleatoire = decalage_aleatoire
+        self.rescale = rescale
+        self.augmentation = augmentation
+        self.graine = graine
+        self.epoch = 0
+        self.positifs, self.negatifs = Index_patchs(self.Fichiers_masque, self.taille_patch, self.pas, seuil,
+                                                    Fichier_index = Fichier_index)
+        if len(self.positifs) + len(self.negatifs) == 0:
+            raise ValueError("Aucun patch possible : les coupes sont plus petites que taille_patch")
+        self.patchs_par_epoch = patchs_par_epoch or max(len(self.positifs), batch_size)
+        self._volumes = {}
+
+    def __len__(self):
+        return int(np.ceil(self.patchs_par_epoch / self.batch_size))
+
+    def _ouverture(self, numero):
+        #Ouverture paresseuse : chaque processus de keras ouvre ses propres memmaps
+        if numero not in self._volumes:
+            self._volumes[numero] = (Ouvrir_volume(self.Fichiers_volume[numero]), Ouvrir_volume(self.Fichiers_masque[numero]))
+        return self._volumes[numero]
+
+    def __getstate__(self):
+        etat = self.__dict__.copy()
+        etat["_volumes"] = {}
+        return etat
+
+    def __getitem__(self, i):
+        generateur = np.random.RandomState([self.graine, self.epoch, i])
+        nombre = min(self.batch_size, self.patchs_par_epoch - i * self.batch_size)
+        nombre_positifs = generateur.binomial(nombre, self.proportion_positifs) if len(self.negatifs) else nombre
+        if len(self.positifs) == 0:
+            nombre_positifs = 0
+        tirage = np.concatenate([self.positifs[generateur.randint(len(self.positifs), size=nombre_positifs)],
+                                 self.negatifs[generateur.randint(max(len(self.negatifs), 1), size=nombre - nombre_positifs)]])
+
+        hauteur, largeur = self.taille_patch
+        images = np.empty((nombre, hauteur, largeur, 1), dtype=np.float32)
+        masques = np.empty((nombre, hauteur, largeur, 1), dtype=np.float32)
+        for n, (numero, k, l, c) in enumerate(tirage):
+            volume, masque = self._ouverture(numero)
+            if self.decalage_aleatoire:
+                l = int(np.clip(l + generateur.randint(-(self.pas // 2), self.pas // 2 + 1), 0, volume.shape[1] - hauteur))
+                c = int(np.clip(c + generateur.randint(-(self.pas // 2), self.pas // 2 + 1), 0, volume.shape[2] - largeur))
+            images[n, ..., 0] = volume[k, l:l + hauteur, c:c + largeur]
+            masques[n, ..., 0] = masque[k, l:l + hauteur, c:c + largeur]
+        images *= self.rescale
+
+        if self.augmentation is not None:
+            images, masques = Augmentation_par_lot(images, masques, generateur=generateur, **self.augmentation)
+        return images, masques
+
+    def on_epoch_end(self):
+        self.epoch += 1
+
+
+def _Etapes_par_epoch(generateur):
+    """
+    Nombre de batchs par epoch pour un generator keras ; None pour un tf.data.Dataset, que keras parcourt en entier à chaque epoch.
+    """
+    if isinstance(generateur, tf.data.Dataset):
+        return None
+    return generateur.n // generateur.batch_size
+
+
+def _Batch_suivant(generateur):
+    """
+    Renvoie le batch suivant d'un generator keras ou d'un tf.data.Dataset, en reprenant là où l'appel précédent s'était arrêté.
+    """
+    if not isinstance(generateur, tf.data.Dataset):
+        return generateur.next()
+    if generateur not in _ITERATEURS_DATASETS:
+        _ITERATEURS_DATASETS[generateur] = iter(generateur)
+    try:
+        batch = next(_ITERATEURS_DATASETS[generateur])
+    except StopIteration:
+        _ITERATEURS_DATASETS[generateur] = iter(generateur)
+        batch = next(_ITERATEURS_DATASETS[generateur])
+    return tuple(np.asarray(element) for element in batch)
+
+
+def Comparaison_debit_pipelines(pipelines, nombre_de_batchs = 50, echauffement = 2):
+    """
+    Mesure le débit en images par seconde de plusieurs pipelines d'entrée (generators keras et/ou tf.data.Dataset),
+    sans réseau : c'est la vitesse maximale à laquelle chacun peut nourrir l'entrainement.
+
+    Parameters
+    ----------
+        - pipelines : dict, {nom : generator ou dataset}
+        - nombre_de_batchs : int, nombre de batchs lus pour la mesure
+        - echauffement : int, nombre de batchs lus avant la mesure (remplissage du cache, démarrage des threads)
+
+    Returns
+    -------
+        - debits : dict, {nom : images par seconde}
+
+    """
+    debits = {}
+    for nom, pipeline in pipelines.items():
+        if isinstance(pipeline, tf.data.Dataset):
+            iterateur = iter(pipeline.repeat())
+        else:
+            iterateur = pipeline
+        for _ in range(echauffement):
+            next(iterateur)
+        nombre_images = 0
+        debut = time.perf_counter()
+        for _ in range(nombre_de_batchs):
+            batch = next(iterateur)
+            nombre_images += len(batch[0]) if isinstance(batch, tuple) else len(batch)
+        debits[nom] = nombre_images / (time.perf_counter() - debut)
+        print("{} : {:.1f} images/s".format(nom, debits[nom]))
+    return debits
+
 
 #___________________________________________________________________________________________
 #___________________FONCTIONS POUR CREER UN RESEAU DE NEURONES______________________________
 #___________________________________________________________________________________________
 
+#Politiques de précision de keras : 'mixed_bfloat16' fait les calculs en bfloat16 (plus rapide et deux fois moins de mémoire
+#pour les activations sur les processeurs récents et les TPU) en gardant les poids en float32 ; 'mixed_float16' est
+#l'équivalent pour les cartes graphiques. Les couches de sortie restent toujours en float32.
+PRECISIONS = ("float32", "mixed_bfloat16", "mixed_float16")
+
+
+def Reglage_precision(precision = "float32"):
+    """
+    Règle la politique de précision de keras pour les couches créées ensuite, quelle que soit la version de tensorflow.
+
+    Parameters
+    ----------
+        - precision : string, parmi PRECISIONS
+
+    """
+    if precision not in PRECISIONS:
+        raise ValueError("precision doit être parmi {}".format(PRECISIONS))
+    _Politique_globale(precision)
+
+
+def _Politique_globale(politique = None):
+    """
+    Renvoie la politique de précision globale de keras et, si politique est indiquée, la remplace.
+    """
+    if hasattr(tf.keras.mixed_precision, "set_global_policy"):
+        precedente = tf.keras.mixed_precision.global_policy()
+        if politique is not None:
+            tf.keras.mixed_precision.set_global_policy(politique)
+    else: #tensorflow < 2.4
+        precedente = tf.keras.mixed_precision.experimental.global_policy()
+        if politique is not None:
+            tf.keras.mixed_precision.experimental.set_policy(politique)
+    return precedente
+
+
+def _Avec_precision(fonction):
+    """
+    Décorateur des fonctions qui créent un réseau avec un argument precision : la politique demandée ne vaut que pendant
+    la création, la politique globale d'avant est rétablie ensuite. Les couches créées gardent leur propre précision.
+    """
+    parametres = inspect.signature(fonction)
+    @functools.wraps(fonction)
+    def fonction_avec_precision(*args, **kwargs):
+        arguments = parametres.bind(*args, **kwargs)
+        arguments.apply_defaults()
+        precedente = _Politique_globale()
+        try:
+            Reglage_precision(arguments.arguments["precision"])
+            return fonction(*args, **kwargs)
+        finally:
+            _Politique_globale(precedente)
+    return fonction_avec_precision
+
+
+def _Options_compilation(xla = False):
+    """
+    Options à passer à model.compile pour activer la compilation XLA : jit_compile pour tensorflow >= 2.5,
+    sinon réglage global de tensorflow.
+    """
+    if "jit_compile" in inspect.signature(tf.keras.Model.compile).parameters:
+        return {"jit_compile" : bool(xla)}
+    tf.config.optimizer.set_jit(bool(xla))
+    return {}
 
 
+@_Avec_precision
 def U_Net(input_size = (256,256,1), #Correspond à la taille des images utilisées
-         initial = 64 #Le nombre de features maps utilisé au départ
+         initial = 64, #Le nombre de features maps utilisé au départ
+         precision = "float32",
+         xla = False
         ):
     """
     Crée un réseau de type U-net pour la segmentation
@@ -362,6 +2853,8 @@ def U_Net(input_size = (256,256,1), #Correspond à la taille des images utilisé
     ----------
         - input_size : la taille des images à utiliser et le nombre de channels couleur (1 pour les DICOM)
         - initial : nombre de feature map à utiliser au déaprt (allourdit le réseau)
+        - precision : string, parmi PRECISIONS, 'mixed_bfloat16' accélère les calculs sur les processeurs qui le permettent
+        - xla : boolean, compile le réseau avec XLA
         
     Returns
     -------
@@ -374,6 +2867,10 @@ def U_Net(input_size = (256,256,1), #Correspond à la taille des images utilisé
     - l'optimizer
     
     """
+    if xla: #le gradient de UpSampling2D n'est pas compilable par XLA sur CPU, répéter les pixels donne le même résultat
+        UpSampling = lambda size : Lambda(lambda x : K.repeat_elements(K.repeat_elements(x, size[0], 1), size[1], 2))
+    else:
+        UpSampling = UpSampling2D
     inputs = Input(input_size)
     
     conv1 = Conv2D(initial, 3, activation = 'relu', padding = 'same', kernel_initializer = 'he_normal')(inputs)
@@ -397,30 +2894,30 @@ def U_Net(input_size = (256,256,1), #Correspond à la taille des images utilisé
     conv5 = Conv2D(initial * 16, 3, activation = 'relu', padding = 'same', kernel_initializer = 'he_normal')(conv5)
     drop5 = Dropout(0.5)(conv5)
 
-    up6 = Conv2D(initial * 8, 2, activation = 'relu', padding = 'same', kernel_initializer = 'he_normal')(UpSampling2D(size = (2,2))(drop5))
+    up6 = Conv2D(initial * 8, 2, activation = 'relu', padding = 'same', kernel_initializer = 'he_normal')(UpSampling(size = (2,2))(drop5))
     merge6 = concatenate([drop4,up6], axis = 3)
     conv6 = Conv2D(initial * 8, 3, activation = 'relu', padding = 'same', kernel_initializer = 'he_normal')(merge6)
     conv6 = Conv2D(initial * 8, 3, activation = 'relu', padding = 'same', kernel_initializer = 'he_normal')(conv6)
 
-    up7 = Conv2D(initial * 4, 2, activation = 'relu', padding = 'same', kernel_initializer = 'he_normal')(UpSampling2D(size = (2,2))(conv6))
+    up7 = Conv2D(initial * 4, 2, activation = 'relu', padding = 'same', kernel_initializer = 'he_normal')(UpSampling(size = (2,2))(conv6))
     merge7 = concatenate([conv3,up7], axis = 3)
     conv7 = Conv2D(initial * 4, 3, activation = 'relu', padding = 'same', kernel_initializer = 'he_normal')(merge7)
     conv7 = Conv2D(initial * 4, 3, activation = 'relu', padding = 'same', kernel_initializer = 'he_normal')(conv7)
 
-    up8 = Conv2D(initial * 2, 2, activation = 'relu', padding = 'same', kernel_initializer = 'he_normal')(UpSampling2D(size = (2,2))(conv7))
+    up8 = Conv2D(initial * 2, 2, activation = 'relu', padding = 'same', kernel_initializer = 'he_normal')(UpSampling(size = (2,2))(conv7))
     merge8 = concatenate([conv2,up8], axis = 3)
     conv8 = Conv2D(initial * 2, 3, activation = 'relu', padding = 'same', kernel_initializer = 'he_normal')(merge8)
     conv8 = Conv2D(initial * 2, 3, activation = 'relu', padding = 'same', kernel_initializer = 'he_normal')(conv8)
 
-    up9 = Conv2D(initial, 2, activation = 'relu', padding = 'same', kernel_initializer = 'he_normal')(UpSampling2D(size = (2,2))(conv8))
+    up9 = Conv2D(initial, 2, activation = 'relu', padding = 'same', kernel_initializer = 'he_normal')(UpSampling(size = (2,2))(conv8))
     merge9 = concatenate([conv1,up9], axis = 3)
     conv9 = Conv2D(initial, 3, activation = 'relu', padding = 'same', kernel_initializer = 'he_normal')(merge9)
     conv9 = Conv2D(initial, 3, activation = 'relu', padding = 'same', kernel_initializer = 'he_normal')(conv9)
     conv9 = Conv2D(2, 3, activation = 'relu', padding = 'same', kernel_initializer = 'he_normal')(conv9)
-    conv10 = Conv2D(1, 1, activation = 'sigmoid')(conv9)
+    conv10 = Conv2D(1, 1, activation = 'sigmoid', dtype = 'float32')(conv9) #sortie et loss en float32 quelle que soit la précision
 
     model = Model(inputs = inputs, outputs = conv10)
-    model.compile(optimizer = Adam(lr = 1e-4), loss = 'binary_crossentropy', metrics = ['accuracy'])
+    model.compile(optimizer = Adam(lr = 1e-4), loss = 'binary_crossentropy', metrics = ['accuracy'], **_Options_compilation(xla))
 
     return model
 
@@ -474,6 +2971,7 @@ def Create_block(model,
     return model
 
 
+@_Avec_precision
 def build_cnn(entree,
               sortie,
               optimizer = "Adam",
@@ -484,7 +2982,9 @@ def build_cnn(entree,
               activation = "relu",
               dropout_rate = .5,
               batch_Norm = False,
-              couche_entierement_connectee = 64
+              couche_entierement_connectee = 64,
+              precision = "float32",
+              xla = False
               ):
     
     """
@@ -505,6 +3005,8 @@ def build_cnn(entree,
         - dropout_rate : float entre 0. et 0.5 , a noter que la première couche voit son dropout divisé par 2.5, soit entre 0 et 0.2
         - batch_Norm : boolean, active une normalisation par batch à chque bloc
         - couche_entierement_connectee : int, nombre de neurones de la couche Dense finale
+        - precision : string, parmi PRECISIONS, 'mixed_bfloat16' accélère les calculs sur les processeurs qui le permettent
+        - xla : boolean, compile le réseau avec XLA
         
         
     Returns
@@ -517,7 +3019,7 @@ def build_cnn(entree,
         activation = Activation(LeakyReLU(alpha=0.2))
     elif activation == "gelu": #d'après https://arxiv.org/pdf/1606.08415.pdf
         def gelu(x):
-            return 0.5 * x * (1 + tf.tanh(tf.sqrt(2 / np.pi) * (x + 0.044715 * tf.pow(x, 3))))
+            return 0.5 * x * (1 + tf.tanh(np.sqrt(2 / np.pi) * (x + 0.044715 * tf.pow(x, 3))))
         activation =  Activation(gelu)
     
     #Réglage de l'optimizer :
@@ -570,7 +3072,7 @@ def build_cnn(entree,
             model.add(Dense(1, activation='sigmoid'))
         else : 
             model.add(Dense(sortie, activation='softmax'))"""
-        model.add(Dense(sortie, activation='softmax'))
+        model.add(Dense(sortie, activation='softmax', dtype='float32'))
         
     else:
         #1er bloc :
@@ -600,7 +3102,7 @@ def build_cnn(entree,
             model.add(Dense(1, activation='sigmoid'))
         else : 
             model.add(Dense(sortie, activation='softmax'))"""
-        model.add(Dense(sortie, activation='softmax'))
+        model.add(Dense(sortie, activation='softmax', dtype='float32'))
     
     """if sortie ==2:        
         model.compile(
@@ -617,56 +3119,88 @@ def build_cnn(entree,
     model.compile(
             loss='categorical_crossentropy', 
             optimizer=optimizer, 
-            metrics=['accuracy'])
+            metrics=['accuracy'],
+            **_Options_compilation(xla))
     print(model.summary())
     return model
 
 
-def TransferLearning(entree,
-                     sortie,
-                     training_generator, 
-                     validation_generator,
-                     nombre_epochs_avant_finetuning,
-                     nombre_epochs_apres_finetuning,
-                     Model_dOrigine       = "Xception", #
-                     optimizer            = ["Adam","RMSprop"],
-                     Learning_rate_custom = [None,None],
-                     class_weight         = None
-                    ):
-        
+def Extraction_features(extracteur, donnees, copies = 1, Fichier_features = None, identifiant = None):
+    """
+    Passe une seule fois les images dans un réseau gelé et garde les features obtenues (avec les labels), pour entrainer
+    ensuite les dernières couches sans refaire ce calcul à chaque epoch.
+
+    Parameters
+    ----------
+        - extracteur : model keras, le réseau gelé (par exemple base_model suivi de son pooling)
+        - donnees : generator keras ou tf.data.Dataset de batchs (images, labels)
+        - copies : int, nombre de passages sur les données ; avec un generator qui fait de la data augmentation, chaque passage
+        donne une version augmentée différente de chaque image
+        - Fichier_features : string, optionnel, fichier .npz où garder les features ; il est relu s'il a été créé avec le même identifiant
+        - identifiant : string, décrit le réseau et les données (cf TransferLearning) : sans identifiant le fichier n'est jamais relu
+
+    Returns
+    -------
+        - features : array numpy float32 (nombre d'images * copies, ...)
+        - labels : array numpy des labels correspondants
+
+    """
+    if Fichier_features is not None and identifiant is not None and os.path.exists(Fichier_features):
+        with np.load(Fichier_features) as sauvegarde:
+            if str(sauvegarde["identifiant"]) == identifiant:
+                print("Features relues dans {}".format(Fichier_features))
+                return sauvegarde["features"], sauvegarde["labels"]
+
+    debut = time.perf_counter()
+    features, labels = [], []
+    for _ in range(copies):
+        if isinstance(donnees, tf.data.Dataset):
+            batchs = iter(donnees)
+        else:
+            donnees.reset()
+            batchs = (donnees.next() for _ in range(int(np.ceil(donnees.n / donnees.batch_size))))
+        for x, y in batchs:
+            features.append(np.asarray(extracteur.predict_on_batch(x), dtype=np.float32))
+            labels.append(np.asarray(y))
+    features, labels = np.concatenate(features), np.concatenate(labels)
+    print("Features de {} images calculées en {:.1f} s".format(len(features), time.perf_counter() - debut))
+    if Fichier_features is not None:
+        np.savez(Fichier_features, features=features, labels=labels, identifiant=str(identifiant))
+    return features, labels
+
+
+def _Identifiant_donnees(donnees):
+    """
+    Empreinte des fichiers lus par un generator keras (flow_from_directory), None si elle n'est pas connue (tf.data.Dataset).
+    """
+    if not hasattr(donnees, "filepaths"):
+        return None
+    empreinte = hashlib.sha1()
+    for chemin in donnees.filepaths:
+        empreinte.update("{}:{}".format(chemin, os.path.getmtime(chemin)).encode())
+    return empreinte.hexdigest()
+
+
+def Modele_transfert(entree, sortie, Model_dOrigine = "Xception", poids = "imagenet"):
     """
-    Crée un réseau de type CNN pour la labellisation
+    Construit le réseau utilisé par TransferLearning : le réseau pré-entrainé, gelé, suivi des couches ajoutées pour nos classes.
 
     Parameters
     ----------
-        - entree : tuple, la taille des images à utiliser et le nombre de channels couleur (3 obligatoires !)
-        a noter que si la taille est laissée libre, ces réseaux ont été entrainés sur des images d'une définition prédéfinie et 
-        fonctionneront mieux sur des images de taille proche :
-            VGG16 et VGG19 : 224*224
-            Xception : 299*299
-        - sortie : int, le nombre de classes voulues en sortie, correspond au nombre de sous dossiers si vous utilisez keras.
-        - training_generator : generator keras, correspondant au training
-        - validation_generator : generator keras, correspondant à la validation
-        - nombre_epochs_avant_finetuning : int, 2 à 8 epochs suffiront probablement
-        - nombre_epochs_apres_finetuning : int, nombre après finetuning
+        - entree : tuple, la taille des images et le nombre de channels couleur (3 obligatoires !)
+        - sortie : int, le nombre de classes voulues en sortie
         - Model_dOrigine : parmi : "Xception", "InceptionV3", "ResNet50", "VGG16", "VGG19", "MobileNetV2"
-        - optimizer : liste de 2x string, nom de l'optimizer pour avant et après fine-tuning. Selon Tensorflow, exemples : 
-        'Adam','Adamax','Nadam','RMSprop','SGD'
-        - Learning_rate_custom = liste de 2x string ou 'None', modifie le learning rate pour avant et après fine-tuning, disponible 
-        uniquement pour les  optimizer suivants : parmi ['Adam','Adamax','Nadam','RMSprop','SGD'],  'None' prend le learning rate par 
-        défaut défini dans le code de Tensorflow
-        - class_weight : dict, pondérations à appliquer sur les classes.
-        
+        - poids : 'imagenet' pour les réglages pré-entrainés, None pour des réglages aléatoires (mesures de vitesse sans téléchargement)
+
     Returns
     -------
-        - model : le réseau prêt, après entrainement
-        - hist1 : history avant fine tuning
-        - hist2 : history après fine tuning
-    
+        - model : le réseau complet, non compilé
+        - base_model : le réseau pré-entrainé inclus dans model
+
     """
     # Pre-trained model
     if Model_dOrigine == "Xception" :
-        base_model = tf.keras.applications.Xception(input_shape=entree,include_top=False, pooling='avg',weights='imagenet')
+        base_model = tf.keras.applications.Xception(input_shape=entree,include_top=False, pooling='avg',weights=poids)
         base_model.trainable = False
         model = tf.keras.Sequential([
             base_model,
@@ -676,7 +3210,7 @@ def TransferLearning(entree,
         ])
         
     elif Model_dOrigine == "InceptionV3" :
-        base_model = tf.keras.applications.InceptionV3(input_shape=entree,include_top=False,weights='imagenet')
+        base_model = tf.keras.applications.InceptionV3(input_shape=entree,include_top=False,weights=poids)
         base_model.trainable = False
         model = tf.keras.Sequential([
             base_model,
@@ -687,7 +3221,7 @@ def TransferLearning(entree,
         ])
             
     elif Model_dOrigine == "ResNet50" :
-        base_model = tf.keras.applications.ResNet50(input_shape=entree,include_top=False,weights='imagenet')
+        base_model = tf.keras.applications.ResNet50(input_shape=entree,include_top=False,weights=poids)
         base_model.trainable = False
         model = tf.keras.Sequential([
             base_model,
@@ -699,7 +3233,7 @@ def TransferLearning(entree,
         ])
         
     elif Model_dOrigine == "VGG16" :
-        base_model = tf.keras.applications.VGG16(input_shape=entree,include_top=False,weights='imagenet')
+        base_model = tf.keras.applications.VGG16(input_shape=entree,include_top=False,weights=poids)
         base_model.trainable = False
         model = tf.keras.Sequential([
             base_model,
@@ -711,7 +3245,7 @@ def TransferLearning(entree,
         ])
         
     elif Model_dOrigine == "VGG19" :
-        base_model = tf.keras.applications.VGG16(input_shape=entree,include_top=False,weights='imagenet')
+        base_model = tf.keras.applications.VGG16(input_shape=entree,include_top=False,weights=poids)
         base_model.trainable = False
         model = tf.keras.Sequential([
             base_model,
@@ -723,7 +3257,7 @@ def TransferLearning(entree,
         ])
 
     elif Model_dOrigine == "MobileNetV2" :
-        base_model = tf.keras.applications.MobileNetV2(input_shape=entree,include_top=False,weights='imagenet')
+        base_model = tf.keras.applications.MobileNetV2(input_shape=entree,include_top=False,weights=poids)
         base_model.trainable = False
         model = tf.keras.Sequential([
             base_model,
@@ -741,7 +3275,66 @@ def TransferLearning(entree,
         model.add(Dense(1, activation='sigmoid'))
     else : 
         model.add(Dense(sortie, activation='softmax'))"""
-    model.add(Dense(sortie, activation='softmax'))    
+    model.add(Dense(sortie, activation='softmax', dtype='float32')) #sortie et loss en float32 quelle que soit la précision
+    return model, base_model
+
+
+@_Avec_precision
+def TransferLearning(entree,
+                     sortie,
+                     training_generator, 
+                     validation_generator,
+                     nombre_epochs_avant_finetuning,
+                     nombre_epochs_apres_finetuning,
+                     Model_dOrigine       = "Xception", #
+                     optimizer            = ["Adam","RMSprop"],
+                     Learning_rate_custom = [None,None],
+                     class_weight         = None,
+                     Dossier_features     = None,
+                     copies_augmentees    = 1,
+                     precision            = "float32",
+                     xla                  = False
+                    ):
+        
+    """
+    Crée un réseau de type CNN pour la labellisation
+
+    Parameters
+    ----------
+        - entree : tuple, la taille des images à utiliser et le nombre de channels couleur (3 obligatoires !)
+        a noter que si la taille est laissée libre, ces réseaux ont été entrainés sur des images d'une définition prédéfinie et 
+        fonctionneront mieux sur des images de taille proche :
+            VGG16 et VGG19 : 224*224
+            Xception : 299*299
+        - sortie : int, le nombre de classes voulues en sortie, correspond au nombre de sous dossiers si vous utilisez keras.
+        - training_generator : generator keras ou tf.data.Dataset (cf Dataset_depuis_dossier), correspondant au training
+        - validation_generator : generator keras ou tf.data.Dataset, correspondant à la validation
+        - nombre_epochs_avant_finetuning : int, 2 à 8 epochs suffiront probablement
+        - nombre_epochs_apres_finetuning : int, nombre après finetuning
+        - Model_dOrigine : parmi : "Xception", "InceptionV3", "ResNet50", "VGG16", "VGG19", "MobileNetV2"
+        - optimizer : liste de 2x string, nom de l'optimizer pour avant et après fine-tuning. Selon Tensorflow, exemples : 
+        'Adam','Adamax','Nadam','RMSprop','SGD'
+        - Learning_rate_custom = liste de 2x string ou 'None', modifie le learning rate pour avant et après fine-tuning, disponible 
+        uniquement pour les  optimizer suivants : parmi ['Adam','Adamax','Nadam','RMSprop','SGD'],  'None' prend le learning rate par 
+        défaut défini dans le code de Tensorflow
+        - class_weight : dict, pondérations à appliquer sur les classes.
+        - Dossier_features : string, optionnel. Si indiqué, l'entrainement avant fine-tuning se fait sur des features calculées une
+        seule fois : les images passent une fois dans le réseau gelé, les features sont enregistrées dans ce dossier, puis seules
+        les dernières couches sont entrainées sur elles (quelques secondes par epoch au lieu d'un passage complet dans le réseau).
+        Les features sont relues lors d'un nouvel appel avec le même réseau et les mêmes images (generators keras uniquement).
+        - copies_augmentees : int, avec Dossier_features, nombre de versions (augmentées par le generator) de chaque image
+        d'entrainement dont les features sont calculées
+        - precision : string, parmi PRECISIONS, 'mixed_bfloat16' accélère les calculs sur les processeurs qui le permettent
+        - xla : boolean, compile le réseau avec XLA
+        
+    Returns
+    -------
+        - model : le réseau prêt, après entrainement
+        - hist1 : history avant fine tuning (None si nombre_epochs_avant_finetuning vaut 0)
+        - hist2 : history après fine tuning
+    
+    """
+    model, base_model = Modele_transfert(entree, sortie, Model_dOrigine)
 
     
     print(model.summary())
@@ -749,6 +3342,7 @@ def TransferLearning(entree,
     """
     Entrainement avant fine tuning : le réseau utilisé pour le transfer learning n'est pas entrainé durant cette partie.
     """
+    hist1 = None
     if nombre_epochs_avant_finetuning == 0 :
         print("Il n'est pas réalisé d'entrainement avant fine-tuning.")
     
@@ -779,20 +3373,56 @@ def TransferLearning(entree,
                 optimizer=optimizer[0], 
                 metrics=['accuracy']
             )"""
-        model.compile(
-                loss='categorical_crossentropy', 
-                optimizer=optimizer[0], 
-                metrics=['accuracy'])
+        if Dossier_features is None :
+            model.compile(
+                    loss='categorical_crossentropy', 
+                    optimizer=optimizer[0], 
+                    metrics=['accuracy'],
+                    **_Options_compilation(xla))
+
+            hist1 = model.fit(training_generator,
+                                           steps_per_epoch=_Etapes_par_epoch(training_generator),
+                                           epochs=nombre_epochs_avant_finetuning,
+                                           validation_data=validation_generator,
+                                           validation_steps=_Etapes_par_epoch(validation_generator),
+                                           class_weight=class_weight)
+        else :
+            #Le réseau gelé et les couches sans paramètres qui le suivent (pooling, flatten) ne changent pas pendant cette
+            #phase : leurs sorties sont calculées une fois. Les couches suivantes, partagées avec model, sont entrainées seules.
+            couches = model.layers[1:]
+            nombre_fixes = 0
+            while not couches[nombre_fixes].weights and not isinstance(couches[nombre_fixes], Dropout):
+                nombre_fixes += 1
+            extracteur = tf.keras.Sequential([base_model] + couches[:nombre_fixes])
+            os.makedirs(Dossier_features, exist_ok=True)
+            description = "{}_{}x{}x{}".format(Model_dOrigine, *entree)
+            identifiant_entrainement = _Identifiant_donnees(training_generator)
+            identifiant_validation = _Identifiant_donnees(validation_generator)
+            features_entrainement, labels_entrainement = Extraction_features(
+                extracteur, training_generator, copies_augmentees,
+                os.path.join(Dossier_features, "features_entrainement_{}.npz".format(description)),
+                None if identifiant_entrainement is None else "{}_{}_{}".format(description, copies_augmentees, identifiant_entrainement))
+            features_validation, labels_validation = Extraction_features(
+                extracteur, validation_generator, 1,
+                os.path.join(Dossier_features, "features_validation_{}.npz".format(description)),
+                None if identifiant_validation is None else "{}_{}".format(description, identifiant_validation))
 
-        hist1 = model.fit(training_generator,
-                                       steps_per_epoch=training_generator.n//training_generator.batch_size,
-                                       epochs=nombre_epochs_avant_finetuning,
-                                       validation_data=validation_generator,
-                                       validation_steps=validation_generator.n//validation_generator.batch_size,
-                                       class_weight=class_weight)
+            tete = tf.keras.Sequential([Input(features_entrainement.shape[1:])] + couches[nombre_fixes:])
+            tete.compile(
+                    loss='categorical_crossentropy', 
+                    optimizer=optimizer[0], 
+                    metrics=['accuracy'],
+                    **_Options_compilation(xla))
+            hist1 = tete.fit(features_entrainement, labels_entrainement,
+                             batch_size=getattr(training_generator, "batch_size", 32),
+                             epochs=nombre_epochs_avant_finetuning,
+                             validation_data=(features_validation, labels_validation),
+                             class_weight=class_weight)
 
-        training_generator.reset()
-        validation_generator.reset()
+        #un tf.data.Dataset repart de lui-même du début à chaque epoch
+        for generateur in (training_generator, validation_generator):
+            if hasattr(generateur, "reset"):
+                generateur.reset()
 
 
     """
@@ -847,15 +3477,16 @@ def TransferLearning(entree,
     model.compile(
             loss='categorical_crossentropy', 
             optimizer=optimizer[1], 
-            metrics=['accuracy'])
+            metrics=['accuracy'],
+            **_Options_compilation(xla))
     
 
     # Entrainement
     hist2 = model.fit(training_generator,
-                                   steps_per_epoch=training_generator.n//training_generator.batch_size,
+                                   steps_per_epoch=_Etapes_par_epoch(training_generator),
                                    epochs=nombre_epochs_apres_finetuning,
                                    initial_epoch = nombre_epochs_avant_finetuning,
-                                   validation_steps=validation_generator.n//validation_generator.batch_size,
+                                   validation_steps=_Etapes_par_epoch(validation_generator),
                                    validation_data=validation_generator,
                                    class_weight=class_weight)
     
@@ -864,7 +3495,493 @@ def TransferLearning(entree,
     return model, hist1, hist2
 
 
-def ComparaisonResultats(Nombre_a_afficher, model, test_gen, categories, color="gray", colonnes=2, reset=False):
+def Memoire_max_Mo():
+    """
+    Pic de mémoire résidente du processus depuis son lancement, en Mo (None si indisponible, sous Windows).
+    """
+    if resource is None:
+        return None
+    pic = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if platform.system() == "Darwin": #en octets sur macOS, en ko sous Linux
+        return pic / 1e6
+    return pic / 1e3
+
+
+def _Mesure_precision(configuration):
+    """
+    Mesure exécutée dans un processus séparé par Benchmark_precision : construit le réseau avec la précision demandée,
+    fait quelques pas d'entrainement sur des données aléatoires et affiche le résultat en JSON sur la dernière ligne.
+    """
+    configuration = json.loads(configuration)
+    taille, batch_size = configuration["taille"], configuration["batch_size"]
+    if configuration["modele"] == "build_cnn":
+        model = build_cnn((taille, taille, 1), 3, nombre_de_blocs=3, precision=configuration["precision"], xla=configuration["xla"])
+        x, y = np.random.rand(batch_size, taille, taille, 1), np.eye(3)[np.random.randint(3, size=batch_size)]
+    elif configuration["modele"] == "U_Net":
+        model = U_Net((taille, taille, 1), initial=16, precision=configuration["precision"], xla=configuration["xla"])
+        x, y = np.random.rand(batch_size, taille, taille, 1), np.random.rand(batch_size, taille, taille, 1) > 0.5
+    else:
+        Reglage_precision(configuration["precision"])
+        model, base_model = Modele_transfert((taille, taille, 3), 3, configuration["modele_transfert"], poids=None)
+        base_model.trainable = True #mesure de la phase la plus coûteuse, le fine-tuning
+        model.compile(loss='categorical_crossentropy', optimizer="Adam", **_Options_compilation(configuration["xla"]))
+        x, y = np.random.rand(batch_size, taille, taille, 3), np.eye(3)[np.random.randint(3, size=batch_size)]
+    x, y = x.astype(np.float32), y.astype(np.float32)
+    for _ in range(2): #le premier pas construit (et compile avec XLA) le graphe de calcul
+        model.train_on_batch(x, y)
+    debut = time.perf_counter()
+    for _ in range(configuration["nombre_de_pas"]):
+        model.train_on_batch(x, y)
+    duree = (time.perf_counter() - debut) / configuration["nombre_de_pas"]
+    resultat = {"secondes_par_pas" : duree, "images_par_seconde" : batch_size / duree, "memoire_max_Mo" : Memoire_max_Mo()}
+    print("RESULTAT " + json.dumps(resultat))
+
+
+def Benchmark_precision(modeles = ("build_cnn", "U_Net", "TransferLearning"),
+                        precisions = ("float32", "mixed_bfloat16"),
+                        xla = (False, True),
+                        taille = 128,
+                        batch_size = 8,
+                        nombre_de_pas = 10,
+                        modele_transfert = "MobileNetV2"
+                       ):
+    """
+    Compare, pour chaque réseau, la durée d'un pas d'entrainement et la mémoire maximale utilisée selon la précision et XLA.
+    Chaque mesure est faite dans un processus python séparé, car la politique de précision et XLA sont des réglages globaux
+    de tensorflow et la mémoire maximale ne peut être mesurée que pour un processus entier.
+
+    Parameters
+    ----------
+        - modeles : liste parmi 'build_cnn', 'U_Net', 'TransferLearning'
+        - precisions : liste parmi PRECISIONS
+        - xla : liste de boolean
+        - taille : int, hauteur et largeur des images
+        - batch_size : int, nombre d'images par pas d'entrainement
+        - nombre_de_pas : int, nombre de pas mesurés (après 2 pas d'échauffement)
+        - modele_transfert : string, réseau pré-entrainé utilisé pour 'TransferLearning' (cf Modele_transfert), avec des poids aléatoires
+
+    Returns
+    -------
+        - resultats : dataframe pandas, une ligne par mesure : 'modele', 'precision', 'xla', 'secondes_par_pas',
+        'images_par_seconde', 'memoire_max_Mo', 'erreur'
+
+    """
+    dossier = os.path.dirname(os.path.abspath(__file__))
+    resultats = []
+    for modele in modeles:
+        for precision in precisions:
+            for avec_xla in xla:
+                configuration = json.dumps({"modele" : modele, "precision" : precision, "xla" : avec_xla, "taille" : taille,
+                                            "batch_size" : batch_size, "nombre_de_pas" : nombre_de_pas,
+                                            "modele_transfert" : modele_transfert})
+                commande = "import sys; sys.path.insert(0, {!r}); import FunctionsMaster; FunctionsMaster._Mesure_precision({!r})".format(
+                    dossier, configuration)
+                processus = subprocess.run([sys.executable, "-c", commande], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                           universal_newlines=True)
+                ligne = {"modele" : modele, "precision" : precision, "xla" : avec_xla, "secondes_par_pas" : None,
+                         "images_par_seconde" : None, "memoire_max_Mo" : None, "erreur" : None}
+                lignes_resultat = [l for l in processus.stdout.splitlines() if l.startswith("RESULTAT ")]
+                if lignes_resultat:
+                    ligne.update(json.loads(lignes_resultat[-1][len("RESULTAT "):]))
+                else:
+                    erreurs = [l for l in processus.stderr.splitlines() if "Error" in l and not l.startswith(" ")] #ligne de l'exception
+                    ligne["erreur"] = (erreurs or ["code de sortie {}".format(processus.returncode)])[-1]
+                print("{} {} xla={} : {}".format(modele, precision, avec_xla,
+                      ligne["erreur"] or "{:.3f} s/pas, {} Mo".format(ligne["secondes_par_pas"], ligne["memoire_max_Mo"] and round(ligne["memoire_max_Mo"]))))
+                resultats.append(ligne)
+    return pandas.DataFrame(resultats)
+
+
+#Valeurs essayées par défaut par Recherche_hyperparametres pour chaque paramètre de build_cnn
+ESPACE_RECHERCHE = {"nombre_de_blocs"             : [1, 2, 3, 4],
+                    "feature_maps"                : [16, 32, 64],
+                    "Kernel_size"                 : [3, 5],
+                    "activation"                  : ["relu", "elu", "leaky-relu", "selu", "gelu"],
+                    "dropout_rate"                : [0., .25, .5],
+                    "batch_Norm"                  : [False, True],
+                    "optimizer"                   : ["Adam", "Nadam", "RMSprop", "SGD"],
+                    "Learning_rate_custom"        : [None, 1e-2, 1e-3, 1e-4],
+                    "couche_entierement_connectee": [32, 64, 128]}
+
+
+def _Identifiant_configuration(configuration):
+    """
+    Identifiant stable d'une configuration, pour la retrouver dans le journal lors d'une reprise.
+    """
+    return hashlib.sha1(json.dumps(configuration, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+
+
+def _Tirage_configurations(espace, nombre, graine):
+    """
+    Tire au hasard nombre configurations différentes de l'espace de recherche (toute la grille si elle est plus petite).
+    """
+    noms = sorted(espace)
+    taille_grille = int(np.prod([len(espace[nom]) for nom in noms]))
+    generateur_aleatoire = np.random.RandomState(graine)
+    configurations = collections.OrderedDict()
+    while len(configurations) < min(nombre, taille_grille):
+        configuration = {nom : espace[nom][generateur_aleatoire.randint(len(espace[nom]))] for nom in noms}
+        #types python : la configuration est écrite en JSON et passée à build_cnn
+        configuration = {nom : valeur.item() if isinstance(valeur, np.generic) else valeur for nom, valeur in configuration.items()}
+        configurations.setdefault(_Identifiant_configuration(configuration), configuration)
+    return configurations
+
+
+def _Initialisation_processus(nombre_de_threads):
+    """
+    Limite le nombre de threads de calcul de chaque processus de la recherche, pour que les essais en parallèle
+    ne se disputent pas les coeurs.
+    """
+    for variable in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[variable] = str(nombre_de_threads)
+    tf.config.threading.set_intra_op_parallelism_threads(nombre_de_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(min(2, nombre_de_threads))
+
+
+def _Entrainement_essai(tache):
+    """
+    Entraine une configuration de build_cnn jusqu'au nombre d'epochs demandé, en reprenant les poids du palier précédent
+    s'ils existent, et renvoie les métriques de validation de la dernière epoch. Exécutée dans un processus de la recherche.
+    """
+    debut = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()): #résumés des réseaux et messages des datasets
+            entrainement, classes = Dataset_depuis_dossier(tache["Dossier"], tache["taille"], tache["channels"], tache["batch_size"],
+                                                           validation_split=tache["validation_split"], subset="training",
+                                                           graine=tache["graine"])
+            validation, _ = Dataset_depuis_dossier(tache["Dossier"], tache["taille"], tache["channels"], tache["batch_size"],
+                                                   validation_split=tache["validation_split"], subset="validation",
+                                                   melange=False, graine=tache["graine"])
+            tf.random.set_seed(tache["graine"])
+            model = build_cnn(tuple(tache["taille"]) + (tache["channels"],), len(classes), **tache["configuration"])
+        epoch_initiale = 0
+        if tache["epochs_precedentes"] and os.path.exists(tache["Fichier_poids_precedent"]):
+            model.load_weights(tache["Fichier_poids_precedent"])
+            epoch_initiale = tache["epochs_precedentes"]
+        historique = model.fit(entrainement, validation_data=validation, epochs=tache["epochs"], initial_epoch=epoch_initiale,
+                               verbose=0)
+        model.save_weights(tache["Fichier_poids"])
+        metriques = {nom : float(valeurs[-1]) for nom, valeurs in historique.history.items()}
+        resultat = {"metriques" : metriques, "parametres" : int(model.count_params()), "erreur" : None}
+    except Exception as erreur:
+        resultat = {"metriques" : {}, "parametres" : None, "erreur" : "{} : {}".format(type(erreur).__name__, erreur)}
+    keras.backend.clear_session()
+    resultat["duree"] = time.perf_counter() - debut
+    return resultat
+
+
+def Recherche_hyperparametres(Dossier,
+                              Dossier_recherche,
+                              espace = None,
+                              nombre_configurations = 27,
+                              epochs_min = 1,
+                              facteur = 3,
+                              nombre_paliers = 3,
+                              taille = (128,128),
+                              channels = 1,
+                              batch_size = 32,
+                              validation_split = 0.2,
+                              metrique = "val_accuracy",
+                              nombre_de_processus = None,
+                              threads_par_processus = None,
+                              graine = 42,
+                              nombre_meilleurs = 5
+                             ):
+    """
+    Cherche les meilleurs réglages de build_cnn sur un dossier d'images rangées par classe (comme pour Dataset_depuis_dossier).
+    Les configurations sont tirées au hasard dans l'espace de recherche puis entrainées en parallèle dans plusieurs processus,
+    par paliers (successive halving) : toutes sont entrainées epochs_min epochs, seul le meilleur tiers (pour facteur = 3)
+    continue jusqu'à epochs_min * 3 epochs, et ainsi de suite. Les essais faibles sont abandonnés tôt, le temps de calcul va
+    aux configurations prometteuses.
+    Chaque essai terminé est ajouté au journal 'essais.jsonl' du Dossier_recherche : relancer la fonction avec les mêmes
+    paramètres reprend la recherche là où elle s'était arrêtée, et les poids de chaque essai permettent de continuer
+    l'entrainement d'un palier au suivant. Les réglages de l'entrainement (Dossier, taille, channels, batch_size, validation_split,
+    graine, epochs_min, facteur) sont écrits avec chaque essai : la reprise est refusée s'ils ont changé.
+
+    Parameters
+    ----------
+        - Dossier : string, dossier contenant un sous-dossier d'images par classe
+        - Dossier_recherche : string, dossier du journal et des poids des essais
+        - espace : dict, optionnel, {paramètre de build_cnn : liste des valeurs à essayer}, ESPACE_RECHERCHE par défaut
+        - nombre_configurations : int, nombre de configurations tirées au départ
+        - epochs_min : int, nombre d'epochs du premier palier
+        - facteur : int, à chaque palier le nombre d'epochs est multiplié et le nombre de configurations divisé par facteur
+        - nombre_paliers : int
+        - taille : tuple, hauteur et largeur des images
+        - channels : int, nombre de channels des images
+        - batch_size : int
+        - validation_split : float, proportion des images réservée à la validation
+        - metrique : string, métrique de keras utilisée pour classer les essais, maximisée (minimisée si c'est une 'loss')
+        - nombre_de_processus : int, nombre d'essais entrainés en même temps, par défaut un par groupe de 2 coeurs
+        - threads_par_processus : int, nombre de threads de calcul de chaque essai, par défaut les coeurs divisés par le nombre de processus
+        - graine : int, graine du tirage des configurations et de la séparation entrainement / validation
+        - nombre_meilleurs : int, nombre de configurations affichées à la fin
+
+    Returns
+    -------
+        - resultats : dataframe pandas, une ligne par configuration avec ses paramètres, le dernier palier atteint, le nombre d'epochs,
+        les métriques de ce palier, la durée totale et l'erreur éventuelle, triée de la meilleure à la moins bonne
+
+    Notes
+    -----
+    Les processus sont démarrés en 'spawn' (un fork d'un processus où tensorflow est déjà chargé peut bloquer) : lancée depuis un
+    script, la fonction doit être appelée sous if __name__ == "__main__".
+
+    """
+    espace = ESPACE_RECHERCHE if espace is None else espace
+    coeurs = os.cpu_count() or 1
+    nombre_de_processus = nombre_de_processus or max(1, coeurs // 2)
+    threads_par_processus = threads_par_processus or max(1, coeurs // nombre_de_processus)
+    maximiser = "loss" not in metrique
+    os.makedirs(Dossier_recherche, exist_ok=True)
+    Fichier_journal = os.path.join(Dossier_recherche, "essais.jsonl")
+
+    configurations = _Tirage_configurations(espace, nombre_configurations, graine)
+    #Réglages dont dépendent les essais et leurs poids, écrits avec chaque essai : sous la forme relue dans le journal
+    reglages = json.loads(json.dumps({"Dossier" : os.path.abspath(os.path.normpath(Dossier)), "taille" : list(taille),
+                                      "channels" : channels, "batch_size" : batch_size, "validation_split" : validation_split,
+                                      "graine" : graine, "epochs_min" : epochs_min, "facteur" : facteur}))
+    #Reprise : essais déjà terminés, par (identifiant, palier)
+    journal = {}
+    if os.path.exists(Fichier_journal):
+        with open(Fichier_journal) as fichier:
+            for ligne in fichier:
+                if ligne.strip():
+                    essai = json.loads(ligne)
+                    if essai.get("reglages") != reglages:
+                        raise ValueError("Le journal {} a été créé avec d'autres réglages ({}) : utiliser un autre Dossier_recherche "
+                                         "pour ces réglages ({})".format(Fichier_journal, essai.get("reglages"), reglages))
+                    journal[(essai["identifiant"], essai["palier"])] = essai
+    if journal:
+        print("Reprise : {} essais déjà terminés dans {}".format(len(journal), Fichier_journal))
+
+    def score(essai):
+        valeur = essai["metriques"].get(metrique)
+        if essai["erreur"] is not None or valeur is None or not np.isfinite(valeur):
+            return -np.inf
+        return valeur if maximiser else -valeur
+
+    survivants = list(configurations)
+    contexte = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=nombre_de_processus, mp_context=contexte,
+                                                initializer=_Initialisation_processus,
+                                                initargs=(threads_par_processus,)) as executeur:
+        for palier in range(nombre_paliers):
+            epochs = epochs_min * facteur ** palier
+            epochs_precedentes = epochs_min * facteur ** (palier - 1) if palier > 0 else 0
+            a_faire = [identifiant for identifiant in survivants if (identifiant, palier) not in journal]
+            print("Palier {} : {} configurations, {} epochs, {} essais à entrainer ({} processus x {} threads)".format(
+                palier, len(survivants), epochs, len(a_faire), nombre_de_processus, threads_par_processus))
+            futurs = {}
+            for identifiant in a_faire:
+                tache = {"configuration" : configurations[identifiant], "Dossier" : Dossier, "taille" : list(taille),
+                         "channels" : channels, "batch_size" : batch_size, "validation_split" : validation_split,
+                         "graine" : graine, "epochs" : epochs, "epochs_precedentes" : epochs_precedentes,
+                         "Fichier_poids" : os.path.join(Dossier_recherche, "poids_{}_{}.h5".format(identifiant, palier)),
+                         "Fichier_poids_precedent" : os.path.join(Dossier_recherche, "poids_{}_{}.h5".format(identifiant, palier - 1))}
+                futurs[executeur.submit(_Entrainement_essai, tache)] = identifiant
+            for futur in concurrent.futures.as_completed(futurs):
+                identifiant = futurs[futur]
+                essai = {"identifiant" : identifiant, "palier" : palier, "epochs" : epochs,
+                         "configuration" : configurations[identifiant], "reglages" : reglages,
+                         "date" : datetime.datetime.now().isoformat()}
+                essai.update(futur.result())
+                with open(Fichier_journal, "a") as fichier: #une ligne par essai, écrite dès qu'il se termine
+                    fichier.write(json.dumps(essai) + "\n")
+                journal[(identifiant, palier)] = essai
+                print("  {} : {}".format(identifiant, essai["erreur"] or "{} = {:.4f} en {:.0f} s".format(
+                    metrique, essai["metriques"].get(metrique, np.nan), essai["duree"])))
+            classement = sorted(survivants, key=lambda identifiant : score(journal[(identifiant, palier)]), reverse=True)
+            if palier < nombre_paliers - 1:
+                survivants = [identifiant for identifiant in classement[:max(1, len(classement) // facteur)]
+                              if np.isfinite(score(journal[(identifiant, palier)]))] or classement[:1]
+
+    #Résultat de chaque configuration au dernier palier qu'elle a atteint
+    lignes = []
+    for identifiant, configuration in configurations.items():
+        paliers = [palier for palier in range(nombre_paliers) if (identifiant, palier) in journal]
+        essai = journal[(identifiant, paliers[-1])]
+        ligne = {"identifiant" : identifiant, "palier" : paliers[-1], "epochs" : essai["epochs"]}
+        ligne.update(configuration)
+        ligne.update(essai["metriques"])
+        ligne["duree"] = sum(journal[(identifiant, palier)]["duree"] for palier in paliers)
+        ligne["erreur"] = essai["erreur"]
+        ligne["_score"] = score(essai)
+        lignes.append(ligne)
+    resultats = pandas.DataFrame(lignes).sort_values(["palier", "_score"], ascending=False).drop(columns="_score")
+    resultats = resultats.reset_index(drop=True)
+    print("Meilleures configurations :")
+    print(resultats.head(nombre_meilleurs).to_string())
+    return resultats
+
+
+def _Parcours_epoch(generateur, nombre_de_batchs = None):
+    """
+    Parcourt une fois un jeu de test, batch par batch, en lisant le batch suivant pendant que le batch courant est utilisé.
+    tf.data.Dataset et keras.utils.Sequence (generators keras, SequencePatchs) sont lus en entier, sans modifier la position
+    utilisée par ComparaisonResultats ; un generator python doit être limité par nombre_de_batchs.
+    """
+    if isinstance(generateur, tf.data.Dataset):
+        iterateur = (tuple(np.asarray(element) for element in batch) for batch in generateur)
+    elif isinstance(generateur, keras.utils.Sequence):
+        iterateur = (generateur[i] for i in range(len(generateur)))
+    else:
+        if nombre_de_batchs is None:
+            raise ValueError("nombre_de_batchs doit être indiqué pour un generator python, qui n'a pas de fin")
+        iterateur = generateur
+    if nombre_de_batchs is not None:
+        iterateur = (batch for _, batch in zip(range(nombre_de_batchs), iterateur))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as lecteur:
+        futur = lecteur.submit(next, iterateur, None)
+        while True:
+            batch = futur.result()
+            if batch is None:
+                return
+            futur = lecteur.submit(next, iterateur, None)
+            yield batch
+
+
+def _Aire_sous_courbe(positifs, negatifs):
+    """
+    Aire sous la courbe ROC à partir des histogrammes des scores des positifs et des négatifs (mêmes classes de score) :
+    probabilité qu'un positif ait un score supérieur à un négatif, les égalités dans une classe comptant pour moitié.
+    """
+    P, N = positifs.sum(), negatifs.sum()
+    if P == 0 or N == 0:
+        return np.nan
+    positifs_au_dessus = np.cumsum(positifs[::-1])[::-1] - positifs
+    return float(np.sum(negatifs * (positifs_au_dessus + 0.5 * positifs)) / (P * N))
+
+
+def Evaluation_flux(model,
+                    test_gen,
+                    categories,
+                    nombre_exemples = 32,
+                    nombre_de_seuils = 1000,
+                    nombre_de_batchs = None,
+                    graine = 42,
+                    afficher = True
+                   ):
+    """
+    Évalue un réseau de classification sur tout un jeu de test en un seul passage : chaque batch est lu une fois, prédit une fois,
+    puis sert à mettre à jour la matrice de confusion, les histogrammes des scores (pour l'aire sous la courbe ROC) et un réservoir
+    d'exemples tirés au hasard pour l'affichage. Seul le batch courant est gardé en mémoire, quelle que soit la taille du jeu de test.
+
+    Parameters
+    ----------
+        - model : model tensorflow, le réseau de neurones
+        - test_gen : generator keras, SequencePatchs ou tf.data.Dataset, le jeu de test, labels en one-hot ou en entiers
+        - categories : list, liste des classes à nommer
+        - nombre_exemples : int, nombre d'images gardées pour l'affichage (cf ComparaisonResultats)
+        - nombre_de_seuils : int, nombre de classes de score pour le calcul de l'aire sous la courbe ROC (précision de l'ordre de 1/nombre_de_seuils)
+        - nombre_de_batchs : int, optionnel, limite le nombre de batchs lus, obligatoire pour un generator python
+        - graine : int, graine du tirage des exemples
+        - afficher : boolean, affiche la matrice de confusion et les métriques
+
+    Returns
+    -------
+        - evaluation : dict avec :
+            'matrice_confusion' : dataframe pandas, vérité en lignes, prédiction en colonnes
+            'metriques' : dataframe pandas, par classe : 'effectif', 'precision', 'rappel', 'f1', 'auc' (une classe contre les autres)
+            'exactitude' : float, proportion d'images bien classées
+            'nombre_images' : int
+            'images_par_seconde' : float
+            'exemples' : dict, 'images', 'verites', 'predictions' (indices des classes) et 'probabilites' des exemples tirés
+
+    """
+    nombre_classes = len(categories)
+    confusion = np.zeros((nombre_classes, nombre_classes), dtype=np.int64)
+    histogramme_positifs = np.zeros((nombre_classes, nombre_de_seuils), dtype=np.int64)
+    histogramme_negatifs = np.zeros((nombre_classes, nombre_de_seuils), dtype=np.int64)
+    generateur_aleatoire = np.random.RandomState(graine)
+    exemples = {"images" : [], "verites" : [], "predictions" : [], "probabilites" : []}
+    nombre_images = 0
+
+    debut = time.perf_counter()
+    for batch in _Parcours_epoch(test_gen, nombre_de_batchs):
+        x, y = batch[0], np.asarray(batch[1])
+        probabilites = np.asarray(model.predict_on_batch(x), dtype=np.float32).reshape(len(y), -1)
+        if probabilites.shape[1] == 1: #sortie sigmoïde : probabilité de la classe 1
+            probabilites = np.concatenate([1. - probabilites, probabilites], axis=1)
+        verites = np.argmax(y, axis=1) if y.ndim > 1 and y.shape[1] > 1 else np.rint(y.reshape(len(y))).astype(np.int64)
+        predictions = np.argmax(probabilites, axis=1)
+
+        confusion += np.bincount(verites * nombre_classes + predictions, minlength=nombre_classes ** 2).reshape(nombre_classes, -1)
+        classes_score = np.clip((probabilites * nombre_de_seuils).astype(np.int64), 0, nombre_de_seuils - 1)
+        for k in range(nombre_classes):
+            positif = verites == k
+            histogramme_positifs[k] += np.bincount(classes_score[positif, k], minlength=nombre_de_seuils)
+            histogramme_negatifs[k] += np.bincount(classes_score[~positif, k], minlength=nombre_de_seuils)
+
+        #Échantillonnage par réservoir : chaque image du jeu de test a la même probabilité d'être gardée
+        for i in range(len(y)):
+            nombre_images += 1
+            if len(exemples["images"]) < nombre_exemples:
+                place = len(exemples["images"])
+                for cle in exemples:
+                    exemples[cle].append(None)
+            else:
+                place = generateur_aleatoire.randint(nombre_images)
+                if place >= nombre_exemples:
+                    continue
+            exemples["images"][place] = np.array(x[i])
+            exemples["verites"][place] = verites[i]
+            exemples["predictions"][place] = predictions[i]
+            exemples["probabilites"][place] = probabilites[i]
+    duree = time.perf_counter() - debut
+
+    vrais_positifs = np.diag(confusion).astype(np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precision = vrais_positifs / confusion.sum(axis=0)
+        rappel = vrais_positifs / confusion.sum(axis=1)
+        f1 = 2 * precision * rappel / (precision + rappel)
+    metriques = pandas.DataFrame({"effectif" : confusion.sum(axis=1), "precision" : precision, "rappel" : rappel, "f1" : f1,
+                                  "auc" : [_Aire_sous_courbe(histogramme_positifs[k], histogramme_negatifs[k])
+                                           for k in range(nombre_classes)]},
+                                 index=list(categories))
+    evaluation = {"matrice_confusion" : pandas.DataFrame(confusion, index=list(categories), columns=list(categories)),
+                  "metriques" : metriques,
+                  "exactitude" : float(vrais_positifs.sum() / max(nombre_images, 1)),
+                  "nombre_images" : nombre_images,
+                  "images_par_seconde" : nombre_images / duree,
+                  "exemples" : {cle : np.array(valeurs) for cle, valeurs in exemples.items()}}
+
+    print("{} images évaluées en {:.1f} s ({:.0f} images/s), exactitude : {:.3f}".format(
+        nombre_images, duree, evaluation["images_par_seconde"], evaluation["exactitude"]))
+    if afficher:
+        print(metriques.round(3))
+        plt.figure(figsize=(6,6))
+        plt.imshow(confusion, cmap="Blues")
+        for i in range(nombre_classes):
+            for j in range(nombre_classes):
+                plt.text(j, i, confusion[i, j], ha="center", va="center",
+                         color="white" if confusion[i, j] > confusion.max() / 2 else "black")
+        plt.xticks(range(nombre_classes), categories, rotation=45)
+        plt.yticks(range(nombre_classes), categories)
+        plt.xlabel("Prédiction")
+        plt.ylabel("Vérité")
+        plt.show()
+    return evaluation
+
+
+def _Affichage_exemples(images, verites, predictions, categories, color, colonnes):
+    """
+    Affiche des images avec en titre la vérité et la prédiction du réseau.
+    """
+    nombre = len(images)
+    colonnes = min(colonnes, nombre)
+    lignes = int(np.ceil(nombre / colonnes))
+    plt.figure(figsize=(20,20))
+    for i in range(nombre):
+        plt.subplot(lignes,colonnes,i+1)
+        plt.imshow(images[i][:,:,0], cmap=color)
+        titre = 'Vérité: '+ categories[verites[i]] +'\n vs Predit: '+categories[predictions[i]]
+        plt.title(titre)
+        plt.axis('off')
+    plt.show()
+
+
+def ComparaisonResultats(Nombre_a_afficher, model, test_gen, categories, color="gray", colonnes=2, reset=False, evaluation=None):
     """
     Ni Keras ni Tensorflow ne propose de fonction simple pour afficher les résultats en image des prédictions faites par le réseau et
     leur comparaison par rapport à la labellisation réelle.
@@ -874,35 +3991,442 @@ def ComparaisonResultats(Nombre_a_afficher, model, test_gen, categories, color="
     ----------
         - Nombre_a_afficher : int, le nombre d'exemples que l'on veut afficher
         - model : model tensorflow, le réseau de neurones
-        - test_gen : generator, le test_generator que nous utilisons
+        - test_gen : generator keras ou tf.data.Dataset, le jeu de test que nous utilisons
         - categories : list, liste des classes à nommer,
         - color :  string, nom des couleurs à utiliser pour l'affichage, cf matplotlib : https://matplotlib.org/3.1.0/gallery/color/named_colors.html
         - colonnes : combien d'images afficher sur une même ligne, ne peut dépasser la taille du batch du generator
         - reset : boolean, retourne au début du generator
+        - evaluation : dict, optionnel, résultat de Evaluation_flux : les exemples tirés pendant l'évaluation sont affichés,
+        sans nouvelle prédiction ni lecture du jeu de test
   
     
     """
+    if evaluation is not None:
+        exemples = evaluation["exemples"]
+        n = min(Nombre_a_afficher, len(exemples["images"]))
+        _Affichage_exemples(exemples["images"][:n], exemples["verites"][:n], exemples["predictions"][:n], categories, color, colonnes)
+        return
+
     if reset ==True :
-        test_gen.reset()
+        if isinstance(test_gen, tf.data.Dataset):
+            _ITERATEURS_DATASETS.pop(test_gen, None)
+        else:
+            test_gen.reset()
     
-    prediction=model.predict(test_gen,steps=Nombre_a_afficher/test_gen.batch_size,verbose=1)
-    predicted_class_indices=np.argmax(prediction,axis=1)
-    predictions = [categories[k] for k in predicted_class_indices]
     number=0
     while number < Nombre_a_afficher :
-        x,y = test_gen.next()
-
-        plt.figure(figsize=(20,20))
-        lignes= int(test_gen.batch_size/colonnes)
-        if colonnes > Nombre_a_afficher:
-            colonnes = Nombre_a_afficher
-        if test_gen.batch_size%colonnes !=0:
-            lignes+=1
-        for i in range(0,test_gen.batch_size):
-            plt.subplot(lignes,colonnes,i+1)
-            plt.imshow(x[i,:,:,0], cmap=color)
-            titre = 'Vérité: '+ categories[np.argmax(y[i])] +'\n vs Predit: '+predictions[i]
-            plt.title(titre)
-            plt.axis('off')
-        plt.show()
-        number += test_gen.batch_size
\ No newline at end of file
+        #La prédiction est faite sur le batch affiché, pour que chaque image soit comparée à sa propre prédiction
+        x,y = _Batch_suivant(test_gen)
+        batch_size = min(len(x), Nombre_a_afficher - number)
+        prediction = np.asarray(model.predict_on_batch(x[:batch_size]))
+        if prediction.shape[-1] == 1:
+            predictions = (prediction[:, 0] >= 0.5).astype(int)
+        else:
+            predictions = np.argmax(prediction, axis=1)
+        y = np.asarray(y)[:batch_size]
+        verites = np.argmax(y, axis=1) if y.ndim > 1 and y.shape[1] > 1 else np.rint(y.reshape(len(y))).astype(int)
+        _Affichage_exemples(x[:batch_size], verites, predictions, categories, color, colonnes)
+        number += batch_size
+
+
+#___________________________________________________________________________________________
+#___________________FONCTIONS POUR APPLIQUER LES RESEAUX AUX VOLUMES_________________________
+#___________________________________________________________________________________________
+
+def _Ponderation_tuile(taille_tuile, marge):
+    """
+    Poids de chaque pixel d'une tuile pour le fondu des recouvrements : rampe linéaire sur la marge, 1 au centre.
+    Les poids ne sont jamais nuls, pour que les bords de coupe couverts par une seule tuile restent définis.
+    """
+    axes = []
+    for taille in taille_tuile:
+        position = np.arange(taille, dtype=np.float32) + 0.5
+        if marge > 0:
+            axes.append(np.minimum(1., np.minimum(position, taille - position) / marge))
+        else:
+            axes.append(np.ones(taille, dtype=np.float32))
+    return axes[0][:, None] * axes[1][None, :]
+
+
+def _Octets_par_tuile(model, taille_tuile):
+    """
+    Estimation de la mémoire utilisée par une tuile lors de la prédiction : somme des sorties de toutes les couches, en float32.
+    """
+    total = 0
+    for couche in model.layers:
+        try:
+            forme = K.int_shape(couche.output)
+        except (AttributeError, ValueError):
+            continue
+        if isinstance(forme, list) or forme is None:
+            continue
+        forme = list(forme[1:])
+        if len(forme) == 3: #dimensions inconnues d'un réseau entièrement convolutif : taille de la tuile
+            forme[0] = forme[0] or taille_tuile[0]
+            forme[1] = forme[1] or taille_tuile[1]
+        total += 4 * int(np.prod([d or 1 for d in forme]))
+    return max(total, 1)
+
+
+def Segmentation_volume(model,
+                        volume,
+                        taille_tuile = None,
+                        recouvrement = 0.25,
+                        budget_Mo = 512,
+                        pretraitement = None,
+                        labels = False,
+                        seuil = 0.5,
+                        Fichier_sortie = None,
+                        dtype = np.float16
+                       ):
+    """
+    Applique un réseau de segmentation (cf U_Net) à toutes les coupes d'un volume, quelle que soit leur taille, sans les redimensionner.
+    Chaque coupe est découpée en tuiles de la taille d'entrée du réseau, qui se recouvrent ; les tuiles de plusieurs coupes sont
+    prédites ensemble, par lots aussi grands que le permet le budget mémoire, puis recollées avec un fondu sur les recouvrements.
+    La lecture des coupes suivantes (décodage DICOM, disque) se fait pendant la prédiction.
+
+    Parameters
+    ----------
+        - model : model tensorflow, réseau de segmentation dont la sortie a la même taille que l'entrée
+        - volume : array numpy, memmap, SerieDICOM ou chemin d'un fichier .npy, [nb_de_coupes, lignes, colonnes]
+        - taille_tuile : tuple, optionnel, (lignes, colonnes) des tuiles, par défaut la taille d'entrée du réseau
+        - recouvrement : float, fraction de la tuile partagée avec sa voisine, entre 0 et 1 exclu
+        - budget_Mo : int, mémoire allouée aux tuiles en cours de prédiction (entrées, activations du réseau et sorties)
+        - pretraitement : fonction, optionnel, appliquée à chaque bloc de coupes en float32 avant la prédiction, elle doit reproduire
+        la normalisation de l'entrainement, exemple : lambda coupes : WL_scaled(40, 400, coupes, 0, 1)
+        - labels : boolean, True pour renvoyer les labels (seuil si une seule classe, argmax sinon) en uint8 au lieu des probabilités
+        - seuil : float, seuil de probabilité pour les labels d'un réseau à une seule sortie
+        - Fichier_sortie : string, optionnel, fichier .npy où écrire le résultat directement (memmap)
+        - dtype : type numpy des probabilités, np.float16 par défaut comme les volumes de Dossier_DICOM_vers_ImagesPNG
+
+    Returns
+    -------
+        - segmentation : array numpy (ou memmap si Fichier_sortie est indiqué), [nb_de_coupes, lignes, colonnes] pour une sortie
+        unique ou des labels, [nb_de_coupes, lignes, colonnes, classes] pour les probabilités de plusieurs classes
+        - coupes_par_seconde : float, débit obtenu
+
+    """
+    if isinstance(volume, str):
+        volume = Ouvrir_volume(volume)
+    nombre_de_coupes, lignes, colonnes = tuple(volume.shape)[:3]
+    forme_entree = model.input_shape
+    channels = forme_entree[-1]
+    classes = model.output_shape[-1]
+    if taille_tuile is None:
+        taille_tuile = (forme_entree[1] or lignes, forme_entree[2] or colonnes)
+    taille_tuile = tuple(int(t) for t in taille_tuile)
+    if not 0 <= recouvrement < 1:
+        raise ValueError("recouvrement doit être compris entre 0 et 1 exclu : {}".format(recouvrement))
+
+    #Les coupes plus petites que la tuile sont complétées en répétant le bord
+    lignes_tuilees, colonnes_tuilees = max(lignes, taille_tuile[0]), max(colonnes, taille_tuile[1])
+    marge = min(int(round(min(taille_tuile) * recouvrement)), min(taille_tuile) - 1) #l'arrondi ne doit pas annuler le pas entre tuiles
+    positions = [(y, x) for y in _Positions_patchs(lignes_tuilees, taille_tuile[0], taille_tuile[0] - marge)
+                        for x in _Positions_patchs(colonnes_tuilees, taille_tuile[1], taille_tuile[1] - marge)]
+    poids_tuile = _Ponderation_tuile(taille_tuile, marge)
+    #Les tuiles sont les mêmes pour toutes les coupes : la somme des poids n'est calculée qu'une fois
+    poids_total = np.zeros((lignes_tuilees, colonnes_tuilees), dtype=np.float32)
+    for y, x in positions:
+        poids_total[y:y + taille_tuile[0], x:x + taille_tuile[1]] += poids_tuile
+    poids_tuile = poids_tuile[..., None]
+    inverse_poids = (1. / poids_total)[:lignes, :colonnes, None]
+
+    #Taille des lots de tuiles et nombre de coupes traitées ensemble selon le budget mémoire
+    octets_tuile = _Octets_par_tuile(model, taille_tuile) + 4 * int(np.prod(taille_tuile)) * (channels + classes)
+    octets_coupe = 4 * lignes_tuilees * colonnes_tuilees * (1 + classes) + 4 * len(positions) * int(np.prod(taille_tuile)) * channels
+    tuiles_par_lot = max(1, int(budget_Mo * 1e6 // octets_tuile))
+    coupes_par_bloc = int(max(1, min(nombre_de_coupes, tuiles_par_lot // len(positions),
+                                     budget_Mo * 1e6 // (2 * octets_coupe)))) #2 blocs en mémoire : le courant et le suivant
+
+    if labels:
+        forme_sortie, dtype = (nombre_de_coupes, lignes, colonnes), np.uint8
+    else:
+        forme_sortie = (nombre_de_coupes, lignes, colonnes) + ((classes,) if classes > 1 else ())
+    sortie = Allocation_volume(forme_sortie, dtype=dtype, Fichier_volume=Fichier_sortie)
+
+    def lecture(debut):
+        bloc = np.asarray(volume[debut:min(debut + coupes_par_bloc, nombre_de_coupes)], dtype=np.float32)
+        if pretraitement is not None:
+            bloc = np.asarray(pretraitement(bloc), dtype=np.float32)
+        if (lignes_tuilees, colonnes_tuilees) != (lignes, colonnes):
+            bloc = np.pad(bloc, ((0, 0), (0, lignes_tuilees - lignes), (0, colonnes_tuilees - colonnes)), mode="edge")
+        return bloc
+
+    debut_chrono = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as lecteur:
+        futur = lecteur.submit(lecture, 0)
+        for debut in range(0, nombre_de_coupes, coupes_par_bloc):
+            bloc = futur.result()
+            if debut + coupes_par_bloc < nombre_de_coupes:
+                futur = lecteur.submit(lecture, debut + coupes_par_bloc)
+            n = len(bloc)
+            #Tuiles rangées par position puis par coupe : la tuile p de la coupe s est à l'indice p * n + s
+            tuiles = np.empty((len(positions) * n,) + taille_tuile + (channels,), dtype=np.float32)
+            for p, (y, x) in enumerate(positions):
+                tuiles[p * n:(p + 1) * n] = bloc[:, y:y + taille_tuile[0], x:x + taille_tuile[1], None]
+            predictions = np.concatenate([np.asarray(model.predict_on_batch(tuiles[i:i + tuiles_par_lot]), dtype=np.float32)
+                                          for i in range(0, len(tuiles), tuiles_par_lot)])
+            somme = np.zeros((n, lignes_tuilees, colonnes_tuilees, classes), dtype=np.float32)
+            for p, (y, x) in enumerate(positions):
+                somme[:, y:y + taille_tuile[0], x:x + taille_tuile[1]] += predictions[p * n:(p + 1) * n] * poids_tuile
+            probabilites = somme[:, :lignes, :colonnes] * inverse_poids
+            if labels:
+                if classes == 1:
+                    sortie[debut:debut + n] = probabilites[..., 0] >= seuil
+                else:
+                    sortie[debut:debut + n] = np.argmax(probabilites, axis=-1)
+            else:
+                sortie[debut:debut + n] = probabilites[..., 0] if classes == 1 else probabilites
+    if Fichier_sortie is not None:
+        sortie.flush()
+    duree = time.perf_counter() - debut_chrono
+    coupes_par_seconde = nombre_de_coupes / duree
+    print("{} coupes segmentées en {:.1f} s ({:.1f} coupes/s, {} tuiles par coupe, lots de {} tuiles)".format(
+        nombre_de_coupes, duree, coupes_par_seconde, len(positions), min(tuiles_par_lot, len(positions) * coupes_par_bloc)))
+    return sortie, coupes_par_seconde
+
+
+#___________________________________________________________________________________________
+#___________________FONCTIONS POUR EXPORTER LES RESEAUX______________________________________
+#___________________________________________________________________________________________
+
+QUANTIFICATIONS = (None, "float16", "int8")
+
+
+def _Images_calibration(donnees, nombre_images, labels = False):
+    """
+    Renvoie au plus nombre_images images d'un jeu de données (array numpy, tuple (images, labels) d'arrays numpy, generator keras,
+    SequencePatchs ou tf.data.Dataset), en float32, en lisant le moins de batchs possible.
+    Avec labels=True, renvoie (images, labels), labels valant None si le jeu de données n'en a pas.
+    """
+    if isinstance(donnees, (np.ndarray, tuple)):
+        batchs = [donnees]
+    else:
+        #Un generator python n'a pas de fin : au plus nombre_images batchs suffisent
+        nombre_de_batchs = None if isinstance(donnees, (tf.data.Dataset, keras.utils.Sequence)) else nombre_images
+        batchs = _Parcours_epoch(donnees, nombre_de_batchs)
+    images, verites, total = [], [], 0
+    for batch in batchs:
+        x = np.asarray(batch[0] if isinstance(batch, tuple) else batch, dtype=np.float32)[:nombre_images - total]
+        images.append(x)
+        if isinstance(batch, tuple) and len(batch) > 1:
+            verites.append(np.asarray(batch[1])[:len(x)])
+        total += len(x)
+        if total >= nombre_images:
+            break
+    verites = np.concatenate(verites) if verites and len(verites) == len(images) else None #si chaque batch lu en avait
+    images = np.concatenate(images)
+    return (images, verites) if labels else images
+
+
+def Export_modele(model, Dossier_export, quantification = "float16", donnees_calibration = None, nombre_calibration = 200,
+                  entrees_entieres = False):
+    """
+    Exporte un réseau (build_cnn, U_Net, TransferLearning...) pour l'inférence hors de la session d'entrainement :
+    un SavedModel tensorflow et un modèle TFLite, plus léger et plus rapide sur les processeurs des consoles de lecture.
+
+    Parameters
+    ----------
+        - model : model tensorflow, le réseau entrainé
+        - Dossier_export : string, dossier où écrire 'saved_model' et 'modele_<quantification>.tflite'
+        - quantification : parmi QUANTIFICATIONS :
+            None : TFLite en float32, mêmes résultats que le réseau
+            'float16' : poids en float16, taille divisée par 2, calculs en float32
+            'int8' : poids et activations en int8 (quantification entière complète), taille divisée par 4 ; les plages des
+            activations sont calibrées sur donnees_calibration
+        - donnees_calibration : array numpy, generator keras, SequencePatchs ou tf.data.Dataset, images représentatives des données
+        réelles, prétraitées comme pour l'entrainement ; obligatoire pour 'int8'
+        - nombre_calibration : int, nombre d'images utilisées pour la calibration
+        - entrees_entieres : boolean, pour 'int8', entrée et sortie du modèle TFLite en int8 au lieu de float32 (quantification
+        faite par l'appelant, cf _Prediction_TFLite)
+
+    Returns
+    -------
+        - fichiers : dict, {'saved_model' : dossier, 'tflite' : fichier}
+
+    """
+    if quantification not in QUANTIFICATIONS:
+        raise ValueError("quantification doit être parmi {} : {}".format(QUANTIFICATIONS, quantification))
+    os.makedirs(Dossier_export, exist_ok=True)
+    fichiers = {"saved_model" : os.path.join(Dossier_export, "saved_model"),
+                "tflite" : os.path.join(Dossier_export, "modele_{}.tflite".format(quantification or "float32"))}
+    tf.saved_model.save(model, fichiers["saved_model"])
+
+    convertisseur = tf.lite.TFLiteConverter.from_keras_model(model)
+    if quantification == "float16":
+        convertisseur.optimizations = [tf.lite.Optimize.DEFAULT]
+        convertisseur.target_spec.supported_types = [tf.float16]
+    elif quantification == "int8":
+        if donnees_calibration is None:
+            raise ValueError("la quantification int8 nécessite des données de calibration")
+        calibration = _Images_calibration(donnees_calibration, nombre_calibration)
+        def representatif():
+            for image in calibration:
+                yield [image[None]]
+        convertisseur.optimizations = [tf.lite.Optimize.DEFAULT]
+        convertisseur.representative_dataset = representatif
+        convertisseur.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        if entrees_entieres:
+            convertisseur.inference_input_type = tf.int8
+            convertisseur.inference_output_type = tf.int8
+    contenu = convertisseur.convert()
+    with open(fichiers["tflite"], "wb") as fichier:
+        fichier.write(contenu)
+    print("SavedModel : {}\nTFLite ({}) : {} ({:.2f} Mo)".format(fichiers["saved_model"], quantification or "float32",
+                                                                  fichiers["tflite"], len(contenu) / 1e6))
+    return fichiers
+
+
+def _Interpreteur_TFLite(Fichier_tflite, nombre_de_threads = None):
+    """
+    Ouvre un modèle TFLite. num_threads n'existe pas dans les versions anciennes de tensorflow : l'interpréteur est alors
+    créé sans, et nombre_de_threads renvoyé vaut None.
+    """
+    try:
+        return tf.lite.Interpreter(model_path=Fichier_tflite, num_threads=nombre_de_threads), nombre_de_threads
+    except TypeError:
+        return tf.lite.Interpreter(model_path=Fichier_tflite), None
+
+
+def _Prediction_TFLite(interpreteur, x):
+    """
+    Prédiction d'un batch par un interpréteur TFLite : adapte la taille du batch, quantifie l'entrée et déquantifie la sortie
+    si le modèle a des entrées/sorties entières.
+    """
+    entree = interpreteur.get_input_details()[0]
+    if tuple(entree["shape"]) != tuple(x.shape):
+        interpreteur.resize_tensor_input(entree["index"], list(x.shape))
+        interpreteur.allocate_tensors()
+        entree = interpreteur.get_input_details()[0]
+    echelle, zero = entree["quantization"]
+    if np.issubdtype(entree["dtype"], np.integer) and echelle:
+        informations = np.iinfo(entree["dtype"])
+        x = np.clip(np.rint(x / echelle + zero), informations.min, informations.max)
+    interpreteur.set_tensor(entree["index"], np.asarray(x, dtype=entree["dtype"]))
+    interpreteur.invoke()
+    sortie = interpreteur.get_output_details()[0]
+    resultat = interpreteur.get_tensor(sortie["index"])
+    echelle, zero = sortie["quantization"]
+    if np.issubdtype(sortie["dtype"], np.integer) and echelle:
+        resultat = (resultat.astype(np.float32) - zero) * echelle
+    return resultat.astype(np.float32)
+
+
+def Verification_TFLite(model, Fichier_tflite, donnees, nombre_images = 200, batch_size = 16, seuil = 0.5):
+    """
+    Compare les prédictions d'un modèle TFLite (cf Export_modele) à celles du réseau d'origine sur les mêmes images, pour
+    vérifier que la quantification ne dégrade pas les résultats.
+
+    Parameters
+    ----------
+        - model : model tensorflow, le réseau d'origine
+        - Fichier_tflite : string, chemin du modèle TFLite
+        - donnees : array numpy, tuple (images, labels), generator keras, SequencePatchs ou tf.data.Dataset, images de test
+        prétraitées ; si les labels sont fournis (one-hot, entiers ou masques), l'exactitude des deux modèles est aussi calculée
+        - nombre_images : int, nombre d'images comparées
+        - batch_size : int, taille des batchs prédits
+        - seuil : float, seuil de probabilité des sorties à une seule classe (réseaux sigmoïdes, U_Net)
+
+    Returns
+    -------
+        - verification : dict avec 'ecart_max' et 'ecart_moyen' (différence absolue des probabilités), 'accord' (proportion
+        d'images, ou de pixels pour une segmentation, dont la classe prédite est identique) et, si les labels sont fournis,
+        'exactitude_keras', 'exactitude_tflite' et 'delta_exactitude' (TFLite moins keras), None sinon
+
+    """
+    images, verites = _Images_calibration(donnees, nombre_images, labels=True)
+    interpreteur, _ = _Interpreteur_TFLite(Fichier_tflite)
+    interpreteur.allocate_tensors()
+
+    def classes(sorties, labels = False):
+        #Classe prédite (ou vraie) par image, ou par pixel pour une segmentation
+        if sorties.shape[-1] == 1:
+            return sorties[..., 0] >= (0.5 if labels else seuil)
+        return np.argmax(sorties, axis=-1)
+
+    ecart_max, somme_ecarts, accords, justes_keras, justes_tflite, total = 0., 0., 0, 0, 0, 0
+    for debut in range(0, len(images), batch_size):
+        x = images[debut:debut + batch_size]
+        reference = np.asarray(model.predict_on_batch(x), dtype=np.float32)
+        quantifie = _Prediction_TFLite(interpreteur, x).reshape(reference.shape)
+        ecarts = np.abs(reference - quantifie)
+        ecart_max = max(ecart_max, float(ecarts.max()))
+        somme_ecarts += float(ecarts.sum())
+        classes_reference, classes_quantifie = classes(reference), classes(quantifie)
+        accords += int((classes_reference == classes_quantifie).sum())
+        if verites is not None:
+            vraies = np.asarray(verites[debut:debut + batch_size], dtype=np.float32)
+            if vraies.ndim == reference.ndim - 1: #labels entiers (classes, masques d'indices de classe)
+                classes_vraies = np.rint(vraies).astype(np.int64)
+            else: #one-hot, ou probabilité d'une seule classe
+                classes_vraies = classes(vraies, labels=True)
+            classes_vraies = classes_vraies.reshape(classes_reference.shape)
+            justes_keras += int((classes_reference == classes_vraies).sum())
+            justes_tflite += int((classes_quantifie == classes_vraies).sum())
+        total += classes_reference.size
+    verification = {"ecart_max" : ecart_max,
+                    "ecart_moyen" : somme_ecarts / (total * (1 if reference.shape[-1] == 1 else reference.shape[-1])),
+                    "accord" : accords / total,
+                    "exactitude_keras" : None, "exactitude_tflite" : None, "delta_exactitude" : None}
+    texte = "{} : écart max {:.4f}, écart moyen {:.5f}, prédictions identiques {:.2%}".format(
+        os.path.basename(Fichier_tflite), verification["ecart_max"], verification["ecart_moyen"], verification["accord"])
+    if verites is not None:
+        verification["exactitude_keras"] = justes_keras / total
+        verification["exactitude_tflite"] = justes_tflite / total
+        verification["delta_exactitude"] = verification["exactitude_tflite"] - verification["exactitude_keras"]
+        texte += ", exactitude {:.2%} -> {:.2%} ({:+.2%})".format(verification["exactitude_keras"],
+                                                                verification["exactitude_tflite"], verification["delta_exactitude"])
+    print(texte)
+    return verification
+
+
+def Benchmark_TFLite(Fichiers_tflite, model = None, tailles_batch = (1, 8, 32), threads = (1, 2, 4), repetitions = 20):
+    """
+    Mesure la latence et le débit de modèles TFLite (et du réseau keras d'origine, en référence) selon la taille du batch
+    et le nombre de threads, sur des images aléatoires de la taille d'entrée.
+
+    Parameters
+    ----------
+        - Fichiers_tflite : dict, {nom : chemin du modèle TFLite}, ou un seul chemin
+        - model : model tensorflow, optionnel, réseau d'origine mesuré avec predict_on_batch (tensorflow choisit ses threads)
+        - tailles_batch : liste d'int
+        - threads : liste d'int, nombre de threads de l'interpréteur TFLite
+        - repetitions : int, nombre de batchs mesurés par configuration, après un batch d'échauffement
+
+    Returns
+    -------
+        - resultats : dataframe pandas, une ligne par mesure : 'modele', 'batch_size', 'threads', 'latence_mediane_ms',
+        'latence_p90_ms', 'images_par_seconde'
+
+    """
+    if isinstance(Fichiers_tflite, str):
+        Fichiers_tflite = {os.path.basename(Fichiers_tflite) : Fichiers_tflite}
+    resultats = []
+
+    def mesure(nom, prediction, batch_size, nombre_de_threads, forme):
+        x = np.random.rand(batch_size, *forme).astype(np.float32)
+        prediction(x)
+        durees = []
+        for _ in range(repetitions):
+            debut = time.perf_counter()
+            prediction(x)
+            durees.append(time.perf_counter() - debut)
+        durees = np.array(durees)
+        resultats.append({"modele" : nom, "batch_size" : batch_size, "threads" : nombre_de_threads,
+                          "latence_mediane_ms" : 1e3 * np.median(durees), "latence_p90_ms" : 1e3 * np.percentile(durees, 90),
+                          "images_par_seconde" : batch_size / np.median(durees)})
+        print("{} batch={} threads={} : {:.1f} ms, {:.0f} images/s".format(nom, batch_size, nombre_de_threads,
+              resultats[-1]["latence_mediane_ms"], resultats[-1]["images_par_seconde"]))
+
+    for batch_size in tailles_batch:
+        if model is not None:
+            mesure("keras", model.predict_on_batch, batch_size, None, model.input_shape[1:])
+        for nom, Fichier_tflite in Fichiers_tflite.items():
+            for nombre_de_threads in threads:
+                interpreteur, nombre_de_threads = _Interpreteur_TFLite(Fichier_tflite, nombre_de_threads)
+                interpreteur.allocate_tensors()
+                forme = tuple(interpreteur.get_input_details()[0]["shape"][1:])
+                mesure(nom, functools.partial(_Prediction_TFLite, interpreteur), batch_size, nombre_de_threads, forme)
+                if nombre_de_threads is None: #version de tensorflow sans réglage du nombre de threads
+                    break
+    return pandas.DataFrame(resultats)
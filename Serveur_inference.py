@@ -0,0 +1,474 @@
+"""
+Serveur local d'inférence : charge une seule fois un réseau entrainé (build_cnn, TransferLearning, U_Net) et répond en HTTP
+aux demandes de prédiction, sans ouvrir le notebook.
+
+Les requêtes arrivant en même temps sont regroupées en batchs (taille maximale et attente maximale réglables) : le réseau fait
+une prédiction pour tout le batch au lieu d'une par requête.
+
+    python Serveur_inference.py serveur modele.h5 --fenetre 40 400 --classes normal pathologique --port 8080
+
+    curl --data-binary @coupe.dcm http://127.0.0.1:8080/predire      fichier DICOM (ou .npy, en UH)
+    curl http://127.0.0.1:8080/statistiques                          latences, profondeur de la file, taille des batchs
+
+Mesure du débit sous la même charge, sur un fichier d'exemple, de trois façons de servir le réseau : un model.predict_on_batch
+par requête (comme dans le notebook), le serveur sans regroupement (batch_max = 1) et le serveur avec regroupement :
+
+    python Serveur_inference.py comparaison modele.h5 coupe.dcm --requetes 2000 --concurrence 64
+
+Le gain du regroupement dépend du coût du réseau par rapport au décodage et au réglage du contraste, faits image par image :
+il est d'autant plus grand que le réseau est lourd et que la machine a de coeurs pour les décodeurs.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import asyncio
+import base64
+import collections
+import concurrent.futures
+import io
+import json
+import sys
+import time
+
+import numpy as np
+import pydicom
+import tensorflow as tf
+
+import FunctionsMaster as Tutoriel
+
+
+#Préfixe d'un fichier .npy
+MAGIQUE_NPY = b"\x93NUMPY"
+
+
+class EntreeInvalide(ValueError):
+    """
+    Fichier envoyé illisible ou qui n'est pas une image : la requête est refusée (400) avant d'entrer dans un batch.
+    """
+
+
+class RequeteTropGrande(EntreeInvalide):
+    """
+    Corps annoncé par Content-Length plus grand que la taille maximale acceptée par le serveur (413), il n'est pas lu.
+    """
+
+
+class ErreurPrediction(RuntimeError):
+    """
+    Échec du réseau sur un batch : erreur du serveur (500), pas de la requête.
+    """
+
+
+class ServeurInference:
+    """
+    Réseau chargé une fois, file d'attente des images à prédire et statistiques du service.
+
+    Parameters
+    ----------
+        - Fichier_modele : string, réseau keras sauvegardé (.h5 ou dossier SavedModel) ou modèle TFLite (cf Tutoriel.Export_modele)
+        - fenetre : tuple, (centre, largeur) en UH du réglage du contraste fait avant l'entrainement (cf ReglageContrasteDICOM)
+        - rescale : float, facteur appliqué aux images après le contraste, 1/255 comme Dataset_depuis_dossier
+        - classes : liste, optionnel, noms des classes d'un réseau de classification
+        - batch_max : int, nombre maximal d'images prédites ensemble
+        - attente_max_ms : float, durée maximale pendant laquelle la première image d'un batch attend les suivantes
+        - seuil : float, seuil de probabilité des masques d'un réseau de segmentation à une seule sortie
+        - nombre_decodeurs : int, nombre de threads décodant les DICOM pendant que le réseau prédit
+        - par_requete : boolean, True pour prédire chaque requête seule avec model.predict_on_batch, sans file d'attente
+        (référence des mesures de Comparaison_regroupement)
+        - taille_max_Mo : float, taille maximale du corps d'une requête, au-delà elle est refusée (413) sans être lue
+        - file_max : int, nombre maximal d'images en attente d'un batch, 8 x batch_max par défaut : une fois la file pleine,
+        les requêtes suivantes (et les coupes suivantes d'un volume) attendent qu'elle se vide avant d'y entrer
+
+    """
+    def __init__(self, Fichier_modele, fenetre = (40, 400), rescale = 1/255., classes = None, batch_max = 32, attente_max_ms = 5,
+                 seuil = 0.5, nombre_decodeurs = 4, par_requete = False, taille_max_Mo = 256,
+                 file_max = None):
+        if Fichier_modele.endswith(".tflite"):
+            self.interpreteur, _ = Tutoriel._Interpreteur_TFLite(Fichier_modele)
+            self.interpreteur.allocate_tensors()
+            self.forme_entree = tuple(int(d) for d in self.interpreteur.get_input_details()[0]["shape"][1:])
+            self.model = None
+        else:
+            self.model = tf.keras.models.load_model(Fichier_modele, compile=False)
+            self.forme_entree = tuple(self.model.input_shape[1:])
+            self.interpreteur = None
+            #Un seul graphe pour toutes les tailles de batch : un appel coûte bien moins que predict_on_batch
+            def appel(x):
+                return self.model(x, training=False)
+            self.appel = tf.function(appel, input_signature=[tf.TensorSpec((None,) + self.forme_entree, tf.float32)],
+                                     autograph=False)
+        self.fenetre = fenetre
+        self.rescale = rescale
+        self.classes = classes
+        self.batch_max = batch_max
+        self.attente_max = attente_max_ms / 1e3
+        self.seuil = seuil
+        self.par_requete = par_requete
+        self.taille_max = int(taille_max_Mo * 1e6)
+        self.file_max = file_max or 8 * batch_max
+        self.decodeurs = concurrent.futures.ThreadPoolExecutor(max_workers=nombre_decodeurs)
+        #Un seul thread pour le réseau : les batchs se suivent, et l'interpréteur TFLite n'est pas partagé entre threads
+        self.predicteur = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.file = None
+        self.latences = collections.deque(maxlen=10000)
+        self.tailles_batch = collections.deque(maxlen=10000)
+        self.nombre_requetes = 0
+        self.nombre_erreurs = 0
+        self.debut = time.time()
+
+    def pretraitement(self, corps):
+        """
+        Décode un fichier DICOM ou .npy (une image ou un volume, en UH) et règle le contraste comme pour les images d'entrainement,
+        avec l'arrondi en uint8 des png. Le redimensionnement est fait par batch, cf prediction.
+        """
+        try:
+            if corps.startswith(MAGIQUE_NPY):
+                images_UH = np.load(io.BytesIO(corps), allow_pickle=False)
+            else:
+                dicom_file = pydicom.dcmread(io.BytesIO(corps), force=True)
+                pixels = Tutoriel.Decodage_pixels(dicom_file)[0]
+                images_UH = pixels * float(dicom_file.get("RescaleSlope", 1.)) + float(dicom_file.get("RescaleIntercept", 0.))
+        except Exception as erreur:
+            raise EntreeInvalide("fichier illisible, ni DICOM ni .npy ({} : {})".format(type(erreur).__name__, erreur))
+        #Une image (lignes, colonnes) ou un volume (coupes, lignes, colonnes) de nombres finis
+        if images_UH.dtype.kind not in "biuf":
+            raise EntreeInvalide("type de pixels non numérique : {}".format(images_UH.dtype))
+        if images_UH.ndim not in (2, 3) or 0 in images_UH.shape:
+            raise EntreeInvalide("forme {} : une image 2D ou un volume 3D non vide est attendu".format(images_UH.shape))
+        images_UH = images_UH.astype(np.float32)
+        if not np.isfinite(images_UH).all():
+            raise EntreeInvalide("l'image contient des valeurs non finies (nan, inf)")
+        if images_UH.ndim == 2:
+            images_UH = images_UH[None]
+        return np.rint(Tutoriel.ReglageContrasteDICOM(self.fenetre[0], self.fenetre[1], images_UH)).astype(np.uint8)
+
+    def prediction(self, images, predict_on_batch = False):
+        """
+        Redimensionne (bilinéaire, comme Dataset_depuis_dossier) et prédit un batch d'images de tailles éventuellement différentes :
+        les images de même taille sont redimensionnées ensemble. predict_on_batch : passe par model.predict_on_batch au lieu
+        du graphe préparé à l'ouverture du réseau.
+        """
+        x = np.empty((len(images),) + self.forme_entree, dtype=np.float32)
+        tailles = collections.defaultdict(list)
+        for i, image in enumerate(images):
+            tailles[image.shape].append(i)
+        for taille, indices in tailles.items():
+            groupe = np.stack([images[i] for i in indices])[..., None].astype(np.float32)
+            if taille != self.forme_entree[:2]:
+                groupe = tf.image.resize(groupe, self.forme_entree[:2], method="bilinear").numpy()
+            x[indices] = groupe * self.rescale
+        if self.model is not None and predict_on_batch:
+            return np.asarray(self.model.predict_on_batch(x), dtype=np.float32)
+        if self.model is not None:
+            return self.appel(x).numpy().astype(np.float32)
+        return Tutoriel._Prediction_TFLite(self.interpreteur, x)
+
+    def formatage(self, sortie, taille):
+        """
+        Réponse pour une image : classe et probabilités pour un réseau de classification, masque à la taille de l'image envoyée
+        pour un réseau de segmentation.
+        """
+        if sortie.ndim == 1:
+            probabilites = sortie if len(sortie) > 1 else np.array([1. - sortie[0], sortie[0]])
+            noms = self.classes or [str(k) for k in range(len(probabilites))]
+            return {"classe" : noms[int(np.argmax(probabilites))],
+                    "probabilites" : {nom : float(p) for nom, p in zip(noms, probabilites)}}
+        if sortie.shape[:2] != taille:
+            sortie = tf.image.resize(sortie, taille, method="bilinear").numpy()
+        masque = (sortie[..., 0] >= self.seuil) if sortie.shape[-1] == 1 else np.argmax(sortie, axis=-1)
+        masque = masque.astype(np.uint8)
+        tampon = io.BytesIO()
+        np.save(tampon, masque)
+        return {"forme" : list(masque.shape), "pixels_positifs" : int(np.count_nonzero(masque)),
+                "masque_npy" : base64.b64encode(tampon.getvalue()).decode("ascii")}
+
+    async def regroupement(self):
+        """
+        Boucle du réseau : attend une première image, complète le batch avec celles qui arrivent pendant attente_max
+        (ou qui attendaient déjà), prédit le batch dans le thread du réseau et répond à chaque requête.
+        """
+        boucle = asyncio.get_running_loop()
+        while True:
+            lot = [await self.file.get()]
+            limite = boucle.time() + self.attente_max
+            while len(lot) < self.batch_max:
+                if not self.file.empty():
+                    lot.append(self.file.get_nowait())
+                    continue
+                delai = limite - boucle.time()
+                if delai <= 0:
+                    break
+                try:
+                    lot.append(await asyncio.wait_for(self.file.get(), delai))
+                except asyncio.TimeoutError:
+                    break
+            self.tailles_batch.append(len(lot))
+            try:
+                sorties = await boucle.run_in_executor(self.predicteur, self.prediction, [image for image, _ in lot])
+            except Exception as erreur:
+                erreur = ErreurPrediction("{} : {}".format(type(erreur).__name__, erreur))
+                for _, futur in lot:
+                    if not futur.done():
+                        futur.set_exception(erreur)
+                continue
+            for (_, futur), sortie in zip(lot, sorties):
+                if not futur.done():
+                    futur.set_result(sortie)
+
+    async def predire(self, corps):
+        boucle = asyncio.get_running_loop()
+        images = await boucle.run_in_executor(self.decodeurs, self.pretraitement, corps)
+        if self.par_requete:
+            self.tailles_batch.append(len(images))
+            try:
+                sorties = await boucle.run_in_executor(self.predicteur, self.prediction, list(images), True)
+            except Exception as erreur:
+                raise ErreurPrediction("{} : {}".format(type(erreur).__name__, erreur))
+            resultats = [self.formatage(sortie, image.shape) for sortie, image in zip(sorties, images)]
+            return resultats[0] if len(resultats) == 1 else resultats
+        futurs = []
+        for image in images:
+            futurs.append(boucle.create_future())
+            await self.file.put((image, futurs[-1]))
+        sorties = await asyncio.gather(*futurs)
+        resultats = [self.formatage(sortie, image.shape) for sortie, image in zip(sorties, images)]
+        return resultats[0] if len(resultats) == 1 else resultats
+
+    def statistiques(self):
+        latences = np.array(self.latences) * 1e3
+        statistiques = {"requetes" : self.nombre_requetes, "erreurs" : self.nombre_erreurs,
+                        "file_attente" : self.file.qsize() if self.file is not None else 0, "file_max" : self.file_max,
+                        "batch_max" : self.batch_max, "attente_max_ms" : self.attente_max * 1e3,
+                        "taille_moyenne_batch" : float(np.mean(self.tailles_batch)) if self.tailles_batch else None,
+                        "requetes_par_seconde" : self.nombre_requetes / (time.time() - self.debut)}
+        for centile in (50, 90, 99):
+            statistiques["latence_p{}_ms".format(centile)] = float(np.percentile(latences, centile)) if len(latences) else None
+        return statistiques
+
+    async def connexion(self, lecteur, ecrivain):
+        """
+        Une connexion HTTP/1.1, éventuellement gardée ouverte pour plusieurs requêtes (keep-alive).
+        """
+        try:
+            while True:
+                try:
+                    requete = await _Lecture_requete(lecteur, self.taille_max)
+                except EntreeInvalide as erreur: #requête HTTP mal formée : la suite du flux n'est plus lisible, la connexion est fermée
+                    self.nombre_erreurs += 1
+                    _Ecriture_reponse(ecrivain, 413 if isinstance(erreur, RequeteTropGrande) else 400, {"erreur" : str(erreur)}, True)
+                    await ecrivain.drain()
+                    break
+                if requete is None:
+                    break
+                methode, chemin, entetes, corps = requete
+                debut = time.perf_counter()
+                if methode == "POST" and chemin.startswith("/predire"):
+                    try:
+                        statut, contenu = 200, await self.predire(corps)
+                        self.latences.append(time.perf_counter() - debut)
+                    except EntreeInvalide as erreur: #erreur de la requête
+                        self.nombre_erreurs += 1
+                        statut, contenu = 400, {"erreur" : str(erreur)}
+                    except Exception as erreur: #erreur du serveur : réseau, formatage de la réponse
+                        self.nombre_erreurs += 1
+                        statut, contenu = 500, {"erreur" : "{} : {}".format(type(erreur).__name__, erreur)}
+                    self.nombre_requetes += 1
+                elif methode == "GET" and chemin.startswith("/statistiques"):
+                    statut, contenu = 200, self.statistiques()
+                elif methode == "GET" and chemin.startswith("/sante"):
+                    statut, contenu = 200, {"forme_entree" : list(self.forme_entree)}
+                else:
+                    statut, contenu = 404, {"erreur" : "chemin inconnu : {} {}".format(methode, chemin)}
+                fermer = entetes.get("connection", "").lower() == "close"
+                _Ecriture_reponse(ecrivain, statut, contenu, fermer)
+                await ecrivain.drain()
+                if fermer:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            ecrivain.close()
+
+    async def demarrer(self, hote = "127.0.0.1", port = 8080):
+        """
+        Crée la file et la boucle du réseau dans la boucle asyncio courante puis ouvre le port ; renvoie le serveur asyncio.
+        """
+        self.file = asyncio.Queue(maxsize=self.file_max)
+        self._tache_regroupement = asyncio.ensure_future(self.regroupement())
+        return await asyncio.start_server(self.connexion, hote, port)
+
+
+STATUTS = {200 : "OK", 400 : "Bad Request", 404 : "Not Found", 413 : "Payload Too Large", 500 : "Internal Server Error"}
+
+
+async def _Lecture_requete(lecteur, taille_max):
+    """
+    Lit une requête HTTP : ligne de requête, en-têtes et corps selon Content-Length. None si le client a fermé la connexion.
+    Une requête mal formée lève EntreeInvalide, un corps de plus de taille_max octets RequeteTropGrande.
+    """
+    async def ligne_suivante():
+        try:
+            return await lecteur.readline()
+        except ValueError: #ligne plus longue que la limite du lecteur asyncio
+            raise EntreeInvalide("ligne de requête ou d'en-tête trop longue")
+
+    ligne = await ligne_suivante()
+    if not ligne.strip():
+        return None
+    morceaux = ligne.decode("latin-1").split()
+    if len(morceaux) != 3:
+        raise EntreeInvalide("ligne de requête mal formée : {!r}".format(ligne[:100]))
+    methode, chemin, _ = morceaux
+    entetes = {}
+    while True:
+        ligne = await ligne_suivante()
+        if ligne in (b"\r\n", b"\n", b""):
+            break
+        if b":" not in ligne:
+            raise EntreeInvalide("en-tête mal formé : {!r}".format(ligne[:100]))
+        cle, valeur = ligne.decode("latin-1").split(":", 1)
+        entetes[cle.strip().lower()] = valeur.strip()
+    try:
+        longueur = int(entetes.get("content-length", 0))
+    except ValueError:
+        longueur = -1
+    if longueur < 0:
+        raise EntreeInvalide("Content-Length invalide : {}".format(entetes["content-length"]))
+    if longueur > taille_max:
+        raise RequeteTropGrande("corps de {} octets, supérieur à la taille maximale acceptée ({} octets)".format(longueur, taille_max))
+    corps = await lecteur.readexactly(longueur)
+    return methode, chemin, entetes, corps
+
+
+def _Ecriture_reponse(ecrivain, statut, contenu, fermer = False):
+    corps = json.dumps(contenu).encode("utf-8")
+    ecrivain.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n".format(
+        statut, STATUTS.get(statut, ""), len(corps), "close" if fermer else "keep-alive").encode("latin-1") + corps)
+
+
+async def Test_charge(hote, port, corps, nombre_requetes = 1000, concurrence = 32):
+    """
+    Envoie nombre_requetes demandes de prédiction du même fichier par concurrence clients simultanés (une connexion keep-alive
+    chacun) et mesure le débit et les latences vus par les clients.
+
+    Returns
+    -------
+        - resultats : dict, 'requetes_par_seconde', 'latence_p50_ms', 'latence_p90_ms', 'latence_p99_ms', 'erreurs'
+
+    """
+    restantes = [nombre_requetes]
+    latences, erreurs = [], [0]
+    requete = "POST /predire HTTP/1.1\r\nHost: {}\r\nContent-Length: {}\r\n\r\n".format(hote, len(corps)).encode("latin-1") + corps
+
+    async def client():
+        lecteur, ecrivain = await asyncio.open_connection(hote, port)
+        try:
+            while restantes[0] > 0:
+                restantes[0] -= 1
+                debut = time.perf_counter()
+                ecrivain.write(requete)
+                await ecrivain.drain()
+                statut = (await lecteur.readline()).split()[1]
+                longueur = 0
+                while True:
+                    ligne = await lecteur.readline()
+                    if ligne in (b"\r\n", b"\n", b""):
+                        break
+                    if ligne.lower().startswith(b"content-length"):
+                        longueur = int(ligne.split(b":")[1])
+                await lecteur.readexactly(longueur)
+                latences.append(time.perf_counter() - debut)
+                if statut != b"200":
+                    erreurs[0] += 1
+        finally:
+            ecrivain.close()
+
+    debut = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrence)])
+    duree = time.perf_counter() - debut
+    latences = np.array(latences) * 1e3
+    resultats = {"requetes_par_seconde" : len(latences) / duree, "erreurs" : erreurs[0]}
+    for centile in (50, 90, 99):
+        resultats["latence_p{}_ms".format(centile)] = float(np.percentile(latences, centile))
+    return resultats
+
+
+async def Comparaison_regroupement(arguments, corps):
+    """
+    Mesure le débit sous la même charge de trois façons de servir le réseau :
+        - 'predict_par_requete' : un model.predict_on_batch par requête, sans file d'attente (comme dans le notebook)
+        - 'sans_regroupement' : le serveur avec batch_max = 1, une prédiction par image avec le graphe préparé
+        - 'regroupement' : le serveur avec batch_max
+    'acceleration' donne le débit du regroupement divisé par celui de chacune des deux références.
+    """
+    resultats = {}
+    for nom, batch_max, par_requete in (("predict_par_requete", 1, True), ("sans_regroupement", 1, False),
+                                        ("regroupement", arguments.batch_max, False)):
+        service = ServeurInference(arguments.modele, tuple(arguments.fenetre), arguments.rescale, arguments.classes, batch_max,
+                                   arguments.attente_max_ms, arguments.seuil, arguments.decodeurs, par_requete,
+                                   arguments.taille_max_Mo, arguments.file_max)
+        serveur = await service.demarrer(arguments.hote, arguments.port)
+        await Test_charge(arguments.hote, arguments.port, corps, 2 * arguments.concurrence, arguments.concurrence) #échauffement
+        resultats[nom] = await Test_charge(arguments.hote, arguments.port, corps, arguments.requetes, arguments.concurrence)
+        resultats[nom]["taille_moyenne_batch"] = service.statistiques()["taille_moyenne_batch"]
+        print("{} : {:.0f} requêtes/s, latence p50 {:.1f} ms, p99 {:.1f} ms".format(
+            nom, resultats[nom]["requetes_par_seconde"], resultats[nom]["latence_p50_ms"], resultats[nom]["latence_p99_ms"]),
+            file=sys.stderr)
+        serveur.close()
+        await serveur.wait_closed()
+        service._tache_regroupement.cancel()
+    resultats["acceleration"] = {reference : resultats["regroupement"]["requetes_par_seconde"] /
+                                             resultats[reference]["requetes_par_seconde"]
+                                 for reference in ("predict_par_requete", "sans_regroupement")}
+    return resultats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commandes = parser.add_subparsers(dest="commande")
+    commandes.required = True
+    for commande in ("serveur", "comparaison"):
+        sous_parser = commandes.add_parser(commande)
+        sous_parser.add_argument("modele", help="réseau keras (.h5, SavedModel) ou modèle .tflite")
+        if commande == "comparaison":
+            sous_parser.add_argument("fichier", help="fichier DICOM ou .npy envoyé à chaque requête")
+            sous_parser.add_argument("--requetes", type=int, default=2000)
+            sous_parser.add_argument("--concurrence", type=int, default=64)
+        sous_parser.add_argument("--hote", default="127.0.0.1")
+        sous_parser.add_argument("--port", type=int, default=8080)
+        sous_parser.add_argument("--fenetre", type=float, nargs=2, default=[40, 400], metavar=("CENTRE", "LARGEUR"))
+        sous_parser.add_argument("--rescale", type=float, default=1/255.)
+        sous_parser.add_argument("--classes", nargs="+", default=None)
+        sous_parser.add_argument("--batch-max", dest="batch_max", type=int, default=32)
+        sous_parser.add_argument("--attente-max-ms", dest="attente_max_ms", type=float, default=5.)
+        sous_parser.add_argument("--seuil", type=float, default=0.5)
+        sous_parser.add_argument("--decodeurs", type=int, default=4)
+        sous_parser.add_argument("--taille-max-mo", dest="taille_max_Mo", type=float, default=256.,
+                                 help="taille maximale du corps d'une requête")
+        sous_parser.add_argument("--file-max", dest="file_max", type=int, default=None,
+                                 help="nombre maximal d'images en attente d'un batch, 8 x batch-max par défaut")
+    arguments = parser.parse_args()
+
+    if arguments.commande == "comparaison":
+        with open(arguments.fichier, "rb") as fichier:
+            corps = fichier.read()
+        print(json.dumps(asyncio.run(Comparaison_regroupement(arguments, corps)), indent=2))
+        return
+
+    async def service():
+        serveur_inference = ServeurInference(arguments.modele, tuple(arguments.fenetre), arguments.rescale, arguments.classes,
+                                             arguments.batch_max, arguments.attente_max_ms, arguments.seuil, arguments.decodeurs,
+                                             taille_max_Mo=arguments.taille_max_Mo, file_max=arguments.file_max)
+        serveur = await serveur_inference.demarrer(arguments.hote, arguments.port)
+        print("Serveur prêt sur http://{}:{} (entrée {})".format(arguments.hote, arguments.port, serveur_inference.forme_entree),
+              file=sys.stderr)
+        async with serveur:
+            await serveur.serve_forever()
+    try:
+        asyncio.run(service())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()